@@ -26,12 +26,18 @@ of this module to check __name__ explicitly.  Fix all current clients
 that don't check __name__.
 """
 import errno
+import fcntl
+import hashlib
+import marshal
 import os
 import pdb
+import Queue
+import signal
 import socket
 import stat
 import struct
 import sys
+import threading
 import time
 import traceback
 import gflags as flags
@@ -52,12 +58,41 @@ flags.DEFINE_boolean('use_cprofile_for_profiling', True,
                      'Use cProfile instead of the profile module for '
                      'profiling. This has no effect unless '
                      '--run_with_profiling is set.')
+flags.DEFINE_integer('exception_handler_threads', 0,
+                     'If positive, run the installed exception handlers '
+                     'concurrently on up to this many threads, bounded by '
+                     '--exception_handler_timeout and '
+                     '--exception_handlers_deadline, instead of serially.')
+flags.DEFINE_float('exception_handler_timeout', 10.0,
+                   'Seconds a single exception handler may run before it is '
+                   'abandoned. Only used with --exception_handler_threads.')
+flags.DEFINE_float('exception_handlers_deadline', 30.0,
+                   'Seconds all exception handlers together may run before '
+                   'the program exits anyway. Only used with '
+                   '--exception_handler_threads.')
+flags.DEFINE_float('shutdown_timeout', 30.0,
+                   'Seconds all shutdown hooks together may run before the '
+                   'program exits anyway.')
 
 # If main() exits via an abnormal exception, call into these
 # handlers before exiting.
 
 EXCEPTION_HANDLERS = []
+# Run when the program shuts down, see RegisterShutdownHook.
+SHUTDOWN_HOOKS = []  # (priority, registration number, hook, timeout) tuples
+_shutdown_hooks_run = False
+_shutdown_atexit_registered = False
+_forkserver_socket_path = None  # Set by EnableForkserver
+_forkserver_idle_timeout = None
 help_text_wrap = False  # Whether to enable TextWrap in help output
+# If set, rendered usage text is persisted to this file (typically next to the
+# binary, e.g. sys.argv[0] + '.helpcache') and reused by later invocations as
+# long as the set of defined flags does not change.
+help_cache_file = None
+
+_help_cache = {}  # usage() output, indexed by _HelpCacheKey()
+_MAX_HELP_CACHE_ENTRIES = 8  # Stale entries are dropped beyond this size.
+_help_cache_loaded_from = None  # help_cache_file last merged into _help_cache
 
 
 class Error(Exception):
@@ -263,39 +298,169 @@ def _actual_start():
   if hasattr(sys, 'exc_clear'):
     sys.exc_clear()  # This functionality is gone in Python 3.
 
+  if _forkserver_socket_path is not None:
+    _StartForkserver()
+  _StartMain()
+
+
+def _StartMain():
+  """Run really_start(), calling the exception handlers and shutdown hooks."""
   try:
     really_start()
   except SystemExit, e:
     raise
   except Exception, e:
+    exc_info = sys.exc_info()
     # Call any installed exception handlers which may, for example,
-    # log to a file or send email.
-    for handler in EXCEPTION_HANDLERS:
-      try:
-        if handler.Wants(e):
-          handler.Handle(e)
-      except:
-        # We don't want to stop for exceptions in the exception handlers but
-        # we shouldn't hide them either.
-        sys.stderr.write(traceback.format_exc())
-        raise
+    # log to a file or send email. Flag parsing itself may have failed, so
+    # read the value (or default) without the unparsed flag access warning.
+    if FLAGS['exception_handler_threads'].value > 0:
+      _DispatchExceptionHandlersConcurrently(e)
+    else:
+      for handler in EXCEPTION_HANDLERS:
+        try:
+          if handler.Wants(e):
+            handler.Handle(e)
+        except:
+          # We don't want to stop for exceptions in the exception handlers but
+          # we shouldn't hide them either.
+          sys.stderr.write(traceback.format_exc())
+          raise
     # All handlers have had their chance, now die as we would have normally.
-    raise
+    raise exc_info[0], exc_info[1], exc_info[2]
+  finally:
+    # After the exception handlers, which may need what the hooks close.
+    RunShutdownHooks()
 
 
-def usage(shorthelp=0, writeto_stdout=0, detailed_error=None, exitcode=None):
-  """Write __main__'s docstring to stderr with some help text.
+def _DispatchExceptionHandlersConcurrently(exc):
+  """Run the exception handlers wanting exc on a bounded pool of threads.
+
+  At most --exception_handler_threads handlers run at the same time. A handler
+  still running after --exception_handler_timeout seconds is abandoned (its
+  daemon thread cannot hold up process exit) and its slot is given to the next
+  handler. Once --exception_handlers_deadline seconds have passed, remaining
+  handlers are abandoned or skipped. Exceptions raised by handlers are written
+  to stderr but do not stop the other handlers.
 
   Args:
-    shorthelp: print only flags from this module, rather than all flags.
-    writeto_stdout: write help message to stdout, rather than to stderr.
-    detailed_error: additional detail about why usage info was presented.
-    exitcode: if set, exit with this status code after writing help.
+    exc: Exception, the exception main() exited with.
   """
-  if writeto_stdout:
-    stdfile = sys.stdout
-  else:
-    stdfile = sys.stderr
+  pending = [handler for handler in EXCEPTION_HANDLERS if handler.Wants(exc)]
+  finished = Queue.Queue()
+  running = {}  # handler thread -> (handler, time it was started)
+  deadline = time.time() + FLAGS.exception_handlers_deadline
+
+  def RunHandler(handler):
+    try:
+      handler.Handle(exc)
+    except:  # pylint: disable=bare-except
+      sys.stderr.write(traceback.format_exc())
+    finished.put(threading.current_thread())
+
+  while pending or running:
+    now = time.time()
+    if now >= deadline:
+      break
+    while pending and len(running) < FLAGS.exception_handler_threads:
+      handler = pending.pop(0)
+      thread = threading.Thread(target=RunHandler, args=(handler,),
+                                name='ExceptionHandler-%s' % handler)
+      thread.daemon = True
+      running[thread] = (handler, now)
+      thread.start()
+    next_timeout = min([started + FLAGS.exception_handler_timeout
+                        for _, started in running.itervalues()] + [deadline])
+    try:
+      running.pop(finished.get(timeout=max(0, next_timeout - now)), None)
+    except Queue.Empty:
+      pass
+    now = time.time()
+    for thread, (handler, started) in running.items():
+      if now - started >= FLAGS.exception_handler_timeout:
+        sys.stderr.write('Exception handler %s timed out after %.1fs\n'
+                         % (handler, now - started))
+        del running[thread]
+
+  for handler, _ in running.itervalues():
+    sys.stderr.write('Exception handler %s abandoned at the deadline\n'
+                     % handler)
+  for handler in pending:
+    sys.stderr.write('Exception handler %s skipped at the deadline\n'
+                     % handler)
+
+
+def _HelpCacheKey(shorthelp):
+  """Returns a key identifying everything that usage() output depends on.
+
+  The key covers the defined flags (names, defaults and help strings), the
+  main module's key flags, its docstring and the wrapping settings, so a cached
+  rendering is discarded as soon as any of them changes.
+
+  Args:
+    shorthelp: whether the key is for the short (main module only) help.
+
+  Returns:
+    str, a hex digest.
+  """
+  fingerprint = hashlib.md5()
+  for module, module_flags in sorted(FLAGS.FlagsByModuleDict().iteritems()):
+    fingerprint.update('\0%s\0' % module)
+    for flag in module_flags:
+      fingerprint.update(repr((flag.name, flag.short_name, flag.default,
+                               flag.help)))
+  key_flags = FLAGS.KeyFlagsByModuleDict().get(sys.argv[0], [])
+  fingerprint.update(repr([flag.name for flag in key_flags]))
+  fingerprint.update(repr((shorthelp, sys.argv[0], help_text_wrap,
+                           flags.GetHelpWidth(),
+                           sys.modules['__main__'].__doc__)))
+  return fingerprint.hexdigest()
+
+
+def _LoadHelpCache():
+  """Merges the entries of help_cache_file into the in-memory help cache."""
+  # pylint: disable=global-statement
+  global _help_cache_loaded_from
+  if help_cache_file is None or _help_cache_loaded_from == help_cache_file:
+    return
+  _help_cache_loaded_from = help_cache_file
+  try:
+    with open(help_cache_file, 'rb') as fp:
+      entries = marshal.load(fp)
+  except (IOError, EOFError, ValueError, TypeError):
+    # A missing or corrupt cache is simply rebuilt.
+    return
+  if isinstance(entries, dict):
+    _help_cache.update(entries)
+
+
+def _SaveHelpCache():
+  """Writes the in-memory help cache to help_cache_file, if one is set."""
+  if help_cache_file is None:
+    return
+  # Avoid import overhead for the common case of no persistent cache.
+  from google.apputils import file_util  # pylint: disable=g-import-not-at-top
+  try:
+    file_util.AtomicWrite(help_cache_file, marshal.dumps(_help_cache),
+                          mode=0644)
+  except (IOError, OSError):
+    # The binary's directory may well be read-only; that only costs speed.
+    pass
+
+
+def _RenderUsage(shorthelp):
+  """Renders the docstring and flag parts of usage() output, memoized.
+
+  Args:
+    shorthelp: render only flags from the main module, rather than all flags.
+
+  Returns:
+    (doc, flag_str) tuple of str.
+  """
+  key = _HelpCacheKey(shorthelp)
+  _LoadHelpCache()
+  if key in _help_cache:
+    return _help_cache[key]
 
   doc = sys.modules['__main__'].__doc__
   if not doc:
@@ -315,6 +480,31 @@ def usage(shorthelp=0, writeto_stdout=0, detailed_error=None, exitcode=None):
     flag_str = FLAGS.MainModuleHelp()
   else:
     flag_str = str(FLAGS)
+  if len(_help_cache) >= _MAX_HELP_CACHE_ENTRIES:
+    _help_cache.clear()
+  _help_cache[key] = (doc, flag_str)
+  _SaveHelpCache()
+  return _help_cache[key]
+
+
+def usage(shorthelp=0, writeto_stdout=0, detailed_error=None, exitcode=None):
+  """Write __main__'s docstring to stderr with some help text.
+
+  The rendered text is memoized, see help_cache_file to also reuse it across
+  invocations.
+
+  Args:
+    shorthelp: print only flags from this module, rather than all flags.
+    writeto_stdout: write help message to stdout, rather than to stderr.
+    detailed_error: additional detail about why usage info was presented.
+    exitcode: if set, exit with this status code after writing help.
+  """
+  if writeto_stdout:
+    stdfile = sys.stdout
+  else:
+    stdfile = sys.stderr
+
+  doc, flag_str = _RenderUsage(shorthelp)
   try:
     stdfile.write(doc)
     if flag_str:
@@ -377,3 +567,375 @@ def InstallExceptionHandler(handler):
     raise TypeError('handler of type %s does not inherit from ExceptionHandler'
                     % type(handler))
   EXCEPTION_HANDLERS.append(handler)
+
+
+def RegisterShutdownHook(hook, priority=0, timeout=None):
+  """Register a callable to run once when the program shuts down.
+
+  Shutdown hooks are meant for flushing and draining: closing pools, flushing
+  metrics, finishing in-flight work. They run when main() returns or raises
+  (including the SystemExit raised for SIGTERM, see below, and the
+  KeyboardInterrupt raised for SIGINT), or at interpreter exit for programs
+  not started through run().  If main() raised, they run after the exception
+  handlers, so that crash reporters can still use the pools and connections
+  the hooks close.
+
+  Hooks run one at a time, lowest priority first and in registration order for
+  equal priorities. Each may take at most 'timeout' seconds, and all of them
+  together at most --shutdown_timeout seconds; a hook that overruns is
+  abandoned. Exceptions raised by hooks are written to stderr.
+
+  Registering a hook from the main thread also makes SIGTERM raise
+  SystemExit(128 + SIGTERM) in the main thread, so that a terminated program
+  unwinds and runs its hooks, unless a SIGTERM handler is already installed.
+  A second SIGTERM terminates the program immediately.
+
+  Args:
+    hook: callable taking no arguments.
+    priority: int, hooks with lower values run first.
+    timeout: float, seconds this hook may run, or None for no limit of its own.
+
+  Raises:
+    TypeError: hook is not callable
+  """
+  # pylint: disable=global-statement
+  global _shutdown_atexit_registered
+  if not callable(hook):
+    raise TypeError('shutdown hook %r is not callable' % (hook,))
+  SHUTDOWN_HOOKS.append((priority, len(SHUTDOWN_HOOKS), hook, timeout))
+  if not _shutdown_atexit_registered:
+    import atexit  # pylint: disable=g-import-not-at-top
+    atexit.register(RunShutdownHooks)
+    _shutdown_atexit_registered = True
+  if (isinstance(threading.current_thread(), threading._MainThread)  # pylint: disable=protected-access
+      and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+    signal.signal(signal.SIGTERM, _ShutdownSignalHandler)
+
+
+def _ShutdownSignalHandler(signum, unused_frame):
+  """Unwind the main thread so that the shutdown hooks run."""
+  # Let a repeated signal kill the program right away.
+  signal.signal(signum, signal.SIG_DFL)
+  sys.exit(128 + signum)
+
+
+def RunShutdownHooks():
+  """Run the registered shutdown hooks, see RegisterShutdownHook. Idempotent."""
+  # pylint: disable=global-statement
+  global _shutdown_hooks_run
+  if _shutdown_hooks_run:
+    return
+  _shutdown_hooks_run = True
+  # This may run at exit of a program that never parsed its flags, so read the
+  # value (or default) without triggering the unparsed flag access warning.
+  deadline = time.time() + FLAGS['shutdown_timeout'].value
+  for _, _, hook, timeout in sorted(SHUTDOWN_HOOKS):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      sys.stderr.write('Shutdown hook %s skipped at the deadline\n' % hook)
+      continue
+    if timeout is not None:
+      remaining = min(remaining, timeout)
+
+    def RunHook(hook=hook):
+      try:
+        hook()
+      except:  # pylint: disable=bare-except
+        sys.stderr.write(traceback.format_exc())
+    thread = threading.Thread(target=RunHook, name='ShutdownHook-%s' % hook)
+    thread.daemon = True
+    thread.start()
+    thread.join(remaining)
+    if thread.is_alive():
+      sys.stderr.write('Shutdown hook %s abandoned after %.1fs\n'
+                       % (hook, remaining))
+
+
+def EnableForkserver(idle_timeout=600):
+  """Serve later invocations of this program from a warm, forked process.
+
+  Call this at the top of the main module, before the expensive imports.
+  The first invocation then leaves a fully imported server process behind,
+  listening on a Unix socket private to the user. Later invocations of the
+  same (unmodified) main module find that server here: they forward argv,
+  environment, cwd and umask to it and have it fork a child that runs main()
+  with the invoker's stdin, stdout and stderr. The invoker relays signals to
+  that child and exits with its exit status, so this function does not return.
+  If no server is usable, this function returns and run() proceeds as usual,
+  starting a server for the next invocation.
+
+  The child reopens the invoker's stdio through /proc, so this only works on
+  Linux and not for stdio attached to sockets; those invocations simply run
+  without the server. Modules are imported once per server, so changes to
+  anything but the main module only take effect once the server has been idle
+  for idle_timeout seconds and exits.
+
+  Args:
+    idle_timeout: float, seconds after which an unused server exits.
+  """
+  # pylint: disable=global-statement
+  global _forkserver_socket_path, _forkserver_idle_timeout
+  path = _ForkserverSocketPath()
+  if path is None:
+    return
+  status = _ForwardToForkserver(path)
+  if status is not None:
+    sys.exit(status)
+  _forkserver_socket_path = path
+  _forkserver_idle_timeout = idle_timeout
+
+
+def _ForkserverSocketPath():
+  """Returns the forkserver socket path for this program, or None.
+
+  The socket lives in a directory only accessible by the current user. Its
+  name identifies the interpreter and the main module's path and mtime, so
+  that an edited program does not talk to a stale server.
+  """
+  main_file = getattr(sys.modules['__main__'], '__file__', None)
+  if not main_file or not os.path.isdir('/proc/self/fd'):
+    return None
+  main_file = os.path.realpath(main_file)
+  try:
+    mtime = os.stat(main_file).st_mtime
+  except OSError:
+    return None
+  # Avoid import overhead for programs not using the forkserver.
+  import tempfile  # pylint: disable=g-import-not-at-top
+  socket_dir = os.path.join(tempfile.gettempdir(),
+                            'apputils-forkserver-%d' % os.getuid())
+  try:
+    os.mkdir(socket_dir, 0700)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      return None
+  dir_stat = os.lstat(socket_dir)
+  if (not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid()
+      or stat.S_IMODE(dir_stat.st_mode) & 077):
+    return None
+  key = hashlib.md5(repr((sys.executable, main_file, mtime))).hexdigest()
+  return os.path.join(socket_dir, key)
+
+
+def _SendMessage(sock, message):
+  """Send a marshallable object as a length-prefixed message."""
+  data = marshal.dumps(message)
+  sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _RecvExactly(sock, size):
+  """Receive size bytes, or fewer if the peer closes the connection."""
+  chunks = []
+  while size:
+    try:
+      chunk = sock.recv(size)
+    except socket.error, e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    if not chunk:
+      break
+    chunks.append(chunk)
+    size -= len(chunk)
+  return ''.join(chunks)
+
+
+def _RecvMessage(sock):
+  """Receive a message sent by _SendMessage, or None on end of stream."""
+  header = _RecvExactly(sock, 4)
+  if len(header) < 4:
+    return None
+  size, = struct.unpack('!I', header)
+  data = _RecvExactly(sock, size)
+  if len(data) < size:
+    return None
+  return marshal.loads(data)
+
+
+def _ForwardToForkserver(path):
+  """Have the forkserver at path run this invocation.
+
+  Args:
+    path: str, the forkserver socket.
+
+  Returns:
+    The exit status of the invocation, or None if there is no usable server.
+  """
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(path)
+  except socket.error:
+    client.close()
+    return None
+  try:
+    stdio = []
+    for fd in (0, 1, 2):
+      try:
+        append = bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND)
+        fd_stat = os.fstat(fd)
+        offset = None
+        if stat.S_ISREG(fd_stat.st_mode):
+          offset = os.lseek(fd, 0, os.SEEK_CUR)
+      except (IOError, OSError):
+        return None  # Closed stdio cannot be reopened by the server.
+      stdio.append((append, offset, (fd_stat.st_dev, fd_stat.st_ino)))
+    umask = os.umask(0)
+    os.umask(umask)
+    _SendMessage(client, {'argv': sys.argv, 'environ': dict(os.environ),
+                          'cwd': os.getcwd(), 'umask': umask,
+                          'pid': os.getpid(), 'stdio': stdio})
+    reply = _RecvMessage(client)
+    if not reply or 'pid' not in reply:
+      return None
+
+    def ForwardSignal(signum, unused_frame):
+      try:
+        os.kill(reply['pid'], signum)
+      except OSError:
+        pass
+    for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGQUIT,
+                   signal.SIGTERM):
+      signal.signal(signum, ForwardSignal)
+
+    result = _RecvMessage(client)
+    if result is None:
+      return 1  # The child died without reporting its exit status.
+    for fd, offset in enumerate(result['offsets']):
+      if offset is not None and not stdio[fd][0]:
+        os.lseek(fd, offset, os.SEEK_SET)
+    return result['status']
+  except (socket.error, EOFError, ValueError):
+    return None
+  finally:
+    client.close()
+
+
+def _StartForkserver():
+  """Fork off a detached forkserver, then return in the original process."""
+  sys.stdout.flush()
+  sys.stderr.flush()
+  pid = os.fork()
+  if pid:
+    os.waitpid(pid, 0)
+    return
+  try:
+    os.setsid()
+    if os.fork() == 0:
+      _ServeForkserver()
+  finally:
+    os._exit(0)  # pylint: disable=protected-access
+
+
+def _ServeForkserver():
+  """Accept forkserver requests until idle, forking a child for each."""
+  null_fd = os.open(os.devnull, os.O_RDWR)
+  for fd in (0, 1, 2):
+    os.dup2(null_fd, fd)
+  os.close(null_fd)
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    listener.bind(_forkserver_socket_path)
+  except socket.error, e:
+    if e.errno != errno.EADDRINUSE:
+      return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(_forkserver_socket_path)
+      return  # Another server is already listening.
+    except socket.error:
+      pass
+    finally:
+      probe.close()
+    os.unlink(_forkserver_socket_path)
+    listener.bind(_forkserver_socket_path)
+  socket_inode = os.stat(_forkserver_socket_path).st_ino
+  listener.listen(16)
+  listener.settimeout(_forkserver_idle_timeout)
+  # Let the kernel reap the children; they report their status themselves.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  try:
+    while True:
+      try:
+        conn, _ = listener.accept()
+      except socket.timeout:
+        break
+      except socket.error, e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      if os.fork() == 0:
+        listener.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        _ServeForkserverRequest(conn)
+      conn.close()
+  finally:
+    try:
+      if os.stat(_forkserver_socket_path).st_ino == socket_inode:
+        os.unlink(_forkserver_socket_path)
+    except OSError:
+      pass
+
+
+def _ServeForkserverRequest(conn):
+  """Run main() for a forwarded invocation in this forked child; never returns.
+
+  Args:
+    conn: socket, the connection to the invoking process.
+  """
+  status = 1
+  try:
+    conn.settimeout(None)
+    request = _RecvMessage(conn)
+    if request is None:
+      return
+    try:
+      output_fds = {}  # (st_dev, st_ino) -> fd, for stdout and stderr
+      for fd, (append, offset, identity) in enumerate(request['stdio']):
+        if fd and identity in output_fds:
+          # Most likely '>file 2>&1': share the offset as the invoker does.
+          os.dup2(output_fds[identity], fd)
+          continue
+        mode = os.O_RDONLY if fd == 0 else os.O_WRONLY
+        if append:
+          mode |= os.O_APPEND
+        new_fd = os.open('/proc/%d/fd/%d' % (request['pid'], fd), mode)
+        os.dup2(new_fd, fd)
+        os.close(new_fd)
+        if offset is not None and not append:
+          os.lseek(fd, offset, os.SEEK_SET)
+        if fd:
+          output_fds[identity] = fd
+      os.chdir(request['cwd'])
+    except OSError, e:
+      _SendMessage(conn, {'error': str(e)})
+      return
+    os.environ.clear()
+    os.environ.update(request['environ'])
+    os.umask(request['umask'])
+    sys.argv[:] = request['argv']
+    _SendMessage(conn, {'pid': os.getpid()})
+
+    try:
+      _StartMain()
+      status = 0
+    except SystemExit, e:
+      if e.code is None:
+        status = 0
+      elif isinstance(e.code, int):
+        status = e.code
+      else:
+        sys.stderr.write('%s\n' % e.code)
+    except:  # pylint: disable=bare-except
+      traceback.print_exc()
+    import atexit  # pylint: disable=g-import-not-at-top
+    atexit._run_exitfuncs()  # pylint: disable=protected-access
+    sys.stdout.flush()
+    sys.stderr.flush()
+    offsets = []
+    for fd, (unused_append, offset, _) in enumerate(request['stdio']):
+      if offset is not None:
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+      offsets.append(offset)
+    _SendMessage(conn, {'status': status, 'offsets': offsets})
+  finally:
+    os._exit(status)  # pylint: disable=protected-access
@@ -28,7 +28,45 @@ global initialization should call appcommands.Run() rather than app.run().
 
 To register commands use AddCmd() or AddCmdFunc().  AddCmd() is used
 for commands that derive from class Cmd and the AddCmdFunc() is used
-to wrap simple functions.
+to wrap simple functions.  AddLazyCmd() registers a command by the dotted
+path of its Cmd subclass or function, which is only imported once the command
+is run or its full help is shown.  AddShellCmd() registers a 'shell' command
+that runs many command lines in one process, AddBatchCmd() a 'batch' command
+that does the same for command lines read from a file, and AddFanOutCmd() a
+'fanout' command that runs one command for many inputs in parallel.
+
+Timing and profiling:
+  The global flag --time_command_phases reports how long parsing the global
+  flags, main() and the command took. --profile_command=cprofile|sampling
+  profiles only the command's Run(), leaving out imports, flag parsing and
+  main().
+
+Shell completion:
+  AddCompletionCmd() registers a 'completion' command that writes a bash or
+  zsh completion script listing all commands, aliases and flags, so that
+  completing does not have to start the program.
+
+Coroutine commands:
+  The Run() method of a Cmd, or a function registered with AddCmdFunc(), may
+  be a coroutine of asyncio or, on Python 2, of its backport trollius. It is
+  run on an event loop shared by all commands of the process, which is closed
+  when the program shuts down.
+
+Result cache:
+  Commands registered with cacheable=True declare that their output depends
+  only on their arguments, their flags and the contents of their input files.
+  Their standard output and exit status are recorded in an on-disk cache and
+  replayed when they are run the same way again, with the same global flags
+  and by the same code, see --command_cache_dir and Cmd.GetCacheVersion.
+
+Daemon mode:
+  Running 'tool --serve_socket=PATH' initializes the tool once and then serves
+  command invocations over the Unix socket PATH, keeping whatever the commands
+  cache in between. A main module that calls ForwardToDaemon(PATH) before its
+  expensive imports has its invocations run by that daemon, if one is
+  listening, and otherwise runs them itself. PATH may be a plain name for a
+  socket in a directory private to the user; otherwise its directory must be
+  writable only by the user. Only the user's own processes are served.
 
 This module itself registers the command 'help' that allows users
 to retrieve help for all or specific commands.  'help' is the default
@@ -118,16 +156,63 @@ Inner working:
 
 
 
+import atexit
+import contextlib
+import copy
+import errno
+import fcntl
+import functools
+import hashlib
+import marshal
 import os
 import pdb
+import re
+import select
+import shlex
+import signal
+import socket
+import stat
+import StringIO
+import struct
 import sys
+import tempfile
+import threading
 import traceback
 
 from google.apputils import app
+from google.apputils import stopwatch
 import gflags as flags
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_string('serve_socket', None,
+                    'If set, serve the command invocations forwarded by '
+                    'ForwardToDaemon() over this Unix socket instead of '
+                    'running a command.')
+flags.DEFINE_boolean('time_command_phases', False,
+                     'Write the time spent parsing flags, in main() and in '
+                     'the command to stderr once the command finished.')
+flags.DEFINE_enum('profile_command', None, ['cprofile', 'sampling'],
+                  'Profile only the Run() of the command with cProfile or a '
+                  'sampling profiler and write the profile to stderr, or to '
+                  '--profile_command_file.')
+flags.DEFINE_string('profile_command_file', None,
+                    'Write the --profile_command profile to this file, for '
+                    'cprofile in the format read by the pstats module.')
+flags.DEFINE_boolean('use_command_cache', True,
+                     'Replay the results of cacheable commands from the '
+                     'result cache when run with the same arguments, flags '
+                     'and input files again.')
+flags.DEFINE_string('command_cache_dir', None,
+                    'Directory of the result cache of cacheable commands, by '
+                    'default $XDG_CACHE_HOME/<program>/command_results.')
+flags.DEFINE_integer('command_cache_size', 64 << 20,
+                     'Size in bytes the result cache is trimmed to, dropping '
+                     'the least recently used results first.', lower_bound=0)
+flags.DEFINE_float('profile_command_interval', 0.005,
+                   'Seconds of CPU time between two samples taken by '
+                   '--profile_command=sampling.', lower_bound=0.0001)
+
 
 # module exceptions:
 class AppCommandsError(Exception):
@@ -139,6 +224,107 @@ _cmd_argv = None        # remaining arguments with index 0 = sys.argv[0]
 _cmd_list = {}          # list of commands index by name (_Cmd instances)
 _cmd_alias_list = {}    # list of command_names index by command_alias
 _cmd_default = 'help'   # command to execute if none explicitly given
+_cmd_max_length = None  # length of the longest command name, or None
+_cmd_help_cache = {}    # rendered help of commands, see _CommandHelpBlock
+_cmd_prefix_matching = True  # whether unambiguous prefixes select commands
+_CMD_NAME_CHARS_RE = re.compile(r'\w+\Z')  # alphanumeric or '_' (no LOCALE)
+
+
+class _TrieNode(object):
+  """Node of the _CommandIndex trie."""
+
+  __slots__ = ('children', 'targets', 'name')
+
+  def __init__(self):
+    self.children = {}  # next character -> _TrieNode
+    self.targets = set()  # names of the commands registered below this node
+    self.name = None  # command name or alias ending at this node
+
+
+class _CommandIndex(object):
+  """Trie of command names and aliases.
+
+  Supports resolving unambiguous prefixes and suggesting registered names
+  close to a mistyped one, in time depending on the length of the names
+  rather than on the number of registered commands.
+  """
+
+  def __init__(self):
+    self._root = _TrieNode()
+
+  def Add(self, name, command_name):
+    """Index a command name or alias.
+
+    Args:
+      name:         command name or alias.
+      command_name: name of the command that name selects.
+    """
+    node = self._root
+    node.targets.add(command_name)
+    for char in name:
+      node = node.children.setdefault(char, _TrieNode())
+      node.targets.add(command_name)
+    node.name = name
+
+  def _Find(self, prefix):
+    """Returns the node for prefix, or None."""
+    node = self._root
+    for char in prefix:
+      node = node.children.get(char)
+      if node is None:
+        return None
+    return node
+
+  def GetTargets(self, prefix):
+    """Returns the set of command names selected by names starting with prefix."""
+    node = self._Find(prefix)
+    return node and node.targets or set()
+
+  def GetNames(self, prefix):
+    """Returns the sorted command names and aliases starting with prefix."""
+    names = []
+    stack = [self._Find(prefix)]
+    while stack:
+      node = stack.pop()
+      if node is None:
+        continue
+      if node.name is not None:
+        names.append(node.name)
+      stack.extend(node.children.itervalues())
+    return sorted(names)
+
+  def Suggest(self, word, max_distance=2):
+    """Returns the registered names within max_distance edits of word.
+
+    Computes the Levenshtein distance row by row while walking the trie, and
+    skips subtrees that cannot get within max_distance.
+
+    Args:
+      word:         str, the mistyped name.
+      max_distance: int, maximum number of inserted, deleted or substituted
+                    characters.
+
+    Returns:
+      List of names, closest first.
+    """
+    matches = []
+    stack = [(child, char, range(len(word) + 1))
+             for char, child in self._root.children.iteritems()]
+    while stack:
+      node, char, previous_row = stack.pop()
+      row = [previous_row[0] + 1]
+      for i in xrange(1, len(word) + 1):
+        row.append(min(row[i - 1] + 1, previous_row[i] + 1,
+                       previous_row[i - 1] + (word[i - 1] != char)))
+      if node.name is not None and row[-1] <= max_distance:
+        matches.append((row[-1], node.name))
+      if min(row) <= max_distance:
+        stack.extend((child, next_char, row)
+                     for next_char, child in node.children.iteritems())
+    return [name for _, name in sorted(matches)]
+
+
+_cmd_index = _CommandIndex()  # index of _cmd_alias_list
 
 
 def GetAppBasename():
@@ -184,13 +370,51 @@ def GetFullCommandList():
 def GetCommandByName(name):
   """Get the command or None if name is not a registered command.
 
+  Unless disabled with SetCommandPrefixMatching, name may also be a prefix
+  of the names and aliases of exactly one command.
+
   Args:
     name:  name of command to look for
 
   Returns:
     Cmd instance holding the command or None
   """
-  return GetCommandList().get(GetCommandAliasList().get(name))
+  command_name = GetCommandAliasList().get(name)
+  if command_name is None and _cmd_prefix_matching and name:
+    targets = _cmd_index.GetTargets(name)
+    if len(targets) == 1:
+      command_name, = targets
+  return GetCommandList().get(command_name)
+
+
+def SetCommandPrefixMatching(enabled):
+  """Change whether unambiguous prefixes of command names select commands.
+
+  Args:
+    enabled: bool, whether GetCommandByName accepts unambiguous prefixes.
+  """
+  # pylint: disable=global-statement
+  global _cmd_prefix_matching
+  _cmd_prefix_matching = enabled
+
+
+def _UnknownCommandMessage(name):
+  """Describe why name does not select a command, with suggestions.
+
+  Args:
+    name: str, the name given by the user.
+
+  Returns:
+    Message starting with "Command '<name>' unknown".
+  """
+  message = "Command '%s' unknown" % name
+  candidates = _cmd_index.GetNames(name) if _cmd_prefix_matching else []
+  if len(candidates) > 1:
+    return '%s, it is a prefix of: %s' % (message, ', '.join(candidates))
+  suggestions = _cmd_index.Suggest(name)
+  if suggestions:
+    return '%s, did you mean: %s?' % (message, ', '.join(suggestions[:5]))
+  return message
 
 
 def GetCommandArgv():
@@ -200,7 +424,385 @@ def GetCommandArgv():
 
 def GetMaxCommandLength():
   """Returns the length of the longest registered command."""
-  return max([len(cmd_name) for cmd_name in GetCommandList()])
+  # pylint: disable=global-statement
+  global _cmd_max_length
+  if _cmd_max_length is None:
+    _cmd_max_length = max([len(cmd_name) for cmd_name in GetCommandList()])
+  return _cmd_max_length
+
+
+_phase_stopwatch = stopwatch.StopWatch()  # for --time_command_phases
+_command_run_depth = 0  # number of Cmd.CommandRun calls in progress
+
+
+def _StartPhase(phase=None):
+  """Ends the running phase of _phase_stopwatch and starts the next one.
+
+  Unlike StopWatch.start() this does not resume the previous phase once the
+  new one is stopped, phases follow each other.
+
+  Args:
+    phase: Name of the phase to start, or None to only end the running one.
+  """
+  for timer in list(_phase_stopwatch.timers):
+    if timer != 'total':
+      _phase_stopwatch.stop(timer)
+  if phase:
+    _phase_stopwatch.start(phase)
+
+
+class _SamplingProfiler(object):
+  """Statistical profiler sampling the main thread's stack on SIGPROF.
+
+  Its overhead does not grow with the number of function calls the way
+  cProfile's does, which keeps the timing of call heavy commands realistic.
+  """
+
+  def __init__(self, interval):
+    self._interval = interval
+    self._samples = 0
+    self._self_counts = {}
+    self._total_counts = {}
+
+  def _Sample(self, unused_signum, frame):
+    self._samples += 1
+    seen = set()
+    innermost = True
+    while frame is not None:
+      code = frame.f_code
+      location = '%s:%d(%s)' % (code.co_filename, code.co_firstlineno,
+                                code.co_name)
+      if innermost:
+        self._self_counts[location] = self._self_counts.get(location, 0) + 1
+        innermost = False
+      if location not in seen:  # count recursive functions once per sample
+        seen.add(location)
+        self._total_counts[location] = self._total_counts.get(location, 0) + 1
+      frame = frame.f_back
+
+  def RunCall(self, func, *args):
+    """Calls func(*args) while sampling and returns its result."""
+    previous_handler = signal.signal(signal.SIGPROF, self._Sample)
+    signal.setitimer(signal.ITIMER_PROF, self._interval, self._interval)
+    try:
+      return func(*args)
+    finally:
+      signal.setitimer(signal.ITIMER_PROF, 0)
+      signal.signal(signal.SIGPROF, previous_handler)
+
+  def Report(self, limit=30):
+    """Returns the functions seen most often on the stack as a string."""
+    lines = ['%d samples taken every %gs of CPU time' % (self._samples,
+                                                        self._interval),
+             '%8s %8s  %s' % ('self', 'total', 'function')]
+    locations = sorted(self._total_counts, key=self._total_counts.get,
+                       reverse=True)
+    for location in locations[:limit]:
+      lines.append('%8d %8d  %s' % (self._self_counts.get(location, 0),
+                                     self._total_counts[location], location))
+    return '\n'.join(lines) + '\n'
+
+
+def _RunProfiled(run, argv):
+  """Calls run(argv) under the profiler selected by --profile_command.
+
+  Args:
+    run: The Run method of the command.
+    argv: Arguments to pass to run.
+
+  Returns:
+    Whatever run returned.
+  """
+  if FLAGS.profile_command == 'cprofile':
+    import cProfile  # pylint: disable=g-import-not-at-top
+    import pstats  # pylint: disable=g-import-not-at-top
+    profiler = cProfile.Profile()
+    try:
+      return profiler.runcall(run, argv)
+    finally:
+      if FLAGS.profile_command_file:
+        profiler.dump_stats(FLAGS.profile_command_file)
+      else:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(30)
+  profiler = _SamplingProfiler(FLAGS.profile_command_interval)
+  try:
+    return profiler.RunCall(run, argv)
+  finally:
+    if FLAGS.profile_command_file:
+      with open(FLAGS.profile_command_file, 'w') as report_file:
+        report_file.write(profiler.Report())
+    else:
+      sys.stderr.write(profiler.Report())
+
+
+class _TeeWriter(object):
+  """File-like object writing to a stream and recording what was written."""
+
+  def __init__(self, stream):
+    self._stream = stream
+    self.recorded = StringIO.StringIO()
+
+  def write(self, data):  # pylint: disable=invalid-name
+    self._stream.write(data)
+    self.recorded.write(data)
+
+  def writelines(self, lines):  # pylint: disable=invalid-name
+    for line in lines:
+      self.write(line)
+
+  def __getattr__(self, name):
+    return getattr(self._stream, name)
+
+
+def _CommandCacheDir():
+  """Returns the directory of the result cache."""
+  if FLAGS.command_cache_dir:
+    return FLAGS.command_cache_dir
+  cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cache_home, GetAppBasename(), 'command_results')
+
+
+def _HashFile(filename):
+  """Returns the SHA-1 hex digest of a file's contents."""
+  digest = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), ''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+# Global flags that do not change what a command outputs.
+_CACHE_NEUTRAL_FLAGS = frozenset(['use_command_cache', 'command_cache_dir',
+                                  'command_cache_size'])
+
+
+def _CommandCodeIdentity(cmd):
+  """Returns what identifies the code of cmd, for the result cache key.
+
+  That is the command's cache version and the path, size and modification
+  time of the files of the modules defining the command and its function,
+  and of the main module.
+  """
+  modules = [type(cmd).__module__, '__main__']
+  cmd_func = getattr(cmd, '_cmd_func', None)
+  if cmd_func is not None:
+    modules.append(getattr(cmd_func, '__module__', None))
+  files = []
+  for module_name in sorted(set(modules) - set([None])):
+    filename = getattr(sys.modules.get(module_name), '__file__', None)
+    if not filename:
+      continue
+    filename = os.path.realpath(filename)
+    if filename.endswith(('.pyc', '.pyo')) and os.path.exists(filename[:-1]):
+      filename = filename[:-1]
+    try:
+      file_stat = os.stat(filename)
+    except OSError:
+      continue
+    files.append((filename, file_stat.st_size, file_stat.st_mtime))
+  return repr(cmd.GetCacheVersion()), files
+
+
+def _CommandCacheKey(cmd, argv):
+  """Returns the result cache key of running cmd with argv.
+
+  Args:
+    cmd:  Cmd instance, with its flags parsed.
+    argv: Remaining command line arguments after parsing command and flags.
+
+  Raises:
+    IOError: if one of the command's input files cannot be read.
+  """
+  flag_dict = cmd._command_flags.FlagDict()  # pylint: disable=protected-access
+  flag_values = [(name, repr(flag.value))
+                 for name, flag in sorted(flag_dict.iteritems())
+                 if name == flag.name]  # skip short names
+  global_flag_values = [
+      (name, repr(flag.value))
+      for name, flag in sorted(FLAGS.FlagDict().iteritems())
+      if name == flag.name and name not in flag_dict
+      and name not in _CACHE_NEUTRAL_FLAGS and flag.value != flag.default]
+  inputs = [(filename, _HashFile(filename))
+            for filename in cmd.GetCacheInputs(argv)]
+  key = repr((2, GetAppBasename(), _CommandCodeIdentity(cmd),
+              cmd._command_name, argv[1:], flag_values,  # pylint: disable=protected-access
+              global_flag_values, inputs))
+  return hashlib.sha1(key).hexdigest()
+
+
+def _StoreCachedResult(cache_dir, key, status, output):
+  """Adds a result to the result cache and trims it to its size budget."""
+  # Avoid import overhead for commands that are not cacheable.
+  from google.apputils import file_util  # pylint: disable=g-import-not-at-top
+  entry = marshal.dumps((status, output))
+  if len(entry) > FLAGS.command_cache_size:
+    return
+  try:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir, 0700)
+    file_util.AtomicWrite(os.path.join(cache_dir, key), entry, mode=0600)
+    entries = []
+    total_size = 0
+    for name in os.listdir(cache_dir):
+      try:
+        entry_stat = os.stat(os.path.join(cache_dir, name))
+      except OSError:
+        continue  # Evicted concurrently.
+      entries.append((entry_stat.st_mtime, entry_stat.st_size, name))
+      total_size += entry_stat.st_size
+    entries.sort()
+    while total_size > FLAGS.command_cache_size and entries:
+      _, size, name = entries.pop(0)
+      try:
+        os.remove(os.path.join(cache_dir, name))
+      except OSError:
+        pass
+      total_size -= size
+  except (IOError, OSError):
+    # An unusable cache only costs speed.
+    pass
+
+
+def _RunCached(cmd, run, argv):
+  """Replays the result of cmd from the result cache, or runs and records it.
+
+  Only what the command writes to sys.stdout and its exit status are
+  recorded, and only if run returns normally.
+
+  Args:
+    cmd:  Cmd instance, with its flags parsed.
+    run:  Callable running the command with argv.
+    argv: Remaining command line arguments after parsing command and flags.
+
+  Returns:
+    The exit status of the command.
+  """
+  cache_dir = _CommandCacheDir()
+  try:
+    key = _CommandCacheKey(cmd, argv)
+  except IOError:
+    return run(argv)  # Let the command report its unreadable input.
+  entry_path = os.path.join(cache_dir, key)
+  try:
+    with open(entry_path, 'rb') as entry_file:
+      status, output = marshal.load(entry_file)
+    os.utime(entry_path, None)  # Mark as recently used.
+  except (IOError, OSError, EOFError, ValueError, TypeError):
+    pass
+  else:
+    sys.stdout.write(output)
+    return status
+  stdout = sys.stdout
+  sys.stdout = _TeeWriter(stdout)
+  try:
+    ret = run(argv)
+  finally:
+    tee, sys.stdout = sys.stdout, stdout
+  if ret is None or isinstance(ret, int):
+    _StoreCachedResult(cache_dir, key, ret or 0, tee.recorded.getvalue())
+  return ret
+
+
+_event_loop = None  # event loop shared by the coroutine commands
+_event_loop_pid = None  # process _event_loop was created in
+_event_loop_atexit_registered = False
+
+
+def _ImportAsyncio():
+  """Returns the asyncio module, or its Python 2 backport trollius.
+
+  Raises:
+    AppCommandsError: if neither is available.
+  """
+  try:
+    import asyncio  # pylint: disable=g-import-not-at-top
+  except ImportError:
+    try:
+      import trollius as asyncio  # pylint: disable=g-import-not-at-top
+    except ImportError:
+      raise AppCommandsError('Running coroutine commands requires the '
+                             'asyncio module or its backport trollius')
+  return asyncio
+
+
+def _IsCoroutine(obj):
+  """Returns whether obj, as returned by a Run() method, is a coroutine."""
+  # Cheap duck typing first, to only import asyncio for coroutine commands.
+  if not (hasattr(obj, 'send') and hasattr(obj, 'throw')):
+    return False
+  return _ImportAsyncio().iscoroutine(obj)
+
+
+def _ShutDownEventLoop(loop):
+  """Cancels the tasks still pending on loop, waits for them and closes it."""
+  asyncio = _ImportAsyncio()
+  all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+  try:
+    pending = [task for task in all_tasks(loop) if not task.done()]
+    for task in pending:
+      task.cancel()
+    if pending:
+      loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    if hasattr(loop, 'shutdown_asyncgens'):
+      loop.run_until_complete(loop.shutdown_asyncgens())
+  finally:
+    loop.close()
+
+
+def _CloseSharedEventLoop():
+  """Closes the event loop shared by coroutine commands, at exit."""
+  global _event_loop
+  loop, _event_loop = _event_loop, None
+  if loop is not None and _event_loop_pid == os.getpid():
+    _ShutDownEventLoop(loop)
+
+
+def _RunCoroutine(coroutine):
+  """Runs the coroutine returned by a command to completion.
+
+  In the main thread all coroutine commands, e.g. all command lines of
+  'shell' or 'batch', share one event loop that is closed at exit, so
+  that they can also share the connections and other state bound to it. In
+  other threads each coroutine gets a loop of its own.
+
+  Args:
+    coroutine: The coroutine returned by the command's Run().
+
+  Returns:
+    The result of the coroutine.
+  """
+  global _event_loop, _event_loop_pid, _event_loop_atexit_registered
+  asyncio = _ImportAsyncio()
+  if not isinstance(threading.current_thread(), threading._MainThread):  # pylint: disable=protected-access
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+      return loop.run_until_complete(coroutine)
+    finally:
+      _ShutDownEventLoop(loop)
+      asyncio.set_event_loop(None)
+  if (_event_loop is None or _event_loop.is_closed() or
+      _event_loop_pid != os.getpid()):
+    # A loop inherited through fork() shares its selector with the parent.
+    _event_loop = asyncio.new_event_loop()
+    _event_loop_pid = os.getpid()
+    asyncio.set_event_loop(_event_loop)
+    if not _event_loop_atexit_registered:
+      # Not a shutdown hook: those run in a thread of their own and install
+      # a SIGTERM handler, and the loop belongs to the main thread.
+      atexit.register(_CloseSharedEventLoop)
+      _event_loop_atexit_registered = True
+  return _event_loop.run_until_complete(coroutine)
+
+
+def _CallRun(run, argv):
+  """Calls run(argv), running the coroutine it returns if it is one."""
+  ret = run(argv)
+  if _IsCoroutine(ret):
+    ret = _RunCoroutine(ret)
+  return ret
 
 
 class Cmd(object):
@@ -213,7 +815,7 @@ class Cmd(object):
   """
 
   def __init__(self, name, flag_values, command_aliases=None,
-               all_commands_help=None, help_full=None):
+               all_commands_help=None, help_full=None, cacheable=False):
     """Initialize and check whether self is actually a Cmd instance.
 
     This can be used to register command specific flags. If you do so
@@ -231,6 +833,10 @@ class Cmd(object):
                          shown when the user requests help for just this
                          command. If unspecified, the command's docstring is
                          used instead.
+      cacheable:         Whether the command's output and exit status depend
+                         only on its arguments, flags and input files (see
+                         GetCacheInputs), so that they may be replayed from
+                         the result cache instead of running the command.
 
     Raises:
       AppCommandsError: if self is Cmd (Cmd is abstract)
@@ -240,6 +846,7 @@ class Cmd(object):
     self._command_flags = flag_values
     self._all_commands_help = all_commands_help
     self._help_full = help_full
+    self._cacheable = cacheable
     if type(self) is Cmd:
       raise AppCommandsError('Cmd is abstract and cannot be instantiated')
 
@@ -254,6 +861,9 @@ class Cmd(object):
     Returns:
       0 for success, anything else for failure (must return with integer).
       Alternatively you may return None (or not use a return statement at all).
+      Run() may also be a coroutine of asyncio or trollius, it is then run to
+      completion on an event loop shared by all commands, whose result is the
+      return value.
 
     Raises:
       AppCommandsError: Always, as in must be overwritten
@@ -261,6 +871,35 @@ class Cmd(object):
     raise AppCommandsError('%s.%s.Run() is not implemented' % (
         type(self).__module__, type(self).__name__))
 
+  def GetCacheInputs(self, argv):
+    """Return the files whose contents a cacheable command's result depends on.
+
+    Results in the result cache are only replayed while these files keep the
+    contents they had when the result was recorded. Override this if the
+    command reads files not named by its arguments.
+
+    Args:
+      argv: Remaining command line arguments after parsing command and flags.
+
+    Returns:
+      List of file names, by default the arguments naming regular files.
+    """
+    return [arg for arg in argv[1:] if os.path.isfile(arg)]
+
+  def GetCacheVersion(self):
+    """Return the version of a cacheable command's results.
+
+    Results in the result cache are only replayed by the same version of the
+    command. Changes to the files of the command's module and of the main
+    module are detected by themselves; return a new version for other code
+    changes, e.g. in other modules the command uses or in a program run with
+    'python -c'.
+
+    Returns:
+      Any value with a stable repr(), by default None.
+    """
+    return None
+
   def CommandRun(self, argv):
     """Execute the command with given arguments.
 
@@ -274,6 +913,7 @@ class Cmd(object):
             (that is a copy of sys.argv at the time of the function call with
             all parsed flags removed).
     """
+    global _command_run_depth
     # Register flags global when run normally
     FLAGS.AppendFlagValues(self._command_flags)
     # Prepare flags parsing, to redirect help, to show help for command
@@ -288,9 +928,25 @@ class Cmd(object):
     # Parse flags and restore app.usage afterwards
     try:
       try:
+        # Only the outermost command is timed and profiled, not the command
+        # lines run by commands such as 'shell' or 'batch'.
+        outermost = _command_run_depth == 0
+        _command_run_depth += 1
+        if outermost:
+          _StartPhase('command flags')
         argv = ParseFlagsWithUsage(argv)
         # Run command
-        ret = self.Run(argv)
+        if outermost:
+          _StartPhase('command')
+        run = functools.partial(_CallRun, self.Run)
+        if outermost and FLAGS.profile_command:
+          run = functools.partial(_RunProfiled, run)
+        if self._cacheable and FLAGS.use_command_cache:
+          ret = _RunCached(self, run, argv)
+        else:
+          ret = run(argv)
+        if outermost:
+          _StartPhase()
         if ret is None:
           ret = 0
         else:
@@ -304,6 +960,7 @@ class Cmd(object):
           pdb.post_mortem()
         raise
     finally:
+      _command_run_depth = max(0, _command_run_depth - 1)
       # Restore app.usage and remove this command's flags from the global flags.
       app.usage = orig_app_usage
       for flag_name in self._command_flags.FlagDict():
@@ -410,17 +1067,21 @@ def _AddCmdInstance(command_name, cmd, command_aliases=None, **_):
                       '_'.
   """
   # Update global command list.
-  # pylint: disable=global-variable-not-assigned
+  # pylint: disable=global-variable-not-assigned,global-statement
   global _cmd_list
   global _cmd_alias_list
+  global _cmd_max_length
   if not issubclass(cmd.__class__, Cmd):
     raise AppCommandsError('Command must be an instance of commands.Cmd')
 
   for name in [command_name] + (command_aliases or []):
     _CheckCmdName(name)
     _cmd_alias_list[name] = command_name
+    _cmd_index.Add(name, command_name)
 
   _cmd_list[command_name] = cmd
+  _cmd_max_length = None
+  _cmd_help_cache.clear()
 
 
 def _CheckCmdName(name_or_alias):
@@ -444,7 +1105,7 @@ def _CheckCmdName(name_or_alias):
   if not name_or_alias[0].isalpha():
     raise AppCommandsError("Command '%s' does not start with a letter"
                            % name_or_alias)
-  if [c for c in name_or_alias if not (c.isalnum() or c == '_')]:
+  if not _CMD_NAME_CHARS_RE.match(name_or_alias):
     raise AppCommandsError("Command '%s' contains non alphanumeric characters"
                            % name_or_alias)
 
@@ -473,7 +1134,7 @@ def AddCmd(command_name, cmd_factory, **kwargs):
 
 
 def AddCmdFunc(command_name, cmd_func, command_aliases=None,
-               all_commands_help=None):
+               all_commands_help=None, cacheable=False):
   """Add a new command to the list of registered commands.
 
   Args:
@@ -486,11 +1147,113 @@ def AddCmdFunc(command_name, cmd_func, command_aliases=None,
     command_aliases:   A list of command aliases that the command can be run as.
     all_commands_help: Help message to be displayed in place of func.__doc__
                        when all commands are displayed.
+    cacheable:         Whether the results of cmd_func may be replayed from
+                       the result cache, see Cmd.__init__.
   """
   _AddCmdInstance(command_name,
                   _FunctionalCmd(command_name, flags.FlagValues(), cmd_func,
                                  command_aliases=command_aliases,
-                                 all_commands_help=all_commands_help),
+                                 all_commands_help=all_commands_help,
+                                 cacheable=cacheable),
+                  command_aliases=command_aliases)
+
+
+class _LazyCmd(Cmd):
+  """Placeholder for a command that is imported only when needed.
+
+  Name, aliases and the short help are known upfront, so listing all commands
+  does not import anything. Running the command or showing its full help loads
+  the real command and delegates to it.
+  """
+
+  def __init__(self, name, import_path, all_commands_help,
+               command_aliases=None):
+    """Create a lazily loaded command.
+
+    Args:
+      name:              Name of the command
+      import_path:       Dotted path of the Cmd subclass or command function,
+                         e.g. 'mytool.commands.version.CmdVersion'.
+      all_commands_help: A short description of the command that is shown when
+                         the user requests help for all commands at once.
+      command_aliases:   A list of aliases that the command can be run as.
+    """
+    super(_LazyCmd, self).__init__(name, None, command_aliases=command_aliases,
+                                   all_commands_help=all_commands_help)
+    self._import_path = import_path
+    self._cmd = None
+
+  def _LoadCmd(self):
+    """Import and instantiate the real command, once.
+
+    Returns:
+      The Cmd instance this placeholder stands for.
+
+    Raises:
+      AppCommandsError: if the command cannot be imported or is neither a Cmd
+                        subclass nor a function.
+    """
+    if self._cmd is None:
+      module_name, _, attr_name = self._import_path.rpartition('.')
+      try:
+        __import__(module_name)
+        target = getattr(sys.modules[module_name], attr_name)
+      except (ImportError, AttributeError, ValueError), error:
+        raise AppCommandsError("Cannot load command '%s' from '%s': %s"
+                               % (self._command_name, self._import_path, error))
+      kwargs = {'command_aliases': self._command_aliases,
+                'all_commands_help': self._all_commands_help}
+      if isinstance(target, type) and issubclass(target, Cmd):
+        self._cmd = target(self._command_name, flags.FlagValues(), **kwargs)
+      elif callable(target):
+        self._cmd = _FunctionalCmd(self._command_name, flags.FlagValues(),
+                                   target, **kwargs)
+      else:
+        raise AppCommandsError("'%s' is neither a Cmd subclass nor a function"
+                               % self._import_path)
+    return self._cmd
+
+  @property
+  def _command_flags(self):
+    return self._LoadCmd()._command_flags  # pylint: disable=protected-access
+
+  @_command_flags.setter
+  def _command_flags(self, unused_flag_values):
+    # Set by Cmd.__init__; the flags are only known once the command is loaded.
+    pass
+
+  def Run(self, argv):
+    return self._LoadCmd().Run(argv)
+
+  def CommandRun(self, argv):
+    return self._LoadCmd().CommandRun(argv)
+
+  def CommandGetHelp(self, unused_argv, cmd_names=None):
+    """Get help string for command, importing it only for its full help."""
+    if type(cmd_names) is list and len(cmd_names) > 1:
+      return flags.DocToHelp(self._all_commands_help)
+    return self._LoadCmd().CommandGetHelp(unused_argv, cmd_names=cmd_names)
+
+
+def AddLazyCmd(command_name, import_path, all_commands_help,
+               command_aliases=None):
+  """Add a command that is imported only when run or when its help is shown.
+
+  This keeps tools with many commands from importing every command module
+  just to register them.
+
+  Args:
+    command_name:      name of the command which will be used in argument
+                       parsing
+    import_path:       dotted path of a Cmd subclass (instantiated like with
+                       AddCmd) or of a command function (wrapped like with
+                       AddCmdFunc), e.g. 'mytool.commands.version.CmdVersion'.
+    all_commands_help: one line help shown when all commands are listed.
+    command_aliases:   A list of command aliases that the command can be run as.
+  """
+  _AddCmdInstance(command_name,
+                  _LazyCmd(command_name, import_path, all_commands_help,
+                           command_aliases=command_aliases),
                   command_aliases=command_aliases)
 
 
@@ -537,14 +1300,1194 @@ class _CmdHelp(Cmd):
     Returns:
       1 for failure
     """
-    if len(argv) > 1 and argv[1] in GetFullCommandList():
-      show_cmd = argv[1]
-    else:
-      show_cmd = None
+    show_cmd = None
+    if len(argv) > 1:
+      if argv[1] in GetCommandAliasList():
+        show_cmd = argv[1]
+      elif GetCommandByName(argv[1]) is not None:
+        show_cmd = GetCommandByName(argv[1]).CommandGetName()
     AppcommandsUsage(shorthelp=0, writeto_stdout=1, detailed_error=None,
                      exitcode=1, show_cmd=show_cmd, show_global_flags=False)
 
 
+def _SaveFlagValues(flag_values):
+  """Snapshot the state of all flags in flag_values.
+
+  Args:
+    flag_values: FlagValues instance.
+
+  Returns:
+    Opaque state to pass to _RestoreFlagValues.
+  """
+  return [(flag, copy.copy(flag.value), flag.present, flag.using_default_value)
+          for flag in set(flag_values.FlagDict().itervalues())]
+
+
+def _RestoreFlagValues(saved):
+  """Restore the flag state returned by _SaveFlagValues."""
+  for flag, value, present, using_default_value in saved:
+    flag.value = value
+    flag.present = present
+    flag.using_default_value = using_default_value
+
+
+@contextlib.contextmanager
+def _CommandFlagsHidden(command):
+  """A context manager removing a command's flags from FLAGS meanwhile.
+
+  Commands running other commands use it, so that those may define flags
+  with the same names as their own, e.g. --jobs.
+
+  Args:
+    command: Cmd instance whose flags to remove.
+  """
+  for flag_name in command._command_flags.FlagDict():  # pylint: disable=protected-access
+    delattr(FLAGS, flag_name)
+  try:
+    yield
+  finally:
+    FLAGS.AppendFlagValues(command._command_flags)  # pylint: disable=protected-access
+
+
+def _ExitStatus(exit_exception):
+  """Returns the exit status the interpreter would use for a SystemExit."""
+  code = exit_exception.code
+  if code is None or isinstance(code, int):
+    return code or 0
+  sys.stderr.write('%s\n' % code)
+  return 1
+
+
+def _RunCommandLine(cmd_args):
+  """Run one command line in this process, isolating its flag changes.
+
+  Global flags and the command's flags are restored afterwards, so each
+  command line sees the state the program had before any of them ran.
+
+  Args:
+    cmd_args: list of str, the command name or alias followed by its flags
+              and arguments.
+
+  Returns:
+    The command's exit status.
+  """
+  command = GetCommandByName(cmd_args[0])
+  if command is None:
+    sys.stderr.write('%s\n' % _UnknownCommandMessage(cmd_args[0]))
+    return 1
+  saved_flags = (_SaveFlagValues(FLAGS) +
+                 _SaveFlagValues(command._command_flags))  # pylint: disable=protected-access
+  try:
+    return command.CommandRun([sys.argv[0]] + cmd_args[1:]) or 0
+  except SystemExit, e:
+    return _ExitStatus(e)
+  except Exception:  # pylint: disable=broad-except
+    traceback.print_exc()
+    return 1
+  finally:
+    sys.stdout.flush()
+    _RestoreFlagValues(saved_flags)
+
+
+class _CmdShell(Cmd):
+  """Run commands interactively, one command line per input line.
+
+  The program and its commands are initialized only once, so each command
+  starts right away. Flags given on one line do not carry over to the next.
+  Use 'exit', 'quit' or end of input to leave the shell; Ctrl-C only drops
+  the line being typed or stops the command running.
+  """
+
+  def Run(self, unused_argv):
+    """Read and run command lines from stdin until end of input.
+
+    Args:
+      unused_argv: Remaining command line flags and arguments after parsing
+                   command; unused.
+
+    Returns:
+      0
+    """
+    interactive = sys.stdin.isatty()
+    prompt = interactive and '%s> ' % GetAppBasename() or ''
+    history_file = None
+    try:
+      import readline  # pylint: disable=g-import-not-at-top
+    except ImportError:
+      readline = None
+    if readline is not None and interactive:
+      history_file = os.path.expanduser('~/.%s_history' % GetAppBasename())
+      try:
+        readline.read_history_file(history_file)
+      except IOError:
+        pass
+    try:
+      while True:
+        try:
+          if not self._RunLine(prompt):
+            break
+        except KeyboardInterrupt:
+          # Ctrl-C drops the line being typed or stops the running command.
+          sys.stdout.write('\n')
+          sys.stdout.flush()
+    finally:
+      if history_file is not None:
+        try:
+          readline.write_history_file(history_file)
+        except IOError:
+          pass
+    return 0
+
+  def _RunLine(self, prompt):
+    """Read one command line and run it.
+
+    Args:
+      prompt: str, the prompt to show.
+
+    Returns:
+      False if the shell should exit, True otherwise.
+    """
+    try:
+      line = raw_input(prompt)
+    except EOFError:
+      return False
+    try:
+      cmd_args = shlex.split(line, comments=True)
+    except ValueError, error:
+      sys.stderr.write('%s\n' % error)
+      return True
+    if not cmd_args:
+      return True
+    if cmd_args[0] in ('exit', 'quit'):
+      return False
+    if GetCommandByName(cmd_args[0]) is self:
+      sys.stderr.write('Already running %s\n' % self._command_name)
+      return True
+    status = _RunCommandLine(cmd_args)
+    if status:
+      sys.stderr.write("Command '%s' exited with status %s\n"
+                       % (cmd_args[0], status))
+    return True
+
+
+def AddShellCmd(command_name='shell', command_aliases=None):
+  """Register a command that reads and runs command lines interactively.
+
+  Args:
+    command_name:    name of the shell command.
+    command_aliases: A list of command aliases that the command can be run as.
+  """
+  AddCmd(command_name, _CmdShell, command_aliases=command_aliases)
+
+
+class _CmdBatch(Cmd):
+  """Run the command lines read from a file, or stdin if none is given.
+
+  Usage: %(prog)s batch [--jobs=N] [--keep_going] [--report_status] [FILE]
+
+  Each line holds a command with its flags and arguments; empty lines and
+  '#' comments are skipped. The program is initialized only once, and flags
+  given on one line do not carry over to the next. By default the lines run
+  one after the other until the first one fails. With --jobs, up to that many
+  lines run at the same time in forked processes, and the output of each line
+  is written as a whole, in input order. Exits with status 1 if any line
+  failed.
+  """
+
+  def __init__(self, name, flag_values, **kargs):
+    if 'help_full' not in kargs:
+      kargs['help_full'] = self.__doc__ % {'prog': GetAppBasename()}
+    super(_CmdBatch, self).__init__(name, flag_values, **kargs)
+    flags.DEFINE_integer('jobs', 1, 'Number of command lines to run in '
+                         'parallel, each in a forked process.',
+                         flag_values=flag_values, lower_bound=1)
+    flags.DEFINE_boolean('keep_going', False, 'Continue with the remaining '
+                         'command lines after one failed.',
+                         flag_values=flag_values)
+    flags.DEFINE_boolean('report_status', False, 'Report the exit status of '
+                         'every command line, not just of the failed ones.',
+                         flag_values=flag_values)
+
+  def Run(self, argv):
+    """Run the command lines of the file named in argv[1], or of stdin.
+
+    Args:
+      argv: Remaining command line arguments after parsing command and flags.
+
+    Returns:
+      0 if all command lines succeeded, 1 otherwise.
+    """
+    if len(argv) > 2:
+      raise app.UsageError('At most one batch file expected')
+    if len(argv) == 2 and argv[1] != '-':
+      try:
+        batch_file = open(argv[1])
+      except IOError, error:
+        raise app.UsageError(str(error))
+    else:
+      batch_file = sys.stdin
+    jobs, keep_going, report_status = (FLAGS.jobs, FLAGS.keep_going,
+                                       FLAGS.report_status)
+    try:
+      command_lines = self._ReadCommandLines(batch_file)
+      failed = False
+      with _CommandFlagsHidden(self):
+        if jobs > 1:
+          results = _RunForkedCommandLines(command_lines, jobs, keep_going)
+        else:
+          results = self._RunInProcess(command_lines, keep_going)
+        for lineno, line, status in results:
+          failed = failed or bool(status)
+          if status or report_status:
+            sys.stdout.flush()
+            sys.stderr.write('Line %d exited with status %s: %s\n'
+                             % (lineno, status, line))
+    finally:
+      if batch_file is not sys.stdin:
+        batch_file.close()
+    return int(failed)
+
+  def _ReadCommandLines(self, batch_file):
+    """Yields (line number, line, command arguments) for each command line."""
+    for lineno, line in enumerate(iter(batch_file.readline, ''), 1):
+      line = line.strip()
+      try:
+        cmd_args = shlex.split(line, comments=True)
+      except ValueError, error:
+        sys.stderr.write('Line %d: %s\n' % (lineno, error))
+        cmd_args = ['']  # Reported as an unknown command.
+      if cmd_args:
+        if GetCommandByName(cmd_args[0]) is self:
+          sys.stderr.write('Line %d: nested %s is not supported\n'
+                           % (lineno, self._command_name))
+          cmd_args = ['']
+        yield lineno, line, cmd_args
+
+  def _RunInProcess(self, command_lines, keep_going):
+    """Yields (line number, line, exit status), running lines one by one.
+
+    Unless keep_going is set this stops after the first failed command line.
+    """
+    for lineno, line, cmd_args in command_lines:
+      status = _RunCommandLine(cmd_args)
+      yield lineno, line, status
+      if status and not keep_going:
+        return
+
+
+def _RunForkedCommandLines(command_lines, jobs, keep_going,
+                           prefix_output=False):
+  """Yields (key, label, exit status) for each command line, in input order.
+
+  Up to jobs command lines run at the same time, each in a forked process
+  whose output is buffered and copied to ours once it finishes. Unless
+  keep_going is set no further lines are started after a failure.
+
+  Args:
+    command_lines: iterable of (key, label, command arguments) tuples.
+    jobs:          maximum number of processes running at the same time.
+    keep_going:    whether to start further command lines after a failure.
+    prefix_output: if True, the processes write their output right away,
+                   each line prefixed with the command line's label.
+  """
+  running = {}  # pid -> index of the command line
+  done = {}  # index of the command line -> exit status
+  started = []  # (key, label, stdout, stderr) by index
+  next_result = 0
+  command_lines = iter(command_lines)
+  failed = False
+  while True:
+    while len(running) < jobs and (keep_going or not failed):
+      try:
+        key, label, cmd_args = next(command_lines)
+      except StopIteration:
+        break
+      if prefix_output:
+        stdout = stderr = None
+        pid = _ForkCommandLine(cmd_args, output_prefix='%s: ' % label)
+      else:
+        stdout, stderr = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        pid = _ForkCommandLine(cmd_args, stdout, stderr)
+      running[pid] = len(started)
+      started.append((key, label, stdout, stderr))
+    if not running:
+      break
+    pid, wait_status = _WaitForAnyChild(running)
+    if os.WIFEXITED(wait_status):
+      status = os.WEXITSTATUS(wait_status)
+    else:
+      status = 128 + os.WTERMSIG(wait_status)
+    failed = failed or bool(status)
+    done[running.pop(pid)] = status
+    while next_result in done:
+      key, label, stdout, stderr = started[next_result]
+      for output, stream in ((stdout, sys.stdout), (stderr, sys.stderr)):
+        if output is not None:
+          output.seek(0)
+          stream.write(output.read())
+          output.close()
+      started[next_result] = None
+      yield key, label, done.pop(next_result)
+      next_result += 1
+
+
+def _WaitForAnyChild(pids):
+  """Wait until one of the child processes pids exits.
+
+  Unlike os.wait(), this does not reap other children of the process, whose
+  exit status their own code may still wait for. In the main thread it
+  sleeps until a SIGCHLD arrives through a self-pipe; other threads cannot
+  set signal handlers and wait for one of pids in particular instead.
+
+  Args:
+    pids: collection of pids of child processes.
+
+  Returns:
+    (pid, wait status) of the child that exited.
+  """
+  if not isinstance(threading.current_thread(), threading._MainThread):  # pylint: disable=protected-access
+    return _WaitPid(next(iter(pids)), 0)
+  read_fd, write_fd = os.pipe()
+  for fd in (read_fd, write_fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+  old_handler = signal.getsignal(signal.SIGCHLD)
+
+  def OnChildExit(signum, frame):
+    # Only there for the interpreter to write to the wakeup fd.
+    if callable(old_handler):
+      old_handler(signum, frame)
+
+  old_wakeup_fd = signal.set_wakeup_fd(write_fd)
+  signal.signal(signal.SIGCHLD, OnChildExit)
+  try:
+    while True:
+      for pid in pids:
+        exited, wait_status = _WaitPid(pid, os.WNOHANG)
+        if exited:
+          return exited, wait_status
+      try:
+        select.select([read_fd], [], [])
+        os.read(read_fd, 4096)
+      except (OSError, select.error), e:
+        if e.args[0] not in (errno.EINTR, errno.EAGAIN):
+          raise
+  finally:
+    if old_handler is not None:
+      signal.signal(signal.SIGCHLD, old_handler)
+    signal.set_wakeup_fd(old_wakeup_fd)
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def _WaitPid(pid, options):
+  """os.waitpid(pid, options), retried when interrupted by a signal."""
+  while True:
+    try:
+      return os.waitpid(pid, options)
+    except OSError, e:
+      if e.errno != errno.EINTR:
+        raise
+
+
+def _ForkCommandLine(cmd_args, stdout=None, stderr=None, output_prefix=None):
+  """Run a command line in a forked process, see _RunCommandLine.
+
+  Args:
+    cmd_args:      list of str, the command name or alias followed by its
+                   flags and arguments.
+    stdout:        file receiving the process's standard output, by default
+                   it shares ours.
+    stderr:        file receiving the process's standard error, by default
+                   it shares ours.
+    output_prefix: if given, each line the command writes to sys.stdout or
+                   sys.stderr is prefixed with this string.
+
+  Returns:
+    The pid of the forked process, whose exit status is the command's.
+  """
+  sys.stdout.flush()
+  sys.stderr.flush()
+  pid = os.fork()
+  if pid:
+    return pid
+  status = 1
+  try:
+    if stdout is not None:
+      os.dup2(stdout.fileno(), 1)
+    if stderr is not None:
+      os.dup2(stderr.fileno(), 2)
+    if output_prefix is not None:
+      sys.stdout = _LinePrefixer(sys.stdout, output_prefix)
+      sys.stderr = _LinePrefixer(sys.stderr, output_prefix)
+    status = _RunCommandLine(cmd_args)
+  finally:
+    if output_prefix is not None:
+      sys.stdout.Close()
+      sys.stderr.Close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status if 0 <= status < 256 else 1)  # pylint: disable=protected-access
+
+
+def AddBatchCmd(command_name='batch', command_aliases=None):
+  """Register a command running the command lines read from a file or stdin.
+
+  Args:
+    command_name:    name of the batch command.
+    command_aliases: A list of command aliases that the command can be run as.
+  """
+  AddCmd(command_name, _CmdBatch, command_aliases=command_aliases)
+
+
+class _LinePrefixer(object):
+  """File-like object writing each line to a stream with a prefix.
+
+  Complete lines are written and flushed at once, under a lock shared by all
+  writers of the stream, so lines of concurrent writers do not interleave.
+  """
+
+  def __init__(self, stream, prefix, lock=None):
+    self._stream = stream
+    self._prefix = prefix
+    self._lock = lock or threading.Lock()
+    self._pending = ''
+
+  def write(self, data):  # pylint: disable=invalid-name
+    lines = (self._pending + data).split('\n')
+    self._pending = lines.pop()
+    if lines:
+      self._Emit(''.join('%s%s\n' % (self._prefix, line) for line in lines))
+
+  def writelines(self, lines):  # pylint: disable=invalid-name
+    for line in lines:
+      self.write(line)
+
+  def flush(self):  # pylint: disable=invalid-name
+    pass  # Partial lines are only written by Close().
+
+  def Close(self):
+    """Writes the last line even if it is incomplete."""
+    if self._pending:
+      self._Emit('%s%s\n' % (self._prefix, self._pending))
+      self._pending = ''
+
+  def _Emit(self, text):
+    with self._lock:
+      self._stream.write(text)
+      self._stream.flush()
+
+  def __getattr__(self, name):
+    return getattr(self._stream, name)
+
+
+class _ThreadLocalStream(object):
+  """Stand-in for sys.stdout or sys.stderr redirectable per thread."""
+
+  def __init__(self, default):
+    self._default = default
+    self._local = threading.local()
+
+  def SetTarget(self, target):
+    """Redirects the current thread's writes to target, or back if None."""
+    self._local.target = target
+
+  def _Target(self):
+    return getattr(self._local, 'target', None) or self._default
+
+  def write(self, data):  # pylint: disable=invalid-name
+    self._Target().write(data)
+
+  def writelines(self, lines):  # pylint: disable=invalid-name
+    self._Target().writelines(lines)
+
+  def flush(self):  # pylint: disable=invalid-name
+    self._Target().flush()
+
+  def __getattr__(self, name):
+    return getattr(self._Target(), name)
+
+
+class _CmdFanOut(Cmd):
+  """Run a command once for each input line, several at the same time.
+
+  Usage: %(prog)s fanout [--jobs=N] [--pool=process|thread] [--stream]
+         [--inputs=FILE] COMMAND [ARGS...]
+
+  Each non-empty line of --inputs, or of stdin, is split like a shell would
+  and appended to COMMAND and ARGS, so 'fanout --inputs=hosts check' runs
+  'check HOST' for every HOST listed in the file hosts. The program is
+  initialized only once and up to --jobs inputs run at the same time.
+
+  With --pool=process every input runs in a forked process. With
+  --pool=thread every input runs in a thread of this process, the command's
+  flags are parsed only once from ARGS, input lines may only add arguments,
+  and the command's Run() must be thread safe.
+
+  The output of each input is written as a whole once it finished, in input
+  order, or with --stream as it is produced, each line prefixed with the
+  input. The failed inputs are listed at the end, in which case the exit
+  status is 1.
+  """
+
+  def __init__(self, name, flag_values, **kargs):
+    if 'help_full' not in kargs:
+      kargs['help_full'] = self.__doc__ % {'prog': GetAppBasename()}
+    super(_CmdFanOut, self).__init__(name, flag_values, **kargs)
+    flags.DEFINE_integer('jobs', 8, 'Number of inputs to run in parallel.',
+                         flag_values=flag_values, lower_bound=1)
+    flags.DEFINE_enum('pool', 'process', ['process', 'thread'],
+                      'Run every input in a forked process or in a thread.',
+                      flag_values=flag_values)
+    flags.DEFINE_boolean('stream', False, 'Write the output as it is '
+                         'produced, each line prefixed with the input.',
+                         flag_values=flag_values)
+    flags.DEFINE_string('inputs', '-', 'File holding one input per line, '
+                        "'-' for stdin.", flag_values=flag_values)
+
+  def Run(self, argv):
+    """Run the command given in argv[1:] once for each input.
+
+    Args:
+      argv: Remaining command line arguments after parsing command and flags.
+
+    Returns:
+      0 if the command succeeded for all inputs, 1 otherwise.
+    """
+    if len(argv) < 2:
+      raise app.UsageError('Command to run expected')
+    command = GetCommandByName(argv[1])
+    if command is None:
+      raise app.UsageError(_UnknownCommandMessage(argv[1]))
+    if command is self:
+      raise app.UsageError('Nested %s is not supported' % self._command_name)
+    jobs, pool, stream = FLAGS.jobs, FLAGS.pool, FLAGS.stream
+    if FLAGS.inputs == '-':
+      inputs_file = sys.stdin
+    else:
+      try:
+        inputs_file = open(FLAGS.inputs)
+      except IOError, error:
+        raise app.UsageError(str(error))
+    try:
+      inputs = list(self._ReadInputs(inputs_file))
+    finally:
+      if inputs_file is not sys.stdin:
+        inputs_file.close()
+    with _CommandFlagsHidden(self):
+      if pool == 'thread':
+        results = self._RunThreaded(command, argv[2:], inputs, jobs, stream)
+      else:
+        command_lines = ((label, label, argv[1:] + args)
+                         for label, args in inputs)
+        results = _RunForkedCommandLines(command_lines, jobs, True,
+                                         prefix_output=stream)
+      failed = [(label, status) for _, label, status in results if status]
+    sys.stdout.flush()
+    if failed:
+      sys.stderr.write('%d of %d inputs failed:\n' % (len(failed),
+                                                      len(inputs)))
+      for label, status in failed:
+        sys.stderr.write('  exit status %s: %s\n' % (status, label))
+    return int(bool(failed))
+
+  def _ReadInputs(self, inputs_file):
+    """Yields (input line, arguments) for each input line."""
+    for lineno, line in enumerate(iter(inputs_file.readline, ''), 1):
+      line = line.strip()
+      try:
+        args = shlex.split(line, comments=True)
+      except ValueError, error:
+        raise app.UsageError('Input line %d: %s' % (lineno, error))
+      if args:
+        yield line, args
+
+  def _RunThreaded(self, command, args, inputs, jobs, stream):
+    """Yields (input line, input line, exit status), in input order.
+
+    The command's flags are parsed from args once, then its Run() is called
+    for all inputs on a pool of jobs threads, with sys.stdout and sys.stderr
+    redirected to a buffer or line prefixer per thread.
+    """
+    from multiprocessing import pool as multiprocessing_pool  # pylint: disable=g-import-not-at-top
+    saved_flags = _SaveFlagValues(FLAGS)
+    FLAGS.AppendFlagValues(command._command_flags)  # pylint: disable=protected-access
+    stdout, stderr = sys.stdout, sys.stderr
+    try:
+      argv = ParseFlagsWithUsage([sys.argv[0]] + args)
+      sys.stdout = _ThreadLocalStream(stdout)
+      sys.stderr = _ThreadLocalStream(stderr)
+      lock = threading.Lock()
+
+      def RunInput(item):
+        label, input_args = item
+        if stream:
+          outputs = (_LinePrefixer(stdout, '%s: ' % label, lock),
+                     _LinePrefixer(stderr, '%s: ' % label, lock))
+        else:
+          outputs = (StringIO.StringIO(), StringIO.StringIO())
+        sys.stdout.SetTarget(outputs[0])
+        sys.stderr.SetTarget(outputs[1])
+        try:
+          status = _CallRun(command.Run, argv + input_args) or 0
+        except SystemExit, e:
+          status = _ExitStatus(e)
+        except app.UsageError, error:
+          sys.stderr.write('%s\n' % error)
+          status = error.exitcode
+        except Exception:  # pylint: disable=broad-except
+          traceback.print_exc()
+          status = 1
+        finally:
+          sys.stdout.SetTarget(None)
+          sys.stderr.SetTarget(None)
+        if stream:
+          for output in outputs:
+            output.Close()
+          return label, status, '', ''
+        return label, status, outputs[0].getvalue(), outputs[1].getvalue()
+
+      thread_pool = multiprocessing_pool.ThreadPool(min(jobs, len(inputs)) or 1)
+      try:
+        for label, status, out, err in thread_pool.imap(RunInput, inputs):
+          stdout.write(out)
+          stdout.flush()
+          stderr.write(err)
+          yield label, label, status
+      finally:
+        thread_pool.terminate()
+    finally:
+      sys.stdout, sys.stderr = stdout, stderr
+      for flag_name in command._command_flags.FlagDict():  # pylint: disable=protected-access
+        delattr(FLAGS, flag_name)
+      _RestoreFlagValues(saved_flags)
+
+
+def AddFanOutCmd(command_name='fanout', command_aliases=None):
+  """Register a command running another command once per input, in parallel.
+
+  Args:
+    command_name:    name of the fan-out command.
+    command_aliases: A list of command aliases that the command can be run as.
+  """
+  AddCmd(command_name, _CmdFanOut, command_aliases=command_aliases)
+
+
+_FLAG_NAME_RE = re.compile(r'[\w.-]+\Z')  # flag names safe to put in scripts
+
+
+def _CompletionFlags(flag_values, exclude=()):
+  """Returns the sorted '--name' words completing the flags in flag_values."""
+  words = set()
+  for name, flag in flag_values.FlagDict().iteritems():
+    if name != flag.name or name in exclude or not _FLAG_NAME_RE.match(name):
+      continue  # Short names are the same flags.
+    words.add('--' + name)
+    if flag.boolean:
+      words.add('--no' + name)
+  return sorted(words)
+
+
+def _CompletionIndex(exclude_flags=()):
+  """Returns the static completion index of the registered commands.
+
+  Args:
+    exclude_flags: names of global flags to leave out.
+
+  Returns:
+    (global flag words, [(command names and aliases, flag words)]) tuple,
+    sorted by command name.
+  """
+  aliases = {}
+  for cmd_alias, cmd_name in GetCommandAliasList().iteritems():
+    aliases.setdefault(cmd_name, []).append(cmd_alias)
+  commands = []
+  for cmd_name, cmd in sorted(GetCommandList().iteritems()):
+    names = [cmd_name] + sorted(set(aliases.get(cmd_name, [])) - {cmd_name})
+    commands.append((names, _CompletionFlags(cmd._command_flags)))  # pylint: disable=protected-access
+  return _CompletionFlags(FLAGS, exclude_flags), commands
+
+
+_BASH_COMPLETION = """\
+# bash completion for %(prog)s, generated by '%(prog)s %(cmd)s'.
+_%(function)s_complete() {
+  local cur=${COMP_WORDS[COMP_CWORD]} command= i words
+  for ((i = 1; i < COMP_CWORD; i++)); do
+    case ${COMP_WORDS[i]} in
+      -*) ;;
+      *) command=${COMP_WORDS[i]}; break ;;
+    esac
+  done
+  case $command in
+%(cases)s
+  esac
+  COMPREPLY=($(compgen -W "$words" -- "$cur"))
+}
+complete -o default -F _%(function)s_complete %(prog)s
+"""
+
+_ZSH_COMPLETION = """\
+#compdef %(prog)s
+# zsh completion for %(prog)s, generated by '%(prog)s %(cmd)s'.
+_%(function)s_complete() {
+  local command= i
+  local -a words_
+  for ((i = 2; i < CURRENT; i++)); do
+    if [[ $words[i] != -* ]]; then
+      command=$words[i]
+      break
+    fi
+  done
+  case $command in
+%(cases)s
+  esac
+  compadd -a words_
+}
+compdef _%(function)s_complete %(prog)s
+"""
+
+
+def _CompletionScript(shell, prog, cmd_name, index):
+  """Renders the completion index as a bash or zsh completion script.
+
+  Args:
+    shell:    'bash' or 'zsh'.
+    prog:     name of the program to complete.
+    cmd_name: name of the command generating the script.
+    index:    completion index, see _CompletionIndex.
+
+  Returns:
+    The script as a str.
+  """
+  global_flags, commands = index
+  cases = [('""', [name for names, _ in commands for name in names] +
+            global_flags)]
+  for names, command_flags in commands:
+    cases.append(('|'.join(names), command_flags + global_flags))
+  cases.append(('*', []))
+  variable = shell == 'zsh' and 'words_=(%s)' or "words='%s'"
+  return (shell == 'zsh' and _ZSH_COMPLETION or _BASH_COMPLETION) % {
+      'prog': prog,
+      'cmd': cmd_name,
+      'function': re.sub(r'\W', '_', prog),
+      'cases': '\n'.join('    %s) %s ;;' % (pattern, variable % ' '.join(words))
+                         for pattern, words in cases),
+  }
+
+
+class _CmdCompletion(Cmd):
+  """Write a bash or zsh completion script for this program.
+
+  Usage: %(prog)s completion [--shell=bash|zsh] [--output=FILE]
+
+  The script holds all commands, their aliases and flags, so completing
+  does not need to run the program. Generate it when installing the program,
+  e.g. '%(prog)s completion --output=/etc/bash_completion.d/%(prog)s'. An
+  existing --output file is only rewritten when the commands or flags
+  changed.
+  """
+
+  def __init__(self, name, flag_values, **kargs):
+    if 'help_full' not in kargs:
+      kargs['help_full'] = self.__doc__ % {'prog': GetAppBasename()}
+    super(_CmdCompletion, self).__init__(name, flag_values, **kargs)
+    flags.DEFINE_enum('shell', 'bash', ['bash', 'zsh'],
+                      'Shell to write the completion script for.',
+                      flag_values=flag_values)
+    flags.DEFINE_string('output', None, 'File to write the completion script '
+                        'to, instead of stdout.', flag_values=flag_values)
+
+  def Run(self, argv):
+    """Write the completion script.
+
+    Args:
+      argv: Remaining command line arguments after parsing command and flags.
+
+    Returns:
+      0
+    """
+    if len(argv) > 1:
+      raise app.UsageError('No arguments expected')
+    index = _CompletionIndex(exclude_flags=self._command_flags.FlagDict())
+    script = _CompletionScript(FLAGS.shell, GetAppBasename(),
+                               self._command_name, index)
+    if not FLAGS.output:
+      sys.stdout.write(script)
+      return 0
+    try:
+      with open(FLAGS.output) as current_file:
+        current = current_file.read()
+    except IOError:
+      current = None
+    if current != script:
+      # Avoid import overhead for the common case of writing to stdout.
+      from google.apputils import file_util  # pylint: disable=g-import-not-at-top
+      file_util.AtomicWrite(FLAGS.output, script, mode=0644)
+    return 0
+
+
+def AddCompletionCmd(command_name='completion', command_aliases=None):
+  """Register a command writing a static shell completion script.
+
+  Args:
+    command_name:    name of the completion command.
+    command_aliases: A list of command aliases that the command can be run as.
+  """
+  AddCmd(command_name, _CmdCompletion, command_aliases=command_aliases)
+
+
+def _SendFrame(sock, kind, payload=''):
+  """Send a frame of the daemon protocol.
+
+  Args:
+    sock:    socket to send on.
+    kind:    one character frame type: 'R' request, '0' stdin data, '.' end of
+             stdin, '1' stdout data, '2' stderr data or 'X' exit status.
+    payload: str, frame data.
+  """
+  sock.sendall(struct.pack('!cI', kind, len(payload)) + payload)
+
+
+def _RecvFrame(sock):
+  """Receive a frame sent by _SendFrame.
+
+  Args:
+    sock: socket to receive from.
+
+  Returns:
+    (kind, payload) tuple, or (None, None) at end of stream.
+  """
+  # pylint: disable=protected-access
+  header = app._RecvExactly(sock, 5)
+  if len(header) < 5:
+    return None, None
+  kind, size = struct.unpack('!cI', header)
+  payload = app._RecvExactly(sock, size)
+  if len(payload) < size:
+    return None, None
+  return kind, payload
+
+
+class _FrameWriter(object):
+  """File-like object sending what is written as frames of one kind."""
+
+  softspace = 0
+
+  def __init__(self, sock, kind):
+    self._sock = sock
+    self._kind = kind
+
+  def write(self, data):
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    if data:
+      _SendFrame(self._sock, self._kind, data)
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    pass
+
+  def isatty(self):
+    return False
+
+
+class _FrameReader(object):
+  """File-like object reading the stdin frames sent by the daemon client."""
+
+  def __init__(self, sock):
+    self._sock = sock
+    self._buffer = ''
+    self._eof = False
+
+  def _Fill(self):
+    """Read the next stdin frame into the buffer; returns False at EOF."""
+    if not self._eof:
+      kind, payload = _RecvFrame(self._sock)
+      if kind == '0':
+        self._buffer += payload
+        return True
+      self._eof = True
+    return False
+
+  def read(self, size=-1):
+    while (size < 0 or len(self._buffer) < size) and self._Fill():
+      pass
+    if size < 0:
+      size = len(self._buffer)
+    data, self._buffer = self._buffer[:size], self._buffer[size:]
+    return data
+
+  def readline(self, size=-1):
+    while '\n' not in self._buffer and self._Fill():
+      pass
+    end = self._buffer.find('\n') + 1 or len(self._buffer)
+    if size >= 0:
+      end = min(end, size)
+    line, self._buffer = self._buffer[:end], self._buffer[end:]
+    return line
+
+  def readlines(self):
+    return list(self)
+
+  def __iter__(self):
+    return iter(self.readline, '')
+
+  def isatty(self):
+    return False
+
+
+def _RunInvocation(argv):
+  """Run a complete tool invocation in this process, isolating flag changes.
+
+  Args:
+    argv: list of str, like sys.argv: program, global flags, command, command
+          flags and arguments.
+
+  Returns:
+    The invocation's exit status.
+  """
+  saved_flags = _SaveFlagValues(FLAGS)
+  try:
+    cmd_args = FLAGS(argv)[1:] or [_cmd_default]
+  except flags.FlagsError, error:
+    sys.stderr.write('FATAL Flags parsing error: %s\n' % error)
+    _RestoreFlagValues(saved_flags)
+    return 1
+  except SystemExit, e:  # From the help flags.
+    _RestoreFlagValues(saved_flags)
+    return _ExitStatus(e)
+  try:
+    return _RunCommandLine(cmd_args)
+  finally:
+    _RestoreFlagValues(saved_flags)
+
+
+# SO_PEERCRED from <asm/socket.h>, which Python 2's socket module lacks.
+if hasattr(socket, 'SO_PEERCRED'):
+  _SO_PEERCRED = socket.SO_PEERCRED
+elif sys.platform.startswith('linux'):
+  _SO_PEERCRED = 21 if os.uname()[4].startswith('ppc') else 17
+else:
+  _SO_PEERCRED = None
+
+
+def _DaemonSocketPath(socket_name, create_directory):
+  """Returns the path of the daemon socket socket_name, or None if unsafe.
+
+  A plain name refers to a socket in a directory only accessible by the
+  current user, like the forkserver's. A path is used as is, provided that
+  its directory belongs to the current user and only they can write to it,
+  so that nobody else can plant or replace the socket.
+
+  Args:
+    socket_name:      str, the --serve_socket or ForwardToDaemon() argument.
+    create_directory: bool, whether to create the private directory.
+  """
+  if os.sep in socket_name:
+    socket_dir = os.path.dirname(os.path.abspath(socket_name))
+    socket_path = socket_name
+  else:
+    socket_dir = os.path.join(tempfile.gettempdir(),
+                              'apputils-daemon-%d' % os.getuid())
+    socket_path = os.path.join(socket_dir, socket_name)
+    if create_directory:
+      try:
+        os.mkdir(socket_dir, 0700)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          return None
+  try:
+    dir_stat = os.stat(socket_dir)
+  except OSError:
+    return None
+  if (not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid()
+      or stat.S_IMODE(dir_stat.st_mode) & 022):
+    return None
+  return socket_path
+
+
+def _PeerIsUs(conn):
+  """Returns whether the process at the other end of conn runs as our user."""
+  if _SO_PEERCRED is None:
+    return True  # Rely on the permissions of the socket and its directory.
+  creds = conn.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED,
+                          struct.calcsize('3i'))
+  _, uid, _ = struct.unpack('3i', creds)
+  return uid == os.getuid()
+
+
+def _ServeDaemon(socket_name):
+  """Serve the invocations forwarded by ForwardToDaemon, one at a time.
+
+  Invocations run in this process with stdin, stdout and stderr redirected to
+  the connection, and with their environment and working directory. They run
+  one after the other since commands share the global flags. Only connections
+  from processes of the same user are served.
+
+  Args:
+    socket_name: str, the Unix socket to listen on, see _DaemonSocketPath.
+
+  Raises:
+    AppCommandsError: if the socket's directory is not private to this user,
+                      something other than a socket is in the way, or a
+                      daemon already listens on the socket.
+  """
+  socket_path = _DaemonSocketPath(socket_name, create_directory=True)
+  if socket_path is None:
+    raise AppCommandsError('The directory of %s must belong to you and be '
+                           'writable only by you' % socket_name)
+  try:
+    socket_stat = os.lstat(socket_path)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+  else:
+    if not stat.S_ISSOCK(socket_stat.st_mode):
+      raise AppCommandsError('%s exists and is not a socket' % socket_path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(socket_path)
+    except socket.error:
+      os.unlink(socket_path)  # Left behind by a daemon that died.
+    else:
+      raise AppCommandsError('A daemon already listens on %s' % socket_path)
+    finally:
+      probe.close()
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # Nobody else may connect, not even before a chmod could be done.
+  old_umask = os.umask(077)
+  try:
+    listener.bind(socket_path)
+  finally:
+    os.umask(old_umask)
+  socket_inode = os.lstat(socket_path).st_ino
+  listener.listen(16)
+  try:
+    while True:
+      conn, _ = listener.accept()
+      try:
+        if not _PeerIsUs(conn):
+          continue
+        kind, request = _RecvFrame(conn)
+        if kind == 'R':
+          status = _ServeInvocation(conn, marshal.loads(request))
+          _SendFrame(conn, 'X', str(status))
+      except (socket.error, IOError, EOFError, ValueError):
+        pass  # The client went away.
+      finally:
+        conn.close()
+  finally:
+    listener.close()
+    try:
+      if os.lstat(socket_path).st_ino == socket_inode:
+        os.unlink(socket_path)
+    except OSError:
+      pass  # Already removed or replaced by someone else.
+
+
+def _ServeInvocation(conn, request):
+  """Run one forwarded invocation with its environment and stdio.
+
+  Args:
+    conn:    socket, the connection to the client.
+    request: dict with the client's 'argv', 'cwd' and 'environ'.
+
+  Returns:
+    The invocation's exit status.
+  """
+  saved_environ = dict(os.environ)
+  saved_cwd = os.getcwd()
+  saved_stdio = sys.stdin, sys.stdout, sys.stderr
+  try:
+    os.environ.clear()
+    os.environ.update(request['environ'])
+    os.chdir(request['cwd'])
+    sys.stdin = _FrameReader(conn)
+    sys.stdout = _FrameWriter(conn, '1')
+    sys.stderr = _FrameWriter(conn, '2')
+    return _RunInvocation(request['argv'])
+  finally:
+    sys.stdin, sys.stdout, sys.stderr = saved_stdio
+    os.chdir(saved_cwd)
+    os.environ.clear()
+    os.environ.update(saved_environ)
+
+
+def ForwardToDaemon(socket_path):
+  """Have a daemon started with --serve_socket run this invocation.
+
+  Call this at the top of the main module, before the expensive imports. If a
+  daemon listens on socket_path, argv, working directory, environment and
+  stdin are sent to it, its output is copied to stdout and stderr, and the
+  program exits with the invocation's exit status, so this function does not
+  return. Otherwise it returns and the program runs as usual.
+
+  Only output written through sys.stdout and sys.stderr reaches the client;
+  subprocesses started by commands write to the daemon's own stdio. Nothing
+  is sent unless the socket and the daemon belong to the current user.
+
+  Args:
+    socket_path: str, the daemon's Unix socket: a name for one in a directory
+                 private to the user, or a path in a directory only the
+                 user can write to.
+  """
+  if any(arg.split('=', 1)[0] in ('--serve_socket', '-serve_socket')
+         for arg in sys.argv[1:]):
+    return  # This is to become the daemon.
+  socket_name = socket_path
+  socket_path = _DaemonSocketPath(socket_name, create_directory=False)
+  if socket_path is None:
+    return
+  try:
+    socket_stat = os.lstat(socket_path)
+  except OSError:
+    return
+  if (not stat.S_ISSOCK(socket_stat.st_mode)
+      or socket_stat.st_uid != os.getuid()):
+    return
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(socket_path)
+  except socket.error:
+    client.close()
+    return
+  if not _PeerIsUs(client):
+    client.close()
+    return
+  _SendFrame(client, 'R', marshal.dumps({'argv': sys.argv,
+                                         'cwd': os.getcwd(),
+                                         'environ': dict(os.environ)}))
+
+  def ForwardStdin():
+    try:
+      while True:
+        data = os.read(0, 65536)
+        if not data:
+          break
+        _SendFrame(client, '0', data)
+      _SendFrame(client, '.')
+    except (OSError, socket.error):
+      pass  # The invocation is over or stdin is closed.
+  stdin_thread = threading.Thread(target=ForwardStdin, name='ForwardStdin')
+  stdin_thread.daemon = True
+  stdin_thread.start()
+
+  outputs = {'1': sys.stdout, '2': sys.stderr}
+  while True:
+    kind, payload = _RecvFrame(client)
+    if kind in outputs:
+      outputs[kind].write(payload)
+      outputs[kind].flush()
+    elif kind == 'X':
+      sys.exit(int(payload))
+    else:
+      sys.stderr.write('Lost connection to the daemon at %s\n' % socket_path)
+      sys.exit(1)
+
+
 def GetSynopsis():
   """Get synopsis for program.
 
@@ -578,6 +2521,55 @@ def _UsageFooter(detailed_error, cmd_names):
   return '\n'.join(footer)
 
 
+def _CommandHelpBlock(name, cmd_names):
+  """Renders the names and help of a command, as shown by AppcommandsUsage.
+
+  The result is memoized, so that showing help repeatedly, e.g. in the shell
+  or daemon modes, neither calls CommandGetHelp nor wraps the text again.
+
+  Args:
+    name:      name of the command.
+    cmd_names: list of the names of all commands help is shown for.
+
+  Returns:
+    The help block, ending with an empty line.
+  """
+  key = (name, tuple(cmd_names), flags.GetHelpWidth(),
+         tuple(GetCommandArgv() or ()))
+  if key in _cmd_help_cache:
+    return _cmd_help_cache[key]
+  command = GetCommandByName(name)
+  prefix = ''.rjust(GetMaxCommandLength() + 2)
+  cacheable = True
+  try:
+    cmd_help = command.CommandGetHelp(GetCommandArgv(), cmd_names=cmd_names)
+  except Exception as error:  # pylint: disable=broad-except
+    cmd_help = "Internal error for command '%s': %s." % (name, str(error))
+    cacheable = False
+  cmd_help = cmd_help.strip()
+  all_names = ', '.join(
+      [command.CommandGetName()] + (command.CommandGetAliases() or []))
+  block = []
+  if len(all_names) + 1 >= len(prefix) or not cmd_help:
+    # If command/alias list would reach over help block-indent
+    # start the help block on a new line.
+    block.append(flags.TextWrap(all_names, flags.GetHelpWidth()))
+    block.append('\n')
+    prefix1 = prefix
+  else:
+    prefix1 = all_names.ljust(GetMaxCommandLength() + 2)
+  if cmd_help:
+    block.append(flags.TextWrap(cmd_help, flags.GetHelpWidth(), prefix,
+                                prefix1))
+    block.append('\n\n')
+  else:
+    block.append('\n')
+  block = ''.join(block)
+  if cacheable:
+    _cmd_help_cache[key] = block
+  return block
+
+
 def AppcommandsUsage(shorthelp=0, writeto_stdout=0, detailed_error=None,
                      exitcode=None, show_cmd=None, show_global_flags=False):
   """Output usage or help information.
@@ -640,27 +2632,7 @@ def AppcommandsUsage(shorthelp=0, writeto_stdout=0, detailed_error=None,
   # Show the command help (none, one specific, or all)
   for name in cmd_names:
     command = GetCommandByName(name)
-    try:
-      cmd_help = command.CommandGetHelp(GetCommandArgv(), cmd_names=cmd_names)
-    except Exception as error:  # pylint: disable=broad-except
-      cmd_help = "Internal error for command '%s': %s." % (name, str(error))
-    cmd_help = cmd_help.strip()
-    all_names = ', '.join(
-        [command.CommandGetName()] + (command.CommandGetAliases() or []))
-    if len(all_names) + 1 >= len(prefix) or not cmd_help:
-      # If command/alias list would reach over help block-indent
-      # start the help block on a new line.
-      stdfile.write(flags.TextWrap(all_names, flags.GetHelpWidth()))
-      stdfile.write('\n')
-      prefix1 = prefix
-    else:
-      prefix1 = all_names.ljust(GetMaxCommandLength() + 2)
-    if cmd_help:
-      stdfile.write(flags.TextWrap(cmd_help, flags.GetHelpWidth(), prefix,
-                                   prefix1))
-      stdfile.write('\n\n')
-    else:
-      stdfile.write('\n')
+    stdfile.write(_CommandHelpBlock(name, cmd_names))
     # When showing help for exactly one command we show its flags
     if len(cmd_names) == 1:
       # Need to register flags for command prior to be able to use them.
@@ -728,7 +2700,7 @@ def GetCommand(command_required):
     return None
   command = GetCommandByName(_cmd_argv[1])
   if command is None:
-    ShortHelpAndExit("FATAL Command '%s' unknown" % _cmd_argv[1])
+    ShortHelpAndExit('FATAL %s' % _UnknownCommandMessage(_cmd_argv[1]))
   del _cmd_argv[1]
   return command
 
@@ -755,6 +2727,7 @@ def _CommandsStart(unused_argv):
   sys.exit, the return value of the command is used as the exit status.
   """
   # The following is supposed to return after registering additional commands
+  _StartPhase('main')
   try:
     sys.modules['__main__'].main(GetCommandArgv())
   # If sys.exit was called, return with error code.
@@ -764,13 +2737,28 @@ def _CommandsStart(unused_argv):
     traceback.print_exc()  # Print a backtrace to stderr.
     ShortHelpAndExit('\nFATAL error in main: %s' % error)
 
+  if FLAGS.serve_socket:
+    try:
+      _ServeDaemon(FLAGS.serve_socket)
+    except AppCommandsError, error:
+      sys.stderr.write('FATAL %s\n' % error)
+      sys.exit(1)
+    sys.exit(0)
+
   if len(GetCommandArgv()) > 1:
     command = GetCommand(command_required=True)
   else:
     command = GetCommandByName(_cmd_default)
     if command is None:
       ShortHelpAndExit("FATAL Command '%s' unknown" % _cmd_default)
-  sys.exit(command.CommandRun(GetCommandArgv()))
+  try:
+    ret = command.CommandRun(GetCommandArgv())
+  finally:
+    if FLAGS.time_command_phases:
+      _StartPhase()
+      _phase_stopwatch.stop()
+      sys.stderr.write(_phase_stopwatch.dump(verbose=True))
+  sys.exit(ret)
 
 
 def Run():
@@ -785,6 +2773,8 @@ def Run():
   original_really_start = app.really_start
 
   def InterceptReallyStart():
+    _phase_stopwatch.start()
+    _StartPhase('flags')
     original_really_start(main=_CommandsStart)
   app.really_start = InterceptReallyStart
   app.usage = _ReplacementAppUsage
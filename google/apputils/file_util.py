@@ -20,11 +20,28 @@ __author__ = ('elaforge@google.com (Evan LaForge)',
 
 import contextlib
 import errno
+import fnmatch
+import hashlib
+import io
+import mmap
 import os
 import pwd
+import Queue
+import re
 import shutil
 import stat
+import sys
 import tempfile
+import threading
+import time
+
+
+# How durable the atomic writes are once they return, in increasing order of
+# safety and cost:
+DURABILITY_NONE = 'none'  # the file may be empty or missing after a crash
+DURABILITY_FILE = 'file'  # the contents are on disk before the file is renamed
+DURABILITY_DIRECTORY = 'directory'  # the rename is on disk as well
+_DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_FILE, DURABILITY_DIRECTORY)
 
 
 class PasswdError(Exception):
@@ -36,12 +53,465 @@ def ListDirPath(dir_name):
   return [os.path.join(dir_name, fn) for fn in os.listdir(dir_name)]
 
 
+class _DirEntry(object):
+  """Stand-in for os.scandir's DirEntry, built from os.listdir and os.lstat.
+
+  Stat results are cached, as by DirEntry, but every type check needs one.
+  """
+
+  __slots__ = ('name', 'path', '_lstat', '_stat')
+
+  def __init__(self, dir_name, name):
+    self.name = name
+    self.path = os.path.join(dir_name, name)
+    self._lstat = None
+    self._stat = None
+
+  def __repr__(self):
+    return '<_DirEntry %r>' % self.name
+
+  def inode(self):
+    return self.stat(follow_symlinks=False).st_ino
+
+  def stat(self, follow_symlinks=True):
+    if self._lstat is None:
+      self._lstat = os.lstat(self.path)
+    if not follow_symlinks or not stat.S_ISLNK(self._lstat.st_mode):
+      return self._lstat
+    if self._stat is None:
+      self._stat = os.stat(self.path)
+    return self._stat
+
+  def _IsType(self, test, follow_symlinks):
+    try:
+      return test(self.stat(follow_symlinks=follow_symlinks).st_mode)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      return False
+
+  def is_dir(self, follow_symlinks=True):  # pylint: disable=invalid-name
+    return self._IsType(stat.S_ISDIR, follow_symlinks)
+
+  def is_file(self, follow_symlinks=True):  # pylint: disable=invalid-name
+    return self._IsType(stat.S_ISREG, follow_symlinks)
+
+  def is_symlink(self):  # pylint: disable=invalid-name
+    return self._IsType(stat.S_ISLNK, False)
+
+
+def _ListDirEntries(dir_name):
+  """Fallback for os.scandir, see _DirEntry."""
+  return (_DirEntry(dir_name, name) for name in os.listdir(dir_name))
+
+
+_scandir = None  # os.scandir or its backport once looked up, or the fallback
+
+
+def _ScanDir(dir_name):
+  """List the entries of directory 'dir_name' with their cached file types.
+
+  Uses os.scandir or, on Python 2, the scandir module where installed; both
+  get the types from the directory listing on most file systems.
+
+  Returns:
+    list of os.scandir DirEntry-like objects.
+  """
+  global _scandir
+  if _scandir is None:
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+      try:
+        from scandir import scandir  # pylint: disable=g-import-not-at-top
+      except ImportError:
+        scandir = _ListDirEntries
+    _scandir = scandir
+  return list(_scandir(dir_name))
+
+
+def _GlobMatcher(patterns):
+  """Return a function telling whether an entry matches any of 'patterns'.
+
+  Patterns containing a path separator match the path relative to the top
+  of the walk, other patterns match the entry's name, as with fnmatch.
+  """
+  name_res = [re.compile(fnmatch.translate(os.path.normcase(pattern)))
+              for pattern in patterns if os.sep not in pattern]
+  path_res = [re.compile(fnmatch.translate(os.path.normcase(pattern)))
+              for pattern in patterns if os.sep in pattern]
+
+  def Matches(name, relative_path):
+    name = os.path.normcase(name)
+    relative_path = os.path.normcase(relative_path)
+    return (any(name_re.match(name) for name_re in name_res) or
+            any(path_re.match(relative_path) for path_re in path_res))
+  return Matches
+
+
+def WalkDir(top, include=None, exclude=None, prune=None, threads=1,
+            follow_symlinks=False, onerror=None):
+  """Yield the entries of directory 'top' and of all directories below it.
+
+  Unlike os.walk, this yields os.scandir DirEntry-like objects, whose
+  is_dir(), is_file(), is_symlink() and stat() results are cached and mostly
+  come for free with the directory listing, and reads directories on a pool
+  of threads if asked to, which keeps many requests in flight on network
+  file systems.
+
+  Args:
+    top: str; the directory to walk; it is not yielded itself
+    include: list of glob patterns; if given, only entries matching one of
+             them are yielded, all directories are still walked
+    exclude: list of glob patterns; entries matching one of them are neither
+             yielded nor walked
+    prune: callable taking a directory entry and returning True to not walk
+           that directory; it is yielded nevertheless
+    threads: int; number of threads reading directories.  With more than one
+             the order of the entries is unspecified, otherwise directories
+             are walked depth-first.
+    follow_symlinks: bool; whether to walk symbolic links to directories
+    onerror: callable taking the OSError raised for a directory that cannot
+             be read; by default such directories are skipped
+  Yields:
+    DirEntry-like objects with name and path attributes.  Glob patterns
+    containing a path separator match the entry's path relative to 'top',
+    others its name.
+  """
+  prefix_length = len(os.path.join(top, ''))
+  included = include and _GlobMatcher(include)
+  excluded = exclude and _GlobMatcher(exclude)
+
+  def Visit(entry):
+    """Return (whether to yield entry, whether to walk it)."""
+    relative_path = entry.path[prefix_length:]
+    if excluded and excluded(entry.name, relative_path):
+      return False, False
+    try:
+      is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+    except OSError:
+      is_dir = False
+    walk = is_dir and not (prune and prune(entry))
+    return not included or included(entry.name, relative_path), walk
+
+  if threads <= 1:
+    stack = [top]
+    while stack:
+      dir_name = stack.pop()
+      try:
+        entries = _ScanDir(dir_name)
+      except OSError, e:
+        if onerror is not None:
+          onerror(e)
+        continue
+      subdirectories = []
+      for entry in entries:
+        wanted, walk = Visit(entry)
+        if walk:
+          subdirectories.append(entry.path)
+        if wanted:
+          yield entry
+      stack.extend(reversed(subdirectories))
+    return
+
+  for entry in _WalkDirThreaded(top, Visit, threads, follow_symlinks,
+                                onerror):
+    yield entry
+
+
+def _WalkDirThreaded(top, visit, threads, follow_symlinks, onerror):
+  """WalkDir's parallel walk, 'visit' decides what to yield and walk."""
+  directories = Queue.Queue()
+  listings = Queue.Queue()
+
+  def ReadDirectories():
+    while True:
+      dir_name = directories.get()
+      if dir_name is None:
+        return
+      try:
+        entries = _ScanDir(dir_name)
+        for entry in entries:
+          try:
+            entry.is_dir(follow_symlinks=follow_symlinks)  # Cache the type.
+          except OSError:
+            pass
+        listings.put((entries, None))
+      except OSError, e:
+        listings.put((None, e))
+      except:  # pylint: disable=bare-except
+        listings.put((None, sys.exc_info()))
+
+  workers = [threading.Thread(target=ReadDirectories) for _ in xrange(threads)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  directories.put(top)
+  pending = 1
+  try:
+    while pending:
+      entries, error = listings.get()
+      pending -= 1
+      if isinstance(error, tuple):
+        raise error[0], error[1], error[2]
+      if error is not None:
+        if onerror is not None:
+          onerror(error)
+        continue
+      for entry in entries:
+        wanted, walk = visit(entry)
+        if walk:
+          directories.put(entry.path)
+          pending += 1
+        if wanted:
+          yield entry
+  finally:
+    try:
+      while True:
+        directories.get_nowait()  # Drop the directories not read yet.
+    except Queue.Empty:
+      pass
+    for _ in workers:
+      directories.put(None)
+
+
 def Read(filename):
   """Read entire contents of file with name 'filename'."""
   with open(filename) as fp:
     return fp.read()
 
 
+def FileDigest(filename, algorithm='sha256', cache=None, chunk_size=1 << 20):
+  """Return the hex digest of the contents of file 'filename'.
+
+  The file is read through one reusable buffer of 'chunk_size' bytes.
+  hashlib releases the GIL while hashing such large chunks, so other threads
+  (e.g. those of FileDigests) keep running meanwhile.
+
+  Args:
+    filename: str; the name of the file
+    algorithm: str; name of a hashlib algorithm, e.g. 'md5' or 'sha1'
+    cache: optional DigestCache; an unchanged file found in it is not read
+    chunk_size: int; size in bytes of the read buffer
+  Returns:
+    The hex digest as a str.
+  Raises:
+    ValueError: if algorithm is not supported by hashlib.
+    IOError: if the file cannot be read.
+  """
+  hasher = hashlib.new(algorithm)
+  with io.open(filename, 'rb', buffering=0) as fp:
+    info = os.fstat(fp.fileno())
+    if cache is not None:
+      digest = cache.Get(algorithm, info)
+      if digest is not None:
+        return digest
+    started = time.time()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+      size = fp.readinto(buf)
+      if not size:
+        break
+      hasher.update(view[:size])
+    digest = hasher.hexdigest()
+    if (cache is not None and
+        _DigestCacheKey(info) == _DigestCacheKey(os.fstat(fp.fileno())) and
+        info.st_mtime < started - _RACY_SECONDS):
+      cache.Put(algorithm, info, digest)
+  return digest
+
+
+def FileDigests(filenames, algorithm='sha256', cache=None, threads=8):
+  """Return the hex digests of the contents of many files, hashed in parallel.
+
+  Args:
+    filenames: iterable of str; the names of the files
+    algorithm: str; name of a hashlib algorithm, see FileDigest
+    cache: optional DigestCache, see FileDigest
+    threads: int; maximum number of files hashed at the same time
+  Returns:
+    A dict from each filename to the hex digest of its contents.
+  Raises:
+    ValueError: if algorithm is not supported by hashlib.
+    IOError: if a file cannot be read; the others may not be hashed then.
+  """
+  hashlib.new(algorithm)  # Fail early for unknown algorithms.
+  digests = {}
+
+  def Digest(filename):
+    digests[filename] = FileDigest(filename, algorithm=algorithm, cache=cache)
+
+  _ForEachInThreads(Digest, filenames, threads)
+  return digests
+
+
+# A file modified this many seconds before it is hashed might be modified
+# again without changing its mtime, on file systems with coarse timestamps,
+# so its digest is not cached.
+_RACY_SECONDS = 2
+
+
+def _DigestCacheKey(info):
+  """The (device, inode, size, mtime in ns) of os.stat_result 'info'."""
+  mtime_ns = getattr(info, 'st_mtime_ns', None)
+  if mtime_ns is None:
+    mtime_ns = int(round(info.st_mtime * 1e9))
+  return info.st_dev, info.st_ino, info.st_size, mtime_ns
+
+
+class DigestCache(object):
+  """Digests of files, by their device, inode, size and modification time.
+
+  A file with the same identity, size and mtime as when it was hashed is
+  taken to be unchanged.  The cache is kept in the file 'filename' across
+  runs, if given: it is loaded on construction and written back atomically
+  by Save, or when a with statement using the cache exits normally, readable
+  by its owner only.  It is safe to use from several threads.
+  """
+
+  def __init__(self, filename=None):
+    """Create the cache, loading it from file 'filename' if that exists."""
+    self._filename = filename
+    self._digests = {}
+    self._lock = threading.Lock()
+    self._modified = False
+    if filename is None:
+      return
+    try:
+      with open(filename) as fp:
+        for line in fp:
+          try:
+            algorithm, dev, ino, size, mtime_ns, digest = line.split()
+            key = (algorithm, int(dev), int(ino), int(size), int(mtime_ns))
+          except ValueError:
+            continue  # Ignore damaged lines, the file is only a cache.
+          self._digests[key] = digest
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if exc_type is None:
+      self.Save()
+
+  def __len__(self):
+    return len(self._digests)
+
+  def Get(self, algorithm, info):
+    """Return the cached digest of the file with os.stat_result 'info', or None.
+
+    Args:
+      algorithm: str; name of the hashlib algorithm of the digest
+      info: os.stat_result of the file
+    Returns:
+      The hex digest as a str, or None if not cached.
+    """
+    return self._digests.get((algorithm,) + _DigestCacheKey(info))
+
+  def Put(self, algorithm, info, digest):
+    """Cache the hex 'digest' of the file with os.stat_result 'info'."""
+    with self._lock:
+      self._digests[(algorithm,) + _DigestCacheKey(info)] = digest
+      self._modified = True
+
+  def Save(self):
+    """Write the cache to its file, if it has one and was modified."""
+    with self._lock:
+      if self._filename is None or not self._modified:
+        return
+      AtomicWrite(self._filename, ''.join(
+          '%s %d %d %d %d %s\n' % (key + (digest,))
+          for key, digest in sorted(self._digests.iteritems())), mode=0600)
+      self._modified = False
+
+
+# Access patterns MappedRead can advise the kernel of, as madvise(2) advice
+# values shared by the Linux architectures.
+ACCESS_NORMAL = 'normal'
+ACCESS_RANDOM = 'random'
+ACCESS_SEQUENTIAL = 'sequential'
+ACCESS_WILLNEED = 'willneed'
+_MADVISE_ADVICE = {ACCESS_NORMAL: 0, ACCESS_RANDOM: 1, ACCESS_SEQUENTIAL: 2,
+                   ACCESS_WILLNEED: 3}
+
+
+@contextlib.contextmanager
+def MappedRead(filename, access=None):
+  """A context manager mapping the file 'filename' into memory, read-only.
+
+  Unlike Read, this does not copy the file: its pages are read on demand and
+  shared with the page cache and other processes mapping the file.  The
+  yielded mmap object supports len(), indexing, slicing, find() and the
+  re module, and can be wrapped by buffer() for zero-copy access; neither
+  must be used after the context exits.
+
+  Args:
+    filename: str; the name of the file
+    access: str; optional ACCESS_* hint of how the file will be read, given
+            to the kernel through madvise(2) where available
+  Yields:
+    A read-only mmap.mmap object, or '' for an empty file (which cannot be
+    mapped).
+  Raises:
+    ValueError: if access is not an ACCESS_* hint.
+  """
+  if access is not None and access not in _MADVISE_ADVICE:
+    raise ValueError('access must be one of %s, not %r'
+                     % (', '.join(sorted(_MADVISE_ADVICE)), access))
+  with open(filename, 'rb') as fp:
+    if not os.fstat(fp.fileno()).st_size:
+      yield ''
+      return
+    mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    if access is not None:
+      _Madvise(mapping, _MADVISE_ADVICE[access])
+    yield mapping
+  finally:
+    mapping.close()
+
+
+def ReadChunks(filename, chunk_size=1 << 20, access=ACCESS_SEQUENTIAL):
+  """Yield the contents of the file 'filename' in chunks of 'chunk_size'.
+
+  The file is mapped with MappedRead, so only one chunk at a time is copied
+  into a string.
+
+  Args:
+    filename: str; the name of the file
+    chunk_size: int; the size in bytes of the chunks, except for the last one
+    access: str; ACCESS_* hint passed on to MappedRead
+  Yields:
+    str chunks of the contents.
+  """
+  with MappedRead(filename, access=access) as mapping:
+    for offset in xrange(0, len(mapping), chunk_size):
+      yield mapping[offset:offset + chunk_size]
+
+
+def _Madvise(mapping, advice):
+  """Give the kernel madvise(2) 'advice' for a whole mmap, if possible."""
+  libc = _Libc()
+  if not libc or not hasattr(libc, 'madvise'):
+    return
+  import ctypes  # pylint: disable=g-import-not-at-top
+  # Python 2's mmap objects only expose their address through the old
+  # buffer interface.
+  as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+  as_read_buffer.argtypes = [ctypes.py_object,
+                             ctypes.POINTER(ctypes.c_void_p),
+                             ctypes.POINTER(ctypes.c_ssize_t)]
+  address = ctypes.c_void_p()
+  length = ctypes.c_ssize_t()
+  if as_read_buffer(mapping, ctypes.byref(address), ctypes.byref(length)):
+    return
+  libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+  libc.madvise(address, length.value, advice)  # Only a hint, ignore errors.
+
+
 def Write(filename, contents, overwrite_existing=True, mode=0666, gid=None):
   """Create a file 'filename' with 'contents', with the mode given in 'mode'.
 
@@ -63,19 +533,24 @@ def Write(filename, contents, overwrite_existing=True, mode=0666, gid=None):
     flags |= os.O_EXCL
   fd = os.open(filename, flags, mode)
   try:
-    os.write(fd, contents)
+    _WriteAll(fd, contents)
   finally:
     os.close(fd)
   if gid is not None:
     os.chown(filename, -1, gid)
 
 
-def AtomicWrite(filename, contents, mode=0666, gid=None):
+def AtomicWrite(filename, contents, mode=0666, gid=None,
+                durability=DURABILITY_NONE):
   """Create a file 'filename' with 'contents' atomically.
 
   As in Write, 'mode' is modified by the umask.  This creates and moves
   a temporary file, and errors doing the above will be propagated normally,
-  though it will try to clean up the temporary file in that case.
+  though it will try to clean up the temporary file in that case.  On Linux,
+  where the file system supports it, the temporary file has no name while it
+  is written, so a crash then leaves nothing behind.  Only to replace an
+  existing file is the complete file briefly given a random temporary name
+  next to 'filename', which a crash before the rename can leave behind.
 
   This is very similar to the prodlib function with the same name.
 
@@ -86,12 +561,218 @@ def AtomicWrite(filename, contents, mode=0666, gid=None):
     contents: str; the data to write to the file
     mode: int; permissions with which to create the file (default is 0666 octal)
     gid: int; group id with which to create the file
+    durability: str; one of the DURABILITY_* levels, how much of the write is
+                synced to disk before returning.  See AtomicWriteMany to
+                write many files durably.
+  Raises:
+    ValueError: if durability is not a DURABILITY_* level.
+  """
+  _CheckDurability(durability)
+  fd = _OpenAnonymousFile(os.path.dirname(filename))
+  if fd is not None:
+    try:
+      _WriteAll(fd, contents)
+      if durability != DURABILITY_NONE:
+        os.fsync(fd)
+      _LinkAnonymousFile(fd, filename, mode, gid)
+    finally:
+      os.close(fd)
+  else:
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+    try:
+      _WriteAll(fd, contents)
+      if durability != DURABILITY_NONE:
+        os.fsync(fd)
+    finally:
+      os.close(fd)
+    _FinishAtomicWrite(tmp_filename, filename, mode, gid)
+  if durability == DURABILITY_DIRECTORY:
+    _SyncDirectory(os.path.dirname(filename))
+
+
+def AtomicWriteMany(files, mode=0666, gid=None,
+                    durability=DURABILITY_DIRECTORY):
+  """Create many files atomically, syncing each directory only once.
+
+  Like calling AtomicWrite for each file, except that with
+  DURABILITY_DIRECTORY every directory holding some of the files is synced
+  once after all of them were written, rather than once per file.  That
+  makes the writes crash safe at little more than the cost of the file
+  syncs.
+
+  Args:
+    files: iterable of (filename, contents) pairs
+    mode: int; permissions with which to create the files
+    gid: int; group id with which to create the files
+    durability: str; one of the DURABILITY_* levels
+  Raises:
+    ValueError: if durability is not a DURABILITY_* level.
+    OSError: if writing a file fails; the directories of the files written
+             before are synced nevertheless.
   """
-  fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+  _CheckDurability(durability)
+  if durability == DURABILITY_DIRECTORY:
+    file_durability = DURABILITY_FILE  # The directories are synced below.
+  else:
+    file_durability = durability
+  directories = set()
   try:
-    os.write(fd, contents)
+    for filename, contents in files:
+      AtomicWrite(filename, contents, mode=mode, gid=gid,
+                  durability=file_durability)
+      directories.add(os.path.dirname(filename))
+  finally:
+    if durability == DURABILITY_DIRECTORY:
+      for directory in sorted(directories):
+        _SyncDirectory(directory)
+
+
+def _CheckDurability(durability):
+  """Raise ValueError unless 'durability' is one of the DURABILITY_* levels."""
+  if durability not in _DURABILITY_LEVELS:
+    raise ValueError('durability must be one of %s, not %r'
+                     % (', '.join(_DURABILITY_LEVELS), durability))
+
+
+def _SyncDirectory(dir_name):
+  """Flush the entries of directory 'dir_name' to disk, e.g. after a rename."""
+  fd = os.open(dir_name or os.curdir, os.O_RDONLY)
+  try:
+    os.fsync(fd)
   finally:
     os.close(fd)
+
+
+def WriteFiles(files, mode=0666, gid=None, threads=8,
+               durability=DURABILITY_DIRECTORY, make_dirs=False):
+  """Create many files atomically with a pool of threads.
+
+  Like AtomicWriteMany, but up to 'threads' files are written at the same
+  time, which keeps enough I/O outstanding to make use of SSDs and network
+  filesystems, and a file that cannot be written does not stop the others.
+  With DURABILITY_DIRECTORY each directory is synced once after all of its
+  files were written, the syncs are spread over the threads as well.
+
+  Args:
+    files: iterable of (filename, contents) pairs; it is consumed as the
+           threads make progress, so it may be a generator
+    mode: int; permissions with which to create the files
+    gid: int; group id with which to create the files
+    threads: int; maximum number of files written at the same time
+    durability: str; one of the DURABILITY_* levels
+    make_dirs: bool; if True, missing directories are created with
+               MkDirsCached first, and again if they turn out to have been
+               removed since
+  Returns:
+    A dict from the filename of every file that could not be written to the
+    OSError or IOError raised writing it.  If syncing a directory fails, the
+    error is reported for each file written to it.  It is empty on success.
+  Raises:
+    ValueError: if durability is not a DURABILITY_* level.
+  """
+  _CheckDurability(durability)
+  if durability == DURABILITY_DIRECTORY:
+    file_durability = DURABILITY_FILE  # The directories are synced below.
+  else:
+    file_durability = durability
+  errors = {}
+  written = {}  # directory -> filenames written to it
+  lock = threading.Lock()
+
+  def WriteFile(item):
+    filename, contents = item
+    directory = os.path.dirname(filename) or os.curdir
+    try:
+      if make_dirs:
+        MkDirsCached(directory)
+      try:
+        AtomicWrite(filename, contents, mode=mode, gid=gid,
+                    durability=file_durability)
+      except EnvironmentError, e:
+        if not (make_dirs and e.errno == errno.ENOENT):
+          raise
+        # Removed behind MkDirsCached's back, make it again once.
+        ForgetDirs(directory)
+        MkDirsCached(directory)
+        AtomicWrite(filename, contents, mode=mode, gid=gid,
+                    durability=file_durability)
+    except EnvironmentError, e:
+      with lock:
+        errors[filename] = e
+    else:
+      with lock:
+        written.setdefault(os.path.dirname(filename), []).append(filename)
+
+  def SyncDirectory(directory):
+    try:
+      _SyncDirectory(directory)
+    except EnvironmentError, e:
+      with lock:
+        for filename in written[directory]:
+          errors[filename] = e
+
+  _ForEachInThreads(WriteFile, files, threads)
+  if durability == DURABILITY_DIRECTORY:
+    _ForEachInThreads(SyncDirectory, sorted(written), threads)
+  return errors
+
+
+def _ForEachInThreads(function, items, threads):
+  """Call 'function' for each of 'items' with up to 'threads' threads.
+
+  Items are handed to the threads through a bounded queue, so 'items' is
+  never read far ahead of the calls.  Once a call raised, the remaining
+  items are skipped and the exception is re-raised here when all threads
+  are done.
+  """
+  if threads <= 1:
+    for item in items:
+      function(item)
+    return
+  work = Queue.Queue(maxsize=2 * threads)
+  failures = []
+
+  def Worker():
+    while True:
+      item = work.get()
+      if item is work:
+        return
+      if failures:
+        continue
+      try:
+        function(item)
+      except:  # pylint: disable=bare-except
+        failures.append(sys.exc_info())
+
+  workers = [threading.Thread(target=Worker) for _ in xrange(threads)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  try:
+    for item in items:
+      if failures:
+        break
+      work.put(item)
+  finally:
+    for _ in workers:
+      work.put(work)  # The queue itself marks the end, items may be None.
+    for worker in workers:
+      worker.join()
+  if failures:
+    raise failures[0][0], failures[0][1], failures[0][2]
+
+
+def _FinishAtomicWrite(tmp_filename, filename, mode, gid):
+  """Set mode and group of a written temporary file and move it into place.
+
+  Args:
+    tmp_filename: str; the name of the complete temporary file
+    filename: str; the name to move it to
+    mode: int; permissions to give the file
+    gid: int; group id to give the file, or None to keep it
+  Raises:
+    OSError: if any step fails; the temporary file is removed then.
+  """
   try:
     os.chmod(tmp_filename, mode)
     if gid is not None:
@@ -105,6 +786,456 @@ def AtomicWrite(filename, contents, mode=0666, gid=None):
     raise exc
 
 
+# Linux's O_TMPFILE from <fcntl.h>, the value differs on some architectures.
+_O_TMPFILE = 020000000 | getattr(os, 'O_DIRECTORY', 0)
+_AT_FDCWD = -100
+_AT_SYMLINK_FOLLOW = 0x400
+_AT_REMOVEDIR = 0x200
+# Names for our file descriptors, through which Linux lets us reach files
+# that Python 2's os module has no *at() functions for.
+_PROC_SELF_FD = '/proc/self/fd'
+_have_proc_self_fd = (sys.platform.startswith('linux') and
+                      os.path.isdir(_PROC_SELF_FD))
+_anonymous_files_supported = (
+    _have_proc_self_fd and
+    not os.uname()[4].startswith(('alpha', 'parisc', 'sparc')))
+_libc = None  # the C library through ctypes once loaded, False if unavailable
+_linkat = None  # libc's linkat() once loaded, False if unavailable
+
+
+def _Libc():
+  """Return the C library loaded through ctypes, or False if unavailable."""
+  global _libc
+  if _libc is None:
+    try:
+      import ctypes  # pylint: disable=g-import-not-at-top
+      _libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+      _libc = False
+  return _libc
+
+
+def _Linkat():
+  """Return libc's linkat() through ctypes, or False if unavailable."""
+  global _linkat
+  if _linkat is None:
+    libc = _Libc()
+    if libc and hasattr(libc, 'linkat'):
+      import ctypes  # pylint: disable=g-import-not-at-top
+      linkat = libc.linkat
+      linkat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                         ctypes.c_char_p, ctypes.c_int]
+      linkat.restype = ctypes.c_int
+    else:
+      linkat = False
+    _linkat = linkat
+  return _linkat
+
+
+def _OpenAnonymousFile(dir_name):
+  """Open a new file without a name in 'dir_name', for writing.
+
+  Atomic writes use such an O_TMPFILE file on Linux: no temporary name needs
+  to be made up, and the file disappears by itself if the process dies before
+  _LinkAnonymousFile gives it its name.
+
+  Args:
+    dir_name: str; the directory of the file
+  Returns:
+    The file descriptor, or None where the kernel or file system does not
+    support it (or opening failed otherwise, leaving the error to mkstemp).
+  """
+  global _anonymous_files_supported
+  if not (_anonymous_files_supported and _Linkat()):
+    return None
+  try:
+    return os.open(dir_name or os.curdir, _O_TMPFILE | os.O_WRONLY, 0600)
+  except OSError, e:
+    if e.errno == errno.EISDIR:
+      # Kernels before 3.11 ignore O_TMPFILE and try to open the directory.
+      _anonymous_files_supported = False
+    return None
+
+
+def _LinkAnonymousFile(fd, filename, mode, gid):
+  """Give the file opened by _OpenAnonymousFile its mode, group and name.
+
+  Args:
+    fd: int; the file descriptor of the complete file
+    filename: str; the name to give it, replacing any existing file
+    mode: int; permissions to give the file
+    gid: int; group id to give the file, or None to keep it
+  Raises:
+    OSError: if any step fails.
+  """
+  os.fchmod(fd, mode)
+  if gid is not None:
+    os.fchown(fd, -1, gid)
+  if isinstance(filename, unicode):
+    filename = filename.encode(sys.getfilesystemencoding())
+  source = '%s/%d' % (_PROC_SELF_FD, fd)
+  if _LinkFileDescriptor(source, filename):
+    return
+  # linkat() never replaces, so link to a new random name and rename that.
+  # Like O_EXCL, linkat() fails rather than touch an existing file, so the
+  # names of other writers are safe.
+  for _ in xrange(tempfile.TMP_MAX):
+    tmp_filename = '%s.%s.tmp' % (filename, os.urandom(8).encode('hex'))
+    if _LinkFileDescriptor(source, tmp_filename):
+      break
+  else:
+    raise OSError(errno.EEXIST, 'No usable temporary file name found',
+                  tmp_filename)
+  try:
+    os.rename(tmp_filename, filename)
+  except OSError, exc:
+    try:
+      os.remove(tmp_filename)
+    except OSError, e:
+      exc = OSError('%s. Additional errors cleaning up: %s' % (exc, e))
+    raise exc
+
+
+def _LinkFileDescriptor(source, filename):
+  """Link the /proc/self/fd entry 'source' as 'filename'.
+
+  Returns:
+    True if linked, False if 'filename' exists.
+  Raises:
+    OSError: if linking fails otherwise.
+  """
+  import ctypes  # pylint: disable=g-import-not-at-top
+  if _Linkat()(_AT_FDCWD, source, _AT_FDCWD, filename,
+               _AT_SYMLINK_FOLLOW) == 0:
+    return True
+  err = ctypes.get_errno()
+  if err == errno.EEXIST:
+    return False
+  raise OSError(err, os.strerror(err), filename)
+
+
+_STREAM_BUFFER_SIZE = 1 << 20
+
+
+def _WriteAll(fd, data):
+  """Write all of 'data' to 'fd', continuing after partial writes."""
+  while len(data):
+    try:
+      written = os.write(fd, data)
+    except OSError, e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    if written == len(data):
+      return
+    try:
+      view = memoryview(data)
+    except TypeError:
+      # Unicode, which os.write encodes with the default encoding.
+      view = memoryview(str(data))
+    data = view[written:]
+
+
+class _StreamWriter(object):
+  """File-like object writing to a file descriptor through a reusable buffer.
+
+  Small writes are collected in the buffer, writes at least as large as the
+  buffer go straight to the file descriptor.
+  """
+
+  def __init__(self, fd, buffer_size):
+    self._fd = fd
+    self._buffer = bytearray(buffer_size)
+    self._used = 0
+
+  def write(self, data):  # pylint: disable=invalid-name
+    size = len(data)
+    if self._used + size > len(self._buffer):
+      self.flush()
+    if size >= len(self._buffer):
+      _WriteAll(self._fd, data)
+    else:
+      self._buffer[self._used:self._used + size] = data
+      self._used += size
+
+  def fileno(self):  # pylint: disable=invalid-name
+    return self._fd
+
+  def writelines(self, lines):  # pylint: disable=invalid-name
+    for line in lines:
+      self.write(line)
+
+  def flush(self):  # pylint: disable=invalid-name
+    if self._used:
+      _WriteAll(self._fd, memoryview(self._buffer)[:self._used])
+      self._used = 0
+
+  def WriteFrom(self, source):
+    """Write everything read from a file-like object or iterable of str.
+
+    Args:
+      source: object with a read() method, or an iterable of str chunks.
+    """
+    if not hasattr(source, 'read'):
+      self.writelines(source)
+      return
+    self.flush()
+    if hasattr(source, 'readinto'):
+      # Read into the buffer itself rather than into new strings.
+      view = memoryview(self._buffer)
+      while True:
+        size = source.readinto(self._buffer)
+        if not size:
+          break
+        _WriteAll(self._fd, view[:size])
+    else:
+      for chunk in iter(lambda: source.read(len(self._buffer)), ''):
+        self.write(chunk)
+
+
+@contextlib.contextmanager
+def AtomicWriter(filename, mode=0666, gid=None,
+                 buffer_size=_STREAM_BUFFER_SIZE, durability=DURABILITY_NONE):
+  """A context manager to create a file 'filename' atomically, piecewise.
+
+  Like AtomicWrite, but the contents are written to the yielded file-like
+  object, through a buffer of 'buffer_size' bytes, so they need not fit in
+  memory.  The file appears under 'filename' only once the context exits
+  normally; if it exits with an exception, the temporary file is removed.
+
+  Args:
+    filename: str; the name of the file
+    mode: int; permissions with which to create the file (default is 0666 octal)
+    gid: int; group id with which to create the file
+    buffer_size: int; size in bytes of the write buffer
+    durability: str; one of the DURABILITY_* levels, see AtomicWrite
+  Yields:
+    A file-like object with write(), writelines(), flush() and
+    WriteFrom(source) methods.
+  Raises:
+    ValueError: if durability is not a DURABILITY_* level.
+  """
+  _CheckDurability(durability)
+  tmp_filename = None
+  fd = _OpenAnonymousFile(os.path.dirname(filename))
+  if fd is None:
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+  try:
+    try:
+      writer = _StreamWriter(fd, buffer_size)
+      yield writer
+      writer.flush()
+      if durability != DURABILITY_NONE:
+        os.fsync(fd)
+      if tmp_filename is None:
+        _LinkAnonymousFile(fd, filename, mode, gid)
+    finally:
+      os.close(fd)
+  except:
+    if tmp_filename is not None:
+      try:
+        os.remove(tmp_filename)
+      except OSError:
+        pass  # Report the original error.
+    raise
+  if tmp_filename is not None:
+    _FinishAtomicWrite(tmp_filename, filename, mode, gid)
+  if durability == DURABILITY_DIRECTORY:
+    _SyncDirectory(os.path.dirname(filename))
+
+
+def AtomicWriteStream(filename, source, mode=0666, gid=None,
+                      buffer_size=_STREAM_BUFFER_SIZE,
+                      durability=DURABILITY_NONE):
+  """Create a file 'filename' atomically with the contents read from 'source'.
+
+  Memory use is bounded by 'buffer_size', whatever the size of the contents.
+  See AtomicWriter.
+
+  Args:
+    filename: str; the name of the file
+    source: file-like object to read the contents from, or an iterable of str
+            chunks
+    mode: int; permissions with which to create the file (default is 0666 octal)
+    gid: int; group id with which to create the file
+    buffer_size: int; size in bytes of the read and write buffer
+    durability: str; one of the DURABILITY_* levels, see AtomicWrite
+  """
+  with AtomicWriter(filename, mode=mode, gid=gid, buffer_size=buffer_size,
+                    durability=durability) as writer:
+    writer.WriteFrom(source)
+
+
+def CopyFile(source, destination, mode=None, gid=None, preserve_metadata=False,
+             buffer_size=_STREAM_BUFFER_SIZE, durability=DURABILITY_NONE):
+  """Copy the contents of file 'source' to 'destination' atomically.
+
+  The data is copied inside the kernel where it can be: the file is cloned
+  (a reflink, sharing the blocks) on file systems supporting it, else copied
+  with copy_file_range() or sendfile().  Otherwise it is copied through a
+  buffer of 'buffer_size' bytes.  As with AtomicWriter, 'destination'
+  appears only once complete.
+
+  Args:
+    source: str; the name of the file to copy
+    destination: str; the name of the copy, replacing any existing file
+    mode: int; permissions with which to create the copy, by default those
+          of 'source' if preserve_metadata is set, else 0666 octal less the
+          umask, as for a file created by open()
+    gid: int; group id with which to create the copy
+    preserve_metadata: bool; if True, the copy gets the permissions and the
+                       access and modification times of 'source'
+    buffer_size: int; size in bytes of the buffer if it is needed
+    durability: str; one of the DURABILITY_* levels, see AtomicWrite
+  Raises:
+    ValueError: if durability is not a DURABILITY_* level.
+    OSError, IOError: if reading 'source' or writing the copy fails; no
+                      partial copy is left behind.
+  """
+  in_fd = os.open(source, os.O_RDONLY)
+  try:
+    info = os.fstat(in_fd)
+    if mode is None:
+      if preserve_metadata:
+        mode = stat.S_IMODE(info.st_mode)
+      else:
+        mode = 0666 & ~_Umask()
+    with AtomicWriter(destination, mode=mode, gid=gid, buffer_size=buffer_size,
+                      durability=durability) as writer:
+      _CopyFileData(in_fd, writer, info)
+      if preserve_metadata and _have_proc_self_fd:
+        # Set the times before the copy appears under its name.
+        os.utime('%s/%d' % (_PROC_SELF_FD, writer.fileno()),
+                 (info.st_atime, info.st_mtime))
+  finally:
+    os.close(in_fd)
+  if preserve_metadata and not _have_proc_self_fd:
+    os.utime(destination, (info.st_atime, info.st_mtime))
+
+
+def _Umask():
+  """Return the process's umask."""
+  try:
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('Umask:'):
+          return int(line.split()[1], 8)
+  except (IOError, ValueError, IndexError):
+    pass
+  # Without Linux 4.7's Umask line, setting is the only way to read it, which
+  # briefly affects files other threads create.
+  umask = os.umask(022)
+  os.umask(umask)
+  return umask
+
+
+# Linux's FICLONE ioctl from <linux/fs.h>.
+_FICLONE = 0x40049409
+# Errors of cloning, copy_file_range() and sendfile() meaning that they do
+# not support the files, the file system or the kernel.
+_KERNEL_COPY_UNSUPPORTED = frozenset([
+    errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP,
+    errno.EPERM, errno.EXDEV, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+_MAX_KERNEL_COPY = 1 << 30  # bytes copied per call
+_copy_functions = None  # libc's (copy_file_range, sendfile) once looked up
+
+
+def _CopyFileData(in_fd, writer, info):
+  """Copy everything from 'in_fd' to the empty file of _StreamWriter 'writer'.
+
+  Every method continues from the file offsets the previous one left, so a
+  method failing part way through only hands the rest on to the next one.
+
+  Args:
+    in_fd: int; file descriptor of the source, at offset 0
+    writer: _StreamWriter of the copy
+    info: os.stat_result of 'in_fd'
+  """
+  out_fd = writer.fileno()
+  # Files of size 0 may still have contents, e.g. those in /proc.
+  if stat.S_ISREG(info.st_mode) and info.st_size > 0:
+    if _CloneFile(in_fd, out_fd):
+      return
+    copy_file_range, sendfile = _CopyFunctions()
+    remaining = info.st_size
+    if copy_file_range:
+      remaining -= _CopyInKernel(
+          lambda size: copy_file_range(in_fd, None, out_fd, None, size, 0),
+          remaining)
+    if sendfile and remaining > 0:
+      _CopyInKernel(lambda size: sendfile(out_fd, in_fd, None, size),
+                    remaining)
+  # Whatever is left, including data appended since the fstat.
+  writer.WriteFrom(io.FileIO(in_fd, closefd=False))
+
+
+def _CloneFile(in_fd, out_fd):
+  """Make 'out_fd' share the data blocks of 'in_fd'; False if unsupported."""
+  if not sys.platform.startswith('linux'):
+    return False
+  import fcntl  # pylint: disable=g-import-not-at-top
+  try:
+    fcntl.ioctl(out_fd, _FICLONE, in_fd)
+  except EnvironmentError, e:
+    if e.errno in _KERNEL_COPY_UNSUPPORTED:
+      return False
+    raise
+  return True
+
+
+def _CopyFunctions():
+  """Return libc's (copy_file_range, sendfile) through ctypes, None if absent."""
+  global _copy_functions
+  if _copy_functions is None:
+    libc = _Libc()
+    copy_file_range = sendfile = None
+    if libc and sys.platform.startswith('linux'):
+      import ctypes  # pylint: disable=g-import-not-at-top
+      if hasattr(libc, 'copy_file_range'):
+        copy_file_range = libc.copy_file_range
+        copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_size_t, ctypes.c_uint]
+        copy_file_range.restype = ctypes.c_ssize_t
+      if hasattr(libc, 'sendfile'):
+        sendfile = libc.sendfile
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                             ctypes.c_size_t]
+        sendfile.restype = ctypes.c_ssize_t
+    _copy_functions = copy_file_range, sendfile
+  return _copy_functions
+
+
+def _CopyInKernel(copy, size):
+  """Copy up to 'size' bytes with 'copy', a copy_file_range or sendfile call.
+
+  Args:
+    copy: function copying up to the given number of bytes, returning the
+          number copied, 0 at the end of the file, or -1 setting errno
+    size: int; number of bytes to copy
+  Returns:
+    The number of bytes copied, fewer than 'size' if the source is shorter
+    or copying is not supported for these files.
+  Raises:
+    OSError: if copying fails otherwise.
+  """
+  import ctypes  # pylint: disable=g-import-not-at-top
+  copied = 0
+  while copied < size:
+    result = copy(min(size - copied, _MAX_KERNEL_COPY))
+    if result < 0:
+      err = ctypes.get_errno()
+      if err == errno.EINTR:
+        continue
+      if err in _KERNEL_COPY_UNSUPPORTED:
+        break
+      raise OSError(err, os.strerror(err))
+    if not result:
+      break
+    copied += result
+  return copied
+
+
 @contextlib.contextmanager
 def TemporaryFileWithContents(contents, **kw):
   """A contextmanager that writes out a string to a file on disk.
@@ -138,7 +1269,7 @@ def TemporaryFileWithContents(contents, **kw):
 # Python 3.2 (http://bugs.python.org/issue5178,
 # http://docs.python.org/dev/library/tempfile.html#tempfile.TemporaryDirectory).
 @contextlib.contextmanager
-def TemporaryDirectory(suffix='', prefix='tmp', base_path=None):
+def TemporaryDirectory(suffix='', prefix='tmp', base_path=None, threads=1):
   """A context manager to create a temporary directory and clean up on exit.
 
   The parameters are the same ones expected by tempfile.mkdtemp.
@@ -149,6 +1280,8 @@ def TemporaryDirectory(suffix='', prefix='tmp', base_path=None):
     suffix: optional suffix.
     prefix: options prefix.
     base_path: the base path under which to create the temporary directory.
+    threads: number of threads removing the directory, see RemoveTree; with
+             1 it is removed by shutil.rmtree.
   Yields:
     The absolute path of the new temporary directory.
   """
@@ -156,8 +1289,12 @@ def TemporaryDirectory(suffix='', prefix='tmp', base_path=None):
   try:
     yield temp_dir_path
   finally:
+    ForgetDirs(temp_dir_path)
     try:
-      shutil.rmtree(temp_dir_path)
+      if threads > 1:
+        RemoveTree(temp_dir_path, threads=threads)
+      else:
+        shutil.rmtree(temp_dir_path)
     except OSError, e:
       if e.message == 'Cannot call rmtree on a symbolic link':
         # Interesting synthetic exception made up by shutil.rmtree.
@@ -198,7 +1335,206 @@ def MkDirs(directory, force_mode=None):
         raise
 
 
-def RmDirs(dir_name):
+_known_directories = set()  # absolute paths of directories MkDirsCached saw
+_known_directories_lock = threading.Lock()
+_MAX_KNOWN_DIRECTORIES = 100000
+
+
+def MkDirsCached(directory, force_mode=None):
+  """Makes a directory including its parent directories, remembering it.
+
+  Like MkDirs, but meant for hot loops creating files in a few directories:
+  directories this function created or found before are not made again, so
+  the common case costs no system call (a relative path costs a getcwd), and
+  otherwise the directory itself is made first, walking up to its parents
+  only if they are missing.
+
+  Directories removed with RmDirs, RemoveTree or TemporaryDirectory are
+  forgotten; if they are removed otherwise, call ForgetDirs.  Until then
+  this returns without making them again, and creating files in them fails
+  with ENOENT: callers should handle that by calling ForgetDirs and this
+  function again, then retrying once, as WriteFiles does.
+
+  Args:
+    directory: str; the directory to make
+    force_mode: optional octal, chmod dirs created to get rid of umask
+                interaction
+  Raises:
+    OSError: as MkDirs, if a directory cannot be made for any reason other
+             than that it already exists.
+  """
+  path = os.path.abspath(directory)
+  if path not in _known_directories:
+    _MakeDirectoryAndParents(path, force_mode)
+    with _known_directories_lock:
+      if len(_known_directories) >= _MAX_KNOWN_DIRECTORIES:
+        _known_directories.clear()
+      _known_directories.add(path)
+
+
+def _MakeDirectoryAndParents(path, force_mode):
+  """Make the absolute 'path', and its parents if it has to, leaf first."""
+  try:
+    os.mkdir(path)
+  except OSError, exc:
+    if exc.errno == errno.ENOENT and os.path.dirname(path) != path:
+      _MakeDirectoryAndParents(os.path.dirname(path), force_mode)
+      _MakeDirectoryAndParents(path, force_mode)
+    elif not (exc.errno == errno.EEXIST and os.path.isdir(path)):
+      raise
+    return
+  # only chmod if we created
+  if force_mode is not None:
+    os.chmod(path, force_mode)
+
+
+def ForgetDirs(directory=None):
+  """Make MkDirsCached forget a removed directory and those below it.
+
+  Args:
+    directory: str; the removed directory, or None to forget all directories
+  """
+  with _known_directories_lock:
+    if directory is None:
+      _known_directories.clear()
+    elif _known_directories:
+      path = os.path.abspath(directory)
+      prefix = os.path.join(path, '')
+      _known_directories.difference_update(
+          [known for known in _known_directories
+           if known == path or known.startswith(prefix)])
+
+
+def _LibcAtFunctions():
+  """Return libc's (openat, unlinkat) through ctypes, or None if unavailable."""
+  libc = _Libc()
+  if not (_have_proc_self_fd and libc and hasattr(libc, 'openat') and
+          hasattr(libc, 'unlinkat')):
+    return None
+  import ctypes  # pylint: disable=g-import-not-at-top
+  libc.openat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                          ctypes.c_uint]
+  libc.unlinkat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+  return libc.openat, libc.unlinkat
+
+
+def _CallLibc(function, *args):
+  """Call a ctypes libc function, raising OSError like the os module does."""
+  result = function(*args)
+  if result < 0:
+    import ctypes  # pylint: disable=g-import-not-at-top
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), args[1])
+  return result
+
+
+class _TreeRemover(object):
+  """Removes directory trees relative to directory file descriptors.
+
+  Every directory is opened with O_NOFOLLOW relative to its parent and its
+  entries are removed relative to it, so replacing a directory by a symbolic
+  link while the tree is removed cannot redirect the removal elsewhere.
+  Entries are unlinked without a stat: only those unlink refuses are taken
+  for directories.  Subdirectories are removed by up to 'threads' threads;
+  when all are busy, the current thread removes them itself.
+  """
+
+  def __init__(self, functions, threads):
+    self._openat, self._unlinkat = functions
+    self._idle_threads = threading.Semaphore(threads - 1)
+    self._errors = []
+
+  def RemoveDirectoryAt(self, parent_fd, name):
+    """Remove directory 'name' of directory 'parent_fd' and all below it."""
+    fd = _CallLibc(self._openat, parent_fd, name,
+                   os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, 0)
+    threads = []
+    try:
+      for entry in os.listdir('%s/%d' % (_PROC_SELF_FD, fd)):
+        if self._errors:
+          break
+        try:
+          _CallLibc(self._unlinkat, fd, entry, 0)
+          continue
+        except OSError, e:
+          if e.errno == errno.ENOENT:
+            continue
+          if e.errno not in (errno.EISDIR, errno.EPERM):
+            raise
+          unlink_error = e
+        if self._idle_threads.acquire(False):
+          thread = threading.Thread(target=self._RemoveInThread,
+                                    args=(fd, entry, unlink_error))
+          thread.start()
+          threads.append(thread)
+        else:
+          self._RemoveEntryDirectory(fd, entry, unlink_error)
+    finally:
+      for thread in threads:
+        thread.join()
+      os.close(fd)
+    if self._errors:
+      raise self._errors[0][0], self._errors[0][1], self._errors[0][2]
+    try:
+      _CallLibc(self._unlinkat, parent_fd, name, _AT_REMOVEDIR)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def _RemoveEntryDirectory(self, fd, entry, unlink_error):
+    """Remove the entry of 'fd' that could not be unlinked, as a directory."""
+    try:
+      self.RemoveDirectoryAt(fd, entry)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        return
+      if e.errno in (errno.ENOTDIR, errno.ELOOP):
+        raise unlink_error  # Not a directory after all.
+      raise
+
+  def _RemoveInThread(self, fd, entry, unlink_error):
+    try:
+      self._RemoveEntryDirectory(fd, entry, unlink_error)
+    except:  # pylint: disable=bare-except
+      self._errors.append(sys.exc_info())
+    finally:
+      self._idle_threads.release()
+
+
+def RemoveTree(path, threads=8):
+  """Remove the directory 'path' and everything below it, in parallel.
+
+  Like shutil.rmtree, but removes the subdirectories with up to 'threads'
+  threads and, on Linux, relative to directory file descriptors, which makes
+  it safe against symbolic link races.  Elsewhere this is shutil.rmtree.
+
+  Args:
+    path: str; the directory to remove
+    threads: int; maximum number of threads removing subdirectories
+  Raises:
+    OSError: if removing fails, e.g. with errno ENOENT if 'path' does not
+             exist or ENOTDIR if it is not a directory.  As with
+             shutil.rmtree, a symbolic link is not removed.
+  """
+  ForgetDirs(path)
+  functions = _LibcAtFunctions()
+  if functions is None:
+    shutil.rmtree(path)
+    return
+  if os.path.islink(path):
+    # The same synthetic exception shutil.rmtree raises.
+    raise OSError('Cannot call rmtree on a symbolic link')
+  if isinstance(path, unicode):
+    path = path.encode(sys.getfilesystemencoding())
+  parent, name = os.path.split(os.path.normpath(path))
+  parent_fd = os.open(parent or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+  try:
+    _TreeRemover(functions, max(1, threads)).RemoveDirectoryAt(parent_fd, name)
+  finally:
+    os.close(parent_fd)
+
+
+def RmDirs(dir_name, threads=1):
   """Removes dir_name and every subsequently empty directory above it.
 
   Unlike os.removedirs and shutil.rmtree, this function doesn't raise an error
@@ -206,9 +1542,15 @@ def RmDirs(dir_name):
 
   Args:
     dir_name: Directory to be removed.
+    threads: Number of threads removing the tree below dir_name, see
+             RemoveTree; with 1 it is removed by shutil.rmtree.
   """
+  ForgetDirs(dir_name)
   try:
-    shutil.rmtree(dir_name)
+    if threads > 1:
+      RemoveTree(dir_name, threads=threads)
+    else:
+      shutil.rmtree(dir_name)
   except OSError, err:
     if err.errno != errno.ENOENT:
       raise
@@ -221,6 +1563,7 @@ def RmDirs(dir_name):
       except OSError, err:
         if err.errno != errno.ENOENT:
           raise
+      ForgetDirs(parent_directory)
 
       parent_directory = os.path.dirname(parent_directory)
   except OSError, err:
@@ -21,7 +21,10 @@
 import os
 import shutil
 import socket
+import StringIO
 import sys
+import threading
+import time
 
 import mox
 
@@ -39,5 +42,198 @@ class TestFunctions(basetest.TestCase):
     self.assertRaises(TypeError, app.InstallExceptionHandler, 1)
 
 
+class RecordingExceptionHandler(app.ExceptionHandler):
+
+  def __init__(self, delay=0, error=None):
+    self.delay = delay
+    self.error = error
+    self.handled = threading.Event()
+
+  def Handle(self, exc):
+    time.sleep(self.delay)
+    self.handled.set()
+    if self.error:
+      raise self.error
+
+
+class ConcurrentExceptionHandlersTest(basetest.TestCase):
+
+  def setUp(self):
+    self.saved_handlers = app.EXCEPTION_HANDLERS[:]
+    self.saved_flags = (FLAGS.exception_handler_threads,
+                        FLAGS.exception_handler_timeout,
+                        FLAGS.exception_handlers_deadline)
+    self.stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    FLAGS.exception_handler_threads = 2
+    FLAGS.exception_handler_timeout = 0.2
+    FLAGS.exception_handlers_deadline = 5
+
+  def tearDown(self):
+    sys.stderr = self.stderr
+    app.EXCEPTION_HANDLERS[:] = self.saved_handlers
+    (FLAGS.exception_handler_threads,
+     FLAGS.exception_handler_timeout,
+     FLAGS.exception_handlers_deadline) = self.saved_flags
+
+  def testAllHandlersRun(self):
+    handlers = [RecordingExceptionHandler(error=ValueError('handler bug')),
+                RecordingExceptionHandler(), RecordingExceptionHandler()]
+    app.EXCEPTION_HANDLERS[:] = handlers
+    app._DispatchExceptionHandlersConcurrently(Exception('main failed'))
+    self.assertTrue(all(h.handled.is_set() for h in handlers))
+    self.assertIn('handler bug', sys.stderr.getvalue())
+
+  def testSlowHandlerIsAbandoned(self):
+    slow = RecordingExceptionHandler(delay=60)
+    fast = RecordingExceptionHandler()
+    app.EXCEPTION_HANDLERS[:] = [slow, slow, fast]
+    start = time.time()
+    app._DispatchExceptionHandlersConcurrently(Exception('main failed'))
+    self.assertLess(time.time() - start, 2)
+    self.assertTrue(fast.handled.is_set())
+    self.assertIn('timed out', sys.stderr.getvalue())
+
+  def testOverallDeadline(self):
+    FLAGS.exception_handler_threads = 1
+    FLAGS.exception_handler_timeout = 60
+    FLAGS.exception_handlers_deadline = 0.2
+    fast = RecordingExceptionHandler()
+    app.EXCEPTION_HANDLERS[:] = [RecordingExceptionHandler(delay=60), fast]
+    start = time.time()
+    app._DispatchExceptionHandlersConcurrently(Exception('main failed'))
+    self.assertLess(time.time() - start, 2)
+    self.assertFalse(fast.handled.is_set())
+    self.assertIn('skipped at the deadline', sys.stderr.getvalue())
+
+
+class ShutdownHooksTest(basetest.TestCase):
+
+  def setUp(self):
+    self.saved_hooks = app.SHUTDOWN_HOOKS[:]
+    self.saved_timeout = FLAGS.shutdown_timeout
+    app.SHUTDOWN_HOOKS[:] = []
+    app._shutdown_hooks_run = False
+    self.stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    self.calls = []
+
+  def tearDown(self):
+    sys.stderr = self.stderr
+    app.SHUTDOWN_HOOKS[:] = self.saved_hooks
+    app._shutdown_hooks_run = False
+    FLAGS.shutdown_timeout = self.saved_timeout
+
+  def testRejectsNonCallable(self):
+    self.assertRaises(TypeError, app.RegisterShutdownHook, 1)
+
+  def testPriorityOrderAndIdempotence(self):
+    app.RegisterShutdownHook(lambda: self.calls.append('late'), priority=10)
+    app.RegisterShutdownHook(lambda: self.calls.append('first'))
+    app.RegisterShutdownHook(lambda: self.calls.append('second'))
+    app.RegisterShutdownHook(lambda: self.calls.append('early'), priority=-1)
+    app.RunShutdownHooks()
+    app.RunShutdownHooks()
+    self.assertEqual(['early', 'first', 'second', 'late'], self.calls)
+
+  def testFailingHookDoesNotStopOthers(self):
+    app.RegisterShutdownHook(lambda: 1 / 0)
+    app.RegisterShutdownHook(lambda: self.calls.append('ran'))
+    app.RunShutdownHooks()
+    self.assertEqual(['ran'], self.calls)
+    self.assertIn('ZeroDivisionError', sys.stderr.getvalue())
+
+  def testHookTimeout(self):
+    app.RegisterShutdownHook(lambda: time.sleep(60), timeout=0.1)
+    app.RegisterShutdownHook(lambda: self.calls.append('ran'))
+    start = time.time()
+    app.RunShutdownHooks()
+    self.assertLess(time.time() - start, 2)
+    self.assertEqual(['ran'], self.calls)
+    self.assertIn('abandoned', sys.stderr.getvalue())
+
+  def testOverallTimeout(self):
+    FLAGS.shutdown_timeout = 0.1
+    app.RegisterShutdownHook(lambda: time.sleep(60))
+    app.RegisterShutdownHook(lambda: self.calls.append('ran'))
+    app.RunShutdownHooks()
+    self.assertEqual([], self.calls)
+    self.assertIn('skipped at the deadline', sys.stderr.getvalue())
+
+  def testHooksRunAfterExceptionHandlers(self):
+
+    class Handler(app.ExceptionHandler):
+
+      def Handle(handler, unused_exc):  # pylint: disable=no-self-argument
+        self.calls.append('handler')
+
+    def Main():
+      raise ValueError('main failed')
+
+    saved_handlers = app.EXCEPTION_HANDLERS[:]
+    self.addCleanup(app.EXCEPTION_HANDLERS.__setitem__, slice(None),
+                    saved_handlers)
+    app.EXCEPTION_HANDLERS[:] = [Handler()]
+    app.RegisterShutdownHook(lambda: self.calls.append('hook'))
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(app, 'really_start', Main)
+    self.assertRaises(ValueError, app._StartMain)
+    self.assertEqual(['handler', 'hook'], self.calls)
+
+
+class UsageCacheTest(basetest.TestCase):
+
+  def setUp(self):
+    self.cache_file = os.path.join(FLAGS.test_tmpdir, 'usage.helpcache')
+    app.help_cache_file = self.cache_file
+    app._help_cache.clear()
+    app._help_cache_loaded_from = None
+    self.stdout = sys.stdout
+
+  def tearDown(self):
+    sys.stdout = self.stdout
+    app.help_cache_file = None
+    app._help_cache.clear()
+    app._help_cache_loaded_from = None
+    if os.path.exists(self.cache_file):
+      os.remove(self.cache_file)
+
+  def _Usage(self, shorthelp=0):
+    sys.stdout = StringIO.StringIO()
+    try:
+      app.usage(shorthelp=shorthelp, writeto_stdout=1)
+      return sys.stdout.getvalue()
+    finally:
+      sys.stdout = self.stdout
+
+  def testRenderingIsMemoized(self):
+    self.assertIs(app._RenderUsage(0), app._RenderUsage(0))
+    self.assertIsNot(app._RenderUsage(0), app._RenderUsage(1))
+
+  def testCacheFileIsReused(self):
+    output = self._Usage()
+    self.assertTrue(os.path.exists(self.cache_file))
+    # Simulate a new process: only the persisted cache is left.
+    app._help_cache.clear()
+    app._help_cache_loaded_from = None
+    app._LoadHelpCache()
+    self.assertEqual(1, len(app._help_cache))
+    self.assertEqual(output, self._Usage())
+
+  def testNewFlagInvalidatesCache(self):
+    self.assertNotIn('usage_cache_test_flag', self._Usage())
+    flags.DEFINE_string('usage_cache_test_flag', '', 'Only for this test.')
+    try:
+      self.assertIn('usage_cache_test_flag', self._Usage())
+    finally:
+      delattr(FLAGS, 'usage_cache_test_flag')
+
+  def testCorruptCacheFileIsIgnored(self):
+    with open(self.cache_file, 'w') as fp:
+      fp.write('not a marshalled dict')
+    self.assertIn('flags:', self._Usage())
+
+
 if __name__ == '__main__':
   basetest.main()
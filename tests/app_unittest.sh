@@ -198,6 +198,78 @@ app.run()
 grep -q "first look for me" $have_handler_output || die "Test 24 failed"
 grep -q "second look for me" $have_handler_output || die "Test 25 failed"
 
+# Test concurrent exception handlers: a hung handler does not delay exit and
+# the original exception is still raised.
+concurrent_handler_output=$TEST_TMPDIR/concurrent_handler.txt
+$PYTHON -c "from ${APP_PACKAGE} import app
+import time
+def main(argv):
+  raise ValueError('look for me')
+
+class SlowExceptionHandler(app.ExceptionHandler):
+  def Handle(self, exc):
+    time.sleep(600)
+
+class TestExceptionHandler(app.ExceptionHandler):
+  def Handle(self, exc):
+    print 'fast %s' % exc
+
+app.InstallExceptionHandler(SlowExceptionHandler())
+app.InstallExceptionHandler(TestExceptionHandler())
+app.run()
+" --exception_handler_threads=2 --exception_handler_timeout=1 \
+  > $concurrent_handler_output 2>&1
+grep -q "fast look for me" $concurrent_handler_output || die "Test 25a failed"
+grep -q "ValueError: look for me" $concurrent_handler_output || \
+  die "Test 25b failed"
+
+# Test shutdown hooks run on SIGTERM, and the exit status reflects the signal.
+shutdown_output=$TEST_TMPDIR/shutdown.txt
+$PYTHON -c "from ${APP_PACKAGE} import app
+import os
+import signal
+import time
+def Flush():
+  print 'flushed'
+def main(argv):
+  app.RegisterShutdownHook(Flush)
+  os.kill(os.getpid(), signal.SIGTERM)
+  time.sleep(600)
+app.run()
+" > $shutdown_output 2>&1
+if [ "$?" -ne "143" ]; then
+  die "Test 25c failed"
+fi
+grep -q "flushed" $shutdown_output || die "Test 25d failed"
+
+# Test the forkserver: later invocations are served by the process left
+# behind by the first one, without importing the main module again.
+FORKSERVER_DIR=$TEST_TMPDIR/forkserver
+rm -rf $FORKSERVER_DIR
+mkdir -p $FORKSERVER_DIR
+cat >$FORKSERVER_DIR/tool.py <<EOF
+import os
+from ${APP_PACKAGE} import app
+app.EnableForkserver(idle_timeout=5)
+open(os.path.join('$FORKSERVER_DIR', 'imports'), 'a').write('imported\\n')
+def main(argv):
+  print 'main %s %s' % (argv[1], os.environ.get('FORKSERVER_TEST'))
+  return int(argv[1])
+app.run()
+EOF
+forkserver_output=$FORKSERVER_DIR/output.txt
+for i in 3 4 5; do
+  FORKSERVER_TEST=env$i TMPDIR=$FORKSERVER_DIR $PYTHON $FORKSERVER_DIR/tool.py \
+    $i </dev/null >>$forkserver_output 2>&1
+  if [ "$?" -ne "$i" ]; then
+    die "Test 25e failed"
+  fi
+  sleep 1
+done
+grep -q "main 3 env3" $forkserver_output || die "Test 25f failed"
+grep -q "main 5 env5" $forkserver_output || die "Test 25g failed"
+[ "$(wc -l <$FORKSERVER_DIR/imports)" -eq 1 ] || die "Test 25h failed"
+
 no_handler_output=$TEST_TMPDIR/no_handler.txt
 # Test exception handlers are not called for "normal" exits
 for exc in "SystemExit(1)" "app.UsageError('foo')"; do
@@ -310,4 +310,561 @@ def main(argv):
 appcommands.SetDefaultCommand('missing')
 appcommands.Run()" >/dev/null 2>&1 && die "Test 76 failed"
 
+# Lazily registered commands are listed without being imported.
+RES=`$PYTHON -c "${IMPORTS}
+import atexit
+import sys
+def ReportImport():
+  print 'imported:', 'appcommands_example' in sys.modules
+atexit.register(ReportImport)
+def main(argv):
+  appcommands.AddLazyCmd('lazy1', 'appcommands_example.Test1', 'Lazy help1',
+                         command_aliases=['lazyalias1'])
+  appcommands.AddLazyCmd('lazy3', 'appcommands_example.Test3', 'Lazy help3')
+appcommands.Run()" help` && die "Test 77 failed"
+echo "${RES}" | grep -q "help, lazy1, lazy3" || die "Test 78 failed"
+echo "${RES}" | grep -q -E "(^| )lazy3[ \t]+Lazy help3($| )" || \
+  die "Test 79 failed"
+echo "${RES}" | grep -q "imported: False" || die "Test 80 failed"
+
+# Lazily registered commands are imported to run them or show their help.
+LAZY_PROG="${IMPORTS}
+def main(argv):
+  appcommands.AddLazyCmd('lazy1', 'appcommands_example.Test1', 'Lazy help1',
+                         command_aliases=['lazyalias1'])
+  appcommands.AddLazyCmd('lazy3', 'appcommands_example.Test3', 'Lazy help3')
+  appcommands.AddLazyCmd('broken', 'appcommands_example.Missing', 'Broken')
+appcommands.Run()"
+$PYTHON -c "${LAZY_PROG}" lazyalias1 --foo=bar | grep -q "Foo1:'bar'" || \
+  die "Test 81 failed"
+$PYTHON -c "${LAZY_PROG}" lazy3 | grep -q "Command3" || die "Test 82 failed"
+$PYTHON -c "${LAZY_PROG}" help lazy1 | grep -q "Help for test1" || \
+  die "Test 83 failed"
+$PYTHON -c "${LAZY_PROG}" help lazy1 | grep -q "[-]-foo" || die "Test 84 failed"
+$PYTHON -c "${LAZY_PROG}" lazy1 --fail1 >/dev/null 2>&1 && die "Test 85 failed"
+$PYTHON -c "${LAZY_PROG}" broken 2>&1 | grep -q "Cannot load command" || \
+  die "Test 86 failed"
+
+# The shell command runs many command lines, each with fresh flags.
+RES=`printf 'test1 --foo=x --hint=y\ntest1\nbogus\n\n# comment\ntest2 --fail2\ntest3\nexit\ntest4\n' | \
+  $PYTHON -c "${IMPORTS}
+import appcommands_example
+def main(argv):
+  appcommands_example.main(argv)
+  appcommands.AddShellCmd()
+appcommands.Run()" shell 2>&1` || die "Test 87 failed"
+echo "${RES}" | grep -q "Foo1:'x'" || die "Test 88 failed"
+echo "${RES}" | grep -q "Hint1:'y'" || die "Test 89 failed"
+echo "${RES}" | grep -q "Foo1:''" || die "Test 90 failed"
+[ "$(echo "${RES}" | grep -c "Hint1")" -eq 1 ] || die "Test 91 failed"
+echo "${RES}" | grep -q "Command 'bogus' unknown" || die "Test 92 failed"
+echo "${RES}" | grep -q "Command 'test2' exited with status 1" || \
+  die "Test 93 failed"
+echo "${RES}" | grep -q "Command3" || die "Test 94 failed"
+echo "${RES}" | grep -q "Command4" && die "Test 95 failed"
+
+# Ctrl-C stops the running command or drops the line typed, not the shell.
+SHELL_FIFO=$TEST_TMPDIR/shell.fifo
+SHELL_OUT=$TEST_TMPDIR/shell.out
+rm -f $SHELL_FIFO
+mkfifo $SHELL_FIFO
+$PYTHON -c "${IMPORTS}
+import os
+import signal
+import appcommands_example
+# Background jobs of scripts start with SIGINT ignored.
+signal.signal(signal.SIGINT, signal.default_int_handler)
+def interrupt(argv):
+  os.kill(os.getpid(), signal.SIGINT)
+  print 'not interrupted'
+def main(argv):
+  appcommands_example.main(argv)
+  appcommands.AddCmdFunc('interrupt', interrupt)
+  appcommands.AddShellCmd()
+appcommands.Run()" shell <$SHELL_FIFO >$SHELL_OUT 2>&1 &
+SHELL_PID=$!
+exec 3>$SHELL_FIFO
+printf 'interrupt\ntest3\n' >&3
+for i in 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20; do
+  grep -q "Command3" $SHELL_OUT && break
+  sleep 0.5
+done
+kill -INT $SHELL_PID
+# Wait for the newline acknowledging the interrupt before typing on.
+for i in 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20; do
+  [ "$(wc -l <$SHELL_OUT)" -ge 3 ] && break
+  sleep 0.5
+done
+printf 'test1 --foo=z\nexit\n' >&3
+exec 3>&-
+wait $SHELL_PID || die "Test 169 failed"
+grep -q "Foo1:'z'" $SHELL_OUT || die "Test 170 failed"
+grep -q "not interrupted" $SHELL_OUT && die "Test 171 failed"
+grep -q "Traceback" $SHELL_OUT && die "Test 172 failed"
+rm -f $SHELL_FIFO
+
+# The batch command runs the command lines of a file or stdin.
+BATCH_PROG="${IMPORTS}
+import appcommands_example
+def main(argv):
+  appcommands_example.main(argv)
+  appcommands.AddBatchCmd()
+appcommands.Run()"
+BATCH_FILE=$TEST_TMPDIR/batch.txt
+printf 'test1 --foo=a\n# comment\n\ntest2 --fail2\ntest1 --foo=b\ntest1\n' \
+  >$BATCH_FILE
+RES=`$PYTHON -c "${BATCH_PROG}" batch $BATCH_FILE 2>&1` && die "Test 96 failed"
+echo "${RES}" | grep -q "Foo1:'a'" || die "Test 97 failed"
+echo "${RES}" | grep -q "Line 4 exited with status 1: test2 --fail2" || \
+  die "Test 98 failed"
+echo "${RES}" | grep -q "Foo1:'b'" && die "Test 99 failed"
+RES=`$PYTHON -c "${BATCH_PROG}" batch --keep_going <$BATCH_FILE 2>&1` && \
+  die "Test 100 failed"
+echo "${RES}" | grep -q "Foo1:'b'" || die "Test 101 failed"
+echo "${RES}" | grep -q "Foo1:''" || die "Test 102 failed"
+RES=`$PYTHON -c "${BATCH_PROG}" batch --keep_going --jobs=3 --report_status \
+  $BATCH_FILE 2>&1` && die "Test 103 failed"
+echo "${RES}" | grep "Foo1:" | tr '\n' ' ' | \
+  grep -q "Foo1:'a' Foo1:'b' Foo1:''" || die "Test 104 failed"
+echo "${RES}" | grep -q "Line 6 exited with status 0: test1" || \
+  die "Test 105 failed"
+printf 'test1\ntest3\n' | $PYTHON -c "${BATCH_PROG}" batch --jobs=2 | \
+  grep -q "Command3" || die "Test 106 failed"
+
+# Commands run by batch may define flags named like the batch command's.
+JOBS_PROG="${IMPORTS}
+class Jobs(appcommands.Cmd):
+  def __init__(self, name, flag_values, **kargs):
+    super(Jobs, self).__init__(name, flag_values, **kargs)
+    flags.DEFINE_integer('jobs', 1, 'Jobs', flag_values=flag_values)
+  def Run(self, argv):
+    print 'jobs=%d' % flags.FLAGS.jobs
+def main(argv):
+  appcommands.AddCmd('jobs', Jobs)
+  appcommands.AddBatchCmd()
+appcommands.Run()"
+RES=`printf 'jobs --jobs=5\njobs\n' | $PYTHON -c "${JOBS_PROG}" batch 2>&1` || \
+  die "Test 173 failed"
+echo "${RES}" | tr '\n' ' ' | grep -q "^jobs=5 jobs=1 $" || die "Test 174 failed"
+RES=`printf 'jobs --jobs=5\njobs\n' | \
+  $PYTHON -c "${JOBS_PROG}" batch --jobs=2 2>&1` || die "Test 175 failed"
+echo "${RES}" | tr '\n' ' ' | grep -q "^jobs=5 jobs=1 $" || die "Test 176 failed"
+
+# Parallel batch waits for its own children only, and leaves the tool's
+# SIGCHLD handler in place.
+CHILD_PROG="${IMPORTS}
+import atexit
+import signal
+import subprocess
+import appcommands_example
+def OnChildExit(signum, frame):
+  pass
+def Report(child):
+  print 'handler', signal.getsignal(signal.SIGCHLD) is OnChildExit
+  print 'child', child.wait()
+def main(argv):
+  signal.signal(signal.SIGCHLD, OnChildExit)
+  atexit.register(Report, subprocess.Popen(['sh', '-c', 'exit 7']))
+  appcommands_example.main(argv)
+  appcommands.AddBatchCmd()
+appcommands.Run()"
+RES=`printf 'test1\ntest1\ntest1\n' | \
+  $PYTHON -c "${CHILD_PROG}" batch --jobs=2 2>&1` || die "Test 191 failed"
+echo "${RES}" | grep -E "^(handler|child)" | tr '\n' ' ' | \
+  grep -q "^handler True child 7 $" || die "Test 192 failed"
+
+# Daemon mode: invocations forwarded to a daemon share its warm state.
+DAEMON_SOCKET=$TEST_TMPDIR/appcommands_daemon.sock
+DAEMON_PROG="${IMPORTS}
+import sys
+appcommands.ForwardToDaemon('${DAEMON_SOCKET}')
+runs = []
+def count(argv):
+  runs.append(argv[1:])
+  print 'run %d %s' % (len(runs), ' '.join(sys.stdin.read().split()))
+  sys.stderr.write('to stderr\\n')
+  return len(runs)
+def main(argv):
+  appcommands.AddCmdFunc('count', count)
+appcommands.Run()"
+rm -f $DAEMON_SOCKET
+$PYTHON -c "${DAEMON_PROG}" --serve_socket=$DAEMON_SOCKET </dev/null &
+DAEMON_PID=$!
+for i in 1 2 3 4 5 6 7 8 9 10; do
+  test -S $DAEMON_SOCKET && break
+  sleep 0.5
+done
+RES=`echo first | $PYTHON -c "${DAEMON_PROG}" count 2>&1`
+[ "$?" -eq 1 ] || die "Test 107 failed"
+echo "${RES}" | grep -q "run 1 first" || die "Test 108 failed"
+echo "${RES}" | grep -q "to stderr" || die "Test 109 failed"
+RES=`echo second | $PYTHON -c "${DAEMON_PROG}" count 2>/dev/null`
+[ "$?" -eq 2 ] || die "Test 110 failed"
+echo "${RES}" | grep -q "run 2 second" || die "Test 111 failed"
+$PYTHON -c "${DAEMON_PROG}" help | grep -q "count" || die "Test 112 failed"
+$PYTHON -c "${DAEMON_PROG}" bogus 2>&1 | grep -q "unknown" || \
+  die "Test 113 failed"
+# A second daemon does not take over the socket of a live one.
+$PYTHON -c "${DAEMON_PROG}" --serve_socket=$DAEMON_SOCKET </dev/null 2>&1 | \
+  grep -q "already listens" || die "Test 177 failed"
+RES=`echo third | $PYTHON -c "${DAEMON_PROG}" count 2>/dev/null`
+echo "${RES}" | grep -q "run 3 third" || die "Test 178 failed"
+kill $DAEMON_PID
+wait $DAEMON_PID 2>/dev/null
+# Without a daemon, the invocation runs locally.
+RES=`echo local | $PYTHON -c "${DAEMON_PROG}" count 2>/dev/null`
+echo "${RES}" | grep -q "run 1 local" || die "Test 114 failed"
+# Nothing but a stale socket is ever removed to serve on its path.
+rm -f $DAEMON_SOCKET
+echo "precious" >$DAEMON_SOCKET
+$PYTHON -c "${DAEMON_PROG}" --serve_socket=$DAEMON_SOCKET </dev/null \
+  >/dev/null 2>&1 && die "Test 179 failed"
+grep -q "precious" $DAEMON_SOCKET || die "Test 180 failed"
+rm -f $DAEMON_SOCKET
+# Sockets in directories others can write to are neither served nor used.
+mkdir -p $TEST_TMPDIR/shared
+chmod 0777 $TEST_TMPDIR/shared
+$PYTHON -c "${DAEMON_PROG}" --serve_socket=$TEST_TMPDIR/shared/sock \
+  </dev/null 2>&1 | grep -q "writable only by you" || die "Test 181 failed"
+test -e $TEST_TMPDIR/shared/sock && die "Test 182 failed"
+# A plain name is a socket in a private per-user directory.
+NAMED_PROG=`echo "${DAEMON_PROG}" | sed "s|'${DAEMON_SOCKET}'|'apputils-test.sock'|"`
+$PYTHON -c "${NAMED_PROG}" --serve_socket=apputils-test.sock </dev/null &
+DAEMON_PID=$!
+RES=""
+for i in 1 2 3 4 5 6 7 8 9 10; do
+  RES=`echo named | $PYTHON -c "${NAMED_PROG}" count 2>/dev/null`
+  echo "${RES}" | grep -q "run 1 named" && break
+  sleep 0.5
+done
+kill $DAEMON_PID
+wait $DAEMON_PID 2>/dev/null
+echo "${RES}" | grep -q "run 1 named" || die "Test 183 failed"
+
+# Unambiguous prefixes select commands, mistyped names get suggestions.
+TEST=./appcommands_example.py
+$PYTHON $TEST test3 >/dev/null || die "Test 115 failed"
+$PYTHON $TEST testalias3 | grep -q "Command4" || die "Test 116 failed"
+$PYTHON $TEST testalias2b --foo=x | grep -q "Foo1:'x'" || die "Test 117 failed"
+$PYTHON $TEST testalias2 | grep -q "Command1" || die "Test 118 failed"
+$PYTHON $TEST testalias1b | grep -q "Command1" || die "Test 119 failed"
+$PYTHON $TEST test1b --allhelp | grep -q "AllHelp:'test1b short help'" || \
+  die "Test 120 failed"
+$PYTHON $TEST tes >/dev/null 2>&1 && die "Test 121 failed"
+$PYTHON $TEST tes 2>&1 | grep -q "it is a prefix of: test1, test1b" || \
+  die "Test 122 failed"
+$PYTHON $TEST tset3 2>&1 | grep -q "did you mean: test3" || \
+  die "Test 123 failed"
+$PYTHON $TEST help testalias3 | grep -q "Help for test4" || \
+  die "Test 124 failed"
+$PYTHON -c "${IMPORTS}
+def test(argv):
+  print 'status ran'
+def main(argv):
+  appcommands.AddCmdFunc('status', test, command_aliases=['stat'])
+  appcommands.AddCmdFunc('version', test)
+appcommands.Run()" st | grep -q "status ran" || die "Test 125 failed"
+$PYTHON -c "${IMPORTS}
+def test(argv):
+  print 'status ran'
+def main(argv):
+  appcommands.AddCmdFunc('status', test)
+appcommands.SetCommandPrefixMatching(False)
+appcommands.Run()" st >/dev/null 2>&1 && die "Test 126 failed"
+
+# Timing and profiling the command.
+PROFILE_PROG="${IMPORTS}
+import time
+def spin(argv):
+  # Spin for CPU time, not wall time, so the sampling profiler's CPU time
+  # timer fires however loaded the machine is.
+  end = time.clock() + 0.3
+  while time.clock() < end:
+    pass
+  return 3
+def main(argv):
+  appcommands.AddCmdFunc('spin', spin)
+appcommands.Run()"
+$PYTHON -c "${PROFILE_PROG}" --time_command_phases spin >/dev/null 2>&1
+[[ $? -eq 3 ]] || die "Test 127 failed"
+RES=`$PYTHON -c "${PROFILE_PROG}" --time_command_phases spin 2>&1`
+for PHASE in flags main "command flags" command total; do
+  echo "${RES}" | grep -q "^ *${PHASE}: " || die "Test 128 failed"
+done
+$PYTHON -c "${PROFILE_PROG}" --profile_command=cprofile spin 2>&1 | \
+  grep -q "function calls" || die "Test 129 failed"
+$PYTHON -c "${PROFILE_PROG}" --profile_command=cprofile spin 2>&1 | \
+  grep -q "RegisterAndParseFlagsWithUsage" && die "Test 130 failed"
+PROFILE_FILE="${TEST_TMPDIR}/appcommands_profile"
+rm -f "${PROFILE_FILE}"
+$PYTHON -c "${PROFILE_PROG}" --profile_command=cprofile \
+  --profile_command_file="${PROFILE_FILE}" spin 2>/dev/null
+$PYTHON -c "import pstats; pstats.Stats('${PROFILE_FILE}')" || \
+  die "Test 131 failed"
+RES=`$PYTHON -c "${PROFILE_PROG}" --profile_command=sampling spin 2>&1`
+echo "${RES}" | grep -q "samples taken every" || die "Test 132 failed"
+echo "${RES}" | grep -q "(spin)" || die "Test 133 failed"
+
+# The fanout command runs one command for many inputs in parallel.
+FANOUT_PROG="${IMPORTS}
+import os
+import sys
+import time
+class Check(appcommands.Cmd):
+  def __init__(self, name, flag_values, **kargs):
+    super(Check, self).__init__(name, flag_values, **kargs)
+    flags.DEFINE_string('greeting', 'hi', 'Greeting', flag_values=flag_values)
+    flags.DEFINE_integer('jobs', 0, 'Clashes with fanout', flag_values=flag_values)
+  def Run(self, argv):
+    # With FANOUT_BARRIER set, wait for that many inputs to have started.
+    barrier = int(os.environ.get('FANOUT_BARRIER', 0))
+    if barrier:
+      marker_dir = os.environ['FANOUT_MARKERS']
+      open(os.path.join(marker_dir, '_'.join(argv[1:])), 'w').close()
+      deadline = time.time() + 60
+      while len(os.listdir(marker_dir)) < barrier:
+        if time.time() > deadline:
+          print 'not run in parallel'
+          break
+        time.sleep(0.01)
+    print '%s %s' % (flags.FLAGS.greeting, ' '.join(argv[1:]))
+    if argv[1] == 'bad':
+      return 4
+def main(argv):
+  appcommands.AddCmd('check', Check)
+  appcommands.AddFanOutCmd()
+appcommands.Run()"
+FANOUT_FILE=$TEST_TMPDIR/fanout.txt
+printf 'a 1\nbad\n\n# comment\nc\nd\n' >$FANOUT_FILE
+FANOUT_MARKERS=$TEST_TMPDIR/fanout_markers
+for POOL in process thread; do
+  rm -rf $FANOUT_MARKERS
+  mkdir $FANOUT_MARKERS
+  # All four inputs must be running at the same time to get past the barrier.
+  RES=`FANOUT_BARRIER=4 FANOUT_MARKERS=$FANOUT_MARKERS \
+       $PYTHON -c "${FANOUT_PROG}" fanout --pool=$POOL --jobs=4 \
+       --inputs=$FANOUT_FILE check --greeting=yo 2>&1` && die "Test 134 failed"
+  echo "${RES}" | grep -q "not run in parallel" && die "Test 135 failed"
+  [[ "`echo "${RES}" | head -4`" == "yo a 1
+yo bad
+yo c
+yo d" ]] || die "Test 136 failed"
+  echo "${RES}" | grep -q "1 of 4 inputs failed" || die "Test 137 failed"
+  echo "${RES}" | grep -q "exit status 4: bad" || die "Test 138 failed"
+done
+RES=`printf 'x\ny\n' | $PYTHON -c "${FANOUT_PROG}" fanout --stream \
+     --pool=thread check` || die "Test 139 failed"
+echo "${RES}" | grep -q "^x: hi x$" || die "Test 140 failed"
+echo "${RES}" | grep -q "^y: hi y$" || die "Test 141 failed"
+printf 'x\n' | $PYTHON -c "${FANOUT_PROG}" fanout --stream check | \
+  grep -q "^x: hi x$" || die "Test 142 failed"
+$PYTHON -c "${FANOUT_PROG}" fanout </dev/null >/dev/null 2>&1 && \
+  die "Test 143 failed"
+$PYTHON -c "${FANOUT_PROG}" fanout fanout </dev/null >/dev/null 2>&1 && \
+  die "Test 144 failed"
+
+# Cacheable commands replay their recorded output and exit status.
+CACHE_DIR=$TEST_TMPDIR/command_cache
+RUNS_FILE=$TEST_TMPDIR/cache_runs
+INPUT_FILE=$TEST_TMPDIR/cache_input
+rm -rf $CACHE_DIR $RUNS_FILE
+echo one >$INPUT_FILE
+CACHE_PROG="${IMPORTS}
+import os
+flags.DEFINE_string('region', 'us', 'A global flag')
+class Lint(appcommands.Cmd):
+  def __init__(self, name, flag_values, **kargs):
+    super(Lint, self).__init__(name, flag_values, cacheable=True, **kargs)
+    flags.DEFINE_boolean('strict', False, 'Strict', flag_values=flag_values)
+  def GetCacheVersion(self):
+    return os.environ.get('LINT_VERSION')
+  def Run(self, argv):
+    open('${RUNS_FILE}', 'a').write('x')
+    print 'lint', flags.FLAGS.strict, open(argv[1]).read().strip()
+    return 3
+def big(argv):
+  open('${RUNS_FILE}', 'a').write('x')
+  print 'y' * 400
+def main(argv):
+  appcommands.AddCmd('lint', Lint)
+  appcommands.AddCmdFunc('big', big, cacheable=True)
+appcommands.Run()"
+function cache_runs {
+  $PYTHON -c "${CACHE_PROG}" --command_cache_dir=$CACHE_DIR "$@"
+}
+RES=`cache_runs lint $INPUT_FILE`
+[[ $? -eq 3 && "${RES}" == "lint False one" ]] || die "Test 145 failed"
+RES=`cache_runs lint $INPUT_FILE`
+[[ $? -eq 3 && "${RES}" == "lint False one" ]] || die "Test 146 failed"
+[[ `cat $RUNS_FILE` == "x" ]] || die "Test 147 failed"
+RES=`cache_runs lint --strict $INPUT_FILE`
+[[ "${RES}" == "lint True one" && `cat $RUNS_FILE` == "xx" ]] || \
+  die "Test 148 failed"
+echo two >$INPUT_FILE
+RES=`cache_runs lint $INPUT_FILE`
+[[ "${RES}" == "lint False two" && `cat $RUNS_FILE` == "xxx" ]] || \
+  die "Test 149 failed"
+cache_runs --nouse_command_cache lint $INPUT_FILE >/dev/null
+[[ `cat $RUNS_FILE` == "xxxx" ]] || die "Test 150 failed"
+# Other global flag values and other code versions get their own results.
+cache_runs --region=eu lint $INPUT_FILE >/dev/null
+[[ `cat $RUNS_FILE` == "xxxxx" ]] || die "Test 184 failed"
+cache_runs --region=us lint $INPUT_FILE >/dev/null
+[[ `cat $RUNS_FILE` == "xxxxx" ]] || die "Test 185 failed"
+LINT_VERSION=2 cache_runs lint $INPUT_FILE >/dev/null
+[[ `cat $RUNS_FILE` == "xxxxxx" ]] || die "Test 186 failed"
+CACHE_TOOL=$TEST_TMPDIR/cachetool.py
+echo "${CACHE_PROG}" >$CACHE_TOOL
+$PYTHON $CACHE_TOOL --command_cache_dir=$CACHE_DIR lint $INPUT_FILE >/dev/null
+$PYTHON $CACHE_TOOL --command_cache_dir=$CACHE_DIR lint $INPUT_FILE >/dev/null
+[[ `cat $RUNS_FILE` == "xxxxxxx" ]] || die "Test 187 failed"
+echo "# Edited." >>$CACHE_TOOL
+$PYTHON $CACHE_TOOL --command_cache_dir=$CACHE_DIR lint $INPUT_FILE >/dev/null
+[[ `cat $RUNS_FILE` == "xxxxxxxx" ]] || die "Test 188 failed"
+# Least recently used results are evicted beyond --command_cache_size.
+rm -rf $CACHE_DIR $RUNS_FILE
+cache_runs --command_cache_size=1000 big 1 >/dev/null
+cache_runs --command_cache_size=1000 big 2 >/dev/null
+cache_runs --command_cache_size=1000 big 1 >/dev/null
+cache_runs --command_cache_size=1000 big 3 >/dev/null
+[[ `ls $CACHE_DIR | wc -l` -eq 2 ]] || die "Test 151 failed"
+cache_runs --command_cache_size=1000 big 1 >/dev/null
+[[ `cat $RUNS_FILE` == "xxx" ]] || die "Test 152 failed"
+cache_runs --command_cache_size=1000 big 2 >/dev/null
+[[ `cat $RUNS_FILE` == "xxxx" ]] || die "Test 153 failed"
+
+# Coroutine commands run on a shared event loop, closed at exit.
+if $PYTHON -c "import trollius" 2>/dev/null; then
+  COROUTINE_PROG="${IMPORTS}
+import signal
+import thread
+import trollius
+MAIN_THREAD = thread.get_ident()
+from trollius import From, Return
+@trollius.coroutine
+def fetch(argv):
+  events = []
+  @trollius.coroutine
+  def FetchOne(value):
+    events.append('start')
+    yield From(trollius.sleep(0.1))
+    events.append('end')
+    raise Return(value)
+  values = yield From(trollius.gather(*[FetchOne(int(arg))
+                                        for arg in argv[1:]]))
+  print ' '.join(events)
+  print sum(values)
+  trollius.async(trollius.sleep(100))  # Cancelled at shutdown.
+  raise Return(5)
+class LoopId(appcommands.Cmd):
+  @trollius.coroutine
+  def Run(self, argv):
+    yield From(trollius.sleep(0))
+    print 'loop', id(trollius.get_event_loop())
+class Handler(appcommands.Cmd):
+  @trollius.coroutine
+  def Run(self, argv):
+    yield From(trollius.sleep(0))
+    print 'handler', signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+@trollius.coroutine
+def Sleeper():
+  try:
+    yield From(trollius.sleep(100))
+  finally:
+    print 'cancelled on main thread', thread.get_ident() == MAIN_THREAD
+def pending(argv):
+  trollius.async(Sleeper())
+  yield From(trollius.sleep(0))
+def main(argv):
+  appcommands.AddCmdFunc('fetch', fetch)
+  appcommands.AddCmd('loopid', LoopId)
+  appcommands.AddCmd('handler', Handler)
+  appcommands.AddCmdFunc('pending', trollius.coroutine(pending))
+  appcommands.AddShellCmd()
+appcommands.Run()"
+  RES=`$PYTHON -c "${COROUTINE_PROG}" fetch 1 2 3 2>&1`
+  [[ $? -eq 5 && "`echo "${RES}" | tail -1`" == "6" ]] || \
+    die "Test 154 failed"
+  # The coroutines ran concurrently: all started before the first ended.
+  [[ "`echo "${RES}" | head -1`" == "start start start end end end" ]] || \
+    die "Test 155 failed"
+  [[ `echo "${RES}" | wc -l` -eq 2 ]] || die "Test 155 failed"
+  RES=`printf 'loopid\nloopid\n' | $PYTHON -c "${COROUTINE_PROG}" shell`
+  [[ `echo "${RES}" | grep -c loop` -eq 2 && \
+     `echo "${RES}" | sort -u | wc -l` -eq 1 ]] || die "Test 156 failed"
+  # Running coroutines leaves the SIGTERM handler alone, and the loop is
+  # closed on the main thread.
+  RES=`printf 'handler\nhandler\n' | $PYTHON -c "${COROUTINE_PROG}" shell`
+  [[ `echo "${RES}" | grep -c "handler True"` -eq 2 ]] || die "Test 189 failed"
+  RES=`$PYTHON -c "${COROUTINE_PROG}" pending`
+  [[ "${RES}" == "cancelled on main thread True" ]] || die "Test 190 failed"
+fi
+
+# The completion command writes a static completion script.
+COMPLETION_PROG=$TEST_TMPDIR/comptool
+cat >$COMPLETION_PROG <<EOF
+${IMPORTS}
+flags.DEFINE_boolean('loud', False, 'Loud')
+class Check(appcommands.Cmd):
+  def __init__(self, name, flag_values, **kargs):
+    super(Check, self).__init__(name, flag_values, **kargs)
+    flags.DEFINE_string('greeting', 'hi', 'Greeting', flag_values=flag_values)
+  def Run(self, argv):
+    pass
+def main(argv):
+  appcommands.AddCmd('check', Check, command_aliases=['chk'])
+  appcommands.AddCompletionCmd()
+appcommands.Run()
+EOF
+COMPLETION_FILE=$TEST_TMPDIR/comptool.bash
+rm -f $COMPLETION_FILE
+$PYTHON $COMPLETION_PROG completion --output=$COMPLETION_FILE || \
+  die "Test 157 failed"
+function complete_words {
+  bash -c "source $COMPLETION_FILE
+COMP_WORDS=(comptool \$*)
+COMP_CWORD=\$#
+_comptool_complete
+echo \${COMPREPLY[@]}" -- "$@"
+}
+[[ "`complete_words ch`" == "check chk" ]] || die "Test 158 failed"
+[[ "`complete_words --lo`" == "--loud" ]] || die "Test 159 failed"
+[[ "`complete_words --noloud chk --g`" == "--greeting" ]] || \
+  die "Test 160 failed"
+[[ "`complete_words check --lo`" == "--loud" ]] || die "Test 161 failed"
+[[ "`complete_words completion --o`" == "--output" ]] || die "Test 162 failed"
+[[ "`complete_words --outp`" == "" ]] || die "Test 163 failed"
+# The script is only rewritten when it changes.
+touch -d '2000-01-01' $COMPLETION_FILE
+$PYTHON $COMPLETION_PROG completion --output=$COMPLETION_FILE
+[[ `stat -c %Y $COMPLETION_FILE` -eq `date -d 2000-01-01 +%s` ]] || \
+  die "Test 164 failed"
+$PYTHON $COMPLETION_PROG completion --shell=zsh | \
+  grep -q "^compdef _comptool_complete comptool$" || die "Test 165 failed"
+
+# Command help is rendered once and then reused.
+HELP_CALLS_FILE=$TEST_TMPDIR/help_calls
+rm -f $HELP_CALLS_FILE
+RES=`printf 'help\nhelp\nhelp counted\n' | $PYTHON -c "${IMPORTS}
+class Counted(appcommands.Cmd):
+  def Run(self, argv):
+    pass
+  def CommandGetHelp(self, argv, cmd_names=None):
+    open('${HELP_CALLS_FILE}', 'a').write('x')
+    return 'Counted help'
+def main(argv):
+  appcommands.AddCmd('counted', Counted)
+  appcommands.AddShellCmd()
+appcommands.Run()" shell 2>&1`
+[[ `echo "${RES}" | grep -c "^counted  *Counted help"` -eq 3 ]] || \
+  die "Test 166 failed"
+[[ `cat $HELP_CALLS_FILE` == "xx" ]] || die "Test 167 failed"
+$PYTHON -c "${IMPORTS}
+def test(argv):
+  pass
+appcommands.AddCmdFunc('abc', test)
+assert appcommands.GetMaxCommandLength() == 4  # 'help'
+appcommands.AddCmdFunc('abcdefgh', test)
+assert appcommands.GetMaxCommandLength() == 8" || die "Test 168 failed"
+
 echo "PASS"
@@ -19,11 +19,13 @@
 
 import __builtin__
 import errno
+import hashlib
 import os
 import posix
 import pwd
 import shutil
 import stat
+import StringIO
 import tempfile
 
 import mox
@@ -89,6 +91,559 @@ class FileUtilTempdirTest(basetest.TestCase):
     s = os.stat(self.file_path)
     self.assertEqual(stat.S_IMODE(s.st_mode), mode)
 
+  def testAtomicWriterChunks(self):
+    chunks = ['%d,' % i for i in xrange(10000)]
+    with file_util.AtomicWriter(self.file_path, buffer_size=64) as writer:
+      writer.write('head:')
+      writer.writelines(chunks)
+      writer.write('x' * 100)  # Larger than the buffer.
+      self.assertFalse(os.path.exists(self.file_path))
+    with open(self.file_path) as fp:
+      self.assertEquals(fp.read(), 'head:' + ''.join(chunks) + 'x' * 100)
+
+  def testAtomicWriterMode(self):
+    with file_util.AtomicWriter(self.file_path, mode=0745) as writer:
+      writer.write(self.sample_contents)
+    s = os.stat(self.file_path)
+    self.assertEqual(stat.S_IMODE(s.st_mode), 0745)
+
+  def testAtomicWriterError(self):
+    file_util.Write(self.file_path, 'original contents')
+    temp_dir_contents = os.listdir(os.path.dirname(self.file_path))
+    def Fail():
+      with file_util.AtomicWriter(self.file_path) as writer:
+        writer.write(self.sample_contents)
+        raise ValueError('interrupted')
+    self.assertRaises(ValueError, Fail)
+    self.assertEqual(file_util.Read(self.file_path), 'original contents')
+    self.assertItemsEqual(os.listdir(os.path.dirname(self.file_path)),
+                          temp_dir_contents)
+
+  def testAtomicWriteStreamFromFile(self):
+    source_path = os.path.join(self.temp_dir, 'source')
+    contents = os.urandom(100000)
+    file_util.Write(source_path, contents)
+    with open(source_path, 'rb') as source:
+      file_util.AtomicWriteStream(self.file_path, source, buffer_size=4096)
+    self.assertEqual(file_util.Read(self.file_path), contents)
+    # Sources without readinto() are read into strings.
+    file_util.AtomicWriteStream(self.file_path,
+                                StringIO.StringIO(self.sample_contents),
+                                buffer_size=7)
+    self.assertEqual(file_util.Read(self.file_path), self.sample_contents)
+
+  def testAtomicWriteStreamFromIterable(self):
+    file_util.AtomicWriteStream(self.file_path,
+                                (str(i) for i in xrange(1000)), mode=0640)
+    self.assertEqual(file_util.Read(self.file_path),
+                     ''.join(str(i) for i in xrange(1000)))
+    self.assertEqual(stat.S_IMODE(os.stat(self.file_path).st_mode), 0640)
+
+  def testAtomicWriteStreamPartialWrites(self):
+    real_write = os.write
+    stubs = mox.stubout.StubOutForTesting()
+    stubs.Set(os, 'write', lambda fd, data: real_write(fd, data[:7]))
+    try:
+      file_util.AtomicWriteStream(self.file_path, ['a' * 50, 'b' * 5000],
+                                  buffer_size=1000)
+    finally:
+      stubs.UnsetAll()
+    self.assertEqual(file_util.Read(self.file_path), 'a' * 50 + 'b' * 5000)
+
+  def _RecordSyncs(self):
+    """Make os.fsync record whether it syncs a directory or a file."""
+    syncs = []
+    real_fsync = os.fsync
+    def RecordingFsync(fd):
+      syncs.append(stat.S_ISDIR(os.fstat(fd).st_mode) and 'dir' or 'file')
+      real_fsync(fd)
+    stubs = mox.stubout.StubOutForTesting()
+    stubs.Set(os, 'fsync', RecordingFsync)
+    self.addCleanup(stubs.UnsetAll)
+    return syncs
+
+  def testAtomicWriteDurability(self):
+    syncs = self._RecordSyncs()
+    file_util.AtomicWrite(self.file_path, self.sample_contents)
+    self.assertEqual(syncs, [])
+    file_util.AtomicWrite(self.file_path, self.sample_contents,
+                          durability=file_util.DURABILITY_FILE)
+    self.assertEqual(syncs, ['file'])
+    file_util.AtomicWrite(self.file_path, self.sample_contents,
+                          durability=file_util.DURABILITY_DIRECTORY)
+    self.assertEqual(syncs, ['file', 'file', 'dir'])
+    with file_util.AtomicWriter(
+        self.file_path, durability=file_util.DURABILITY_DIRECTORY) as writer:
+      writer.write(self.sample_contents)
+    self.assertEqual(syncs, ['file', 'file', 'dir', 'file', 'dir'])
+    self.assertEqual(file_util.Read(self.file_path), self.sample_contents)
+
+  def testAtomicWriteBadDurability(self):
+    self.assertRaises(ValueError, file_util.AtomicWrite, self.file_path,
+                      self.sample_contents, durability='always')
+    self.assertFalse(os.path.exists(self.file_path))
+
+  def testAtomicWriteMany(self):
+    syncs = self._RecordSyncs()
+    os.mkdir(os.path.join(self.temp_dir, 'sub'))
+    files = [(os.path.join(self.temp_dir, name), name)
+             for name in ('a', 'b', 'sub/c', 'sub/d')]
+    file_util.AtomicWriteMany(files, mode=0640)
+    for filename, contents in files:
+      self.assertEqual(file_util.Read(filename), contents)
+      self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0640)
+    self.assertEqual(syncs, ['file'] * 4 + ['dir'] * 2)
+    del syncs[:]
+    file_util.AtomicWriteMany(files, durability=file_util.DURABILITY_NONE)
+    self.assertEqual(syncs, [])
+
+  def testWriteFiles(self):
+    syncs = self._RecordSyncs()
+    os.mkdir(os.path.join(self.temp_dir, 'sub'))
+    files = [(os.path.join(self.temp_dir, name), name * 100)
+             for name in ['f%d' % i for i in xrange(20)] +
+             ['sub/g%d' % i for i in xrange(20)]]
+    errors = file_util.WriteFiles(iter(files), mode=0640, threads=4)
+    self.assertEqual(errors, {})
+    for filename, contents in files:
+      self.assertEqual(file_util.Read(filename), contents)
+      self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0640)
+    self.assertEqual(sorted(syncs), ['dir'] * 2 + ['file'] * 40)
+    del syncs[:]
+    file_util.WriteFiles(files, threads=1,
+                         durability=file_util.DURABILITY_NONE)
+    self.assertEqual(syncs, [])
+
+  def testWriteFilesErrors(self):
+    missing = os.path.join(self.temp_dir, 'missing', 'a')
+    good = os.path.join(self.temp_dir, 'b')
+    errors = file_util.WriteFiles([(missing, 'a'), (good, 'b')], threads=2)
+    self.assertEqual(errors.keys(), [missing])
+    self.assertEqual(errors[missing].errno, errno.ENOENT)
+    self.assertEqual(file_util.Read(good), 'b')
+    self.assertRaises(ValueError, file_util.WriteFiles, [(good, 'c')],
+                      durability='always')
+    self.assertRaises(TypeError, file_util.WriteFiles, [(good, None)])
+    self.assertEqual(file_util.Read(good), 'b')
+
+  def testWriteFilesMakeDirs(self):
+    file_util.ForgetDirs()
+    self.addCleanup(file_util.ForgetDirs)
+    filename = os.path.join(self.temp_dir, 'x', 'y', 'z')
+    errors = file_util.WriteFiles([(filename, 'z')], make_dirs=True)
+    self.assertEqual(errors, {})
+    self.assertEqual(file_util.Read(filename), 'z')
+    # Removed without telling MkDirsCached, the directory is made again.
+    shutil.rmtree(os.path.join(self.temp_dir, 'x'))
+    errors = file_util.WriteFiles([(filename, 'z2')], make_dirs=True)
+    self.assertEqual(errors, {})
+    self.assertEqual(file_util.Read(filename), 'z2')
+
+  def _CopyFileContents(self):
+    source = os.path.join(self.temp_dir, 'source')
+    destination = os.path.join(self.temp_dir, 'destination')
+    contents = ''.join(chr(i % 251) for i in xrange(3 * 1000 * 1000 + 17))
+    file_util.Write(source, contents)
+    file_util.Write(destination, 'old contents')
+    file_util.CopyFile(source, destination, buffer_size=4096)
+    self.assertEqual(file_util.Read(destination), contents)
+    file_util.Write(source, '')
+    file_util.CopyFile(source, destination)
+    self.assertEqual(file_util.Read(destination), '')
+
+  def testCopyFile(self):
+    self._CopyFileContents()
+
+  def testCopyFileWithoutKernelSupport(self):
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(file_util, '_CloneFile', lambda in_fd, out_fd: False)
+    stubs.Set(file_util, '_CopyFunctions', lambda: (None, None))
+    self._CopyFileContents()
+
+  def testCopyFilePreserveMetadata(self):
+    source = os.path.join(self.temp_dir, 'source')
+    destination = os.path.join(self.temp_dir, 'destination')
+    file_util.Write(source, 'contents', mode=0640)
+    os.chmod(source, 0640)
+    os.utime(source, (1000000000, 1200000000))
+    file_util.CopyFile(source, destination, preserve_metadata=True)
+    info = os.stat(destination)
+    self.assertEqual(stat.S_IMODE(info.st_mode), 0640)
+    self.assertEqual(int(info.st_mtime), 1200000000)
+    self.assertEqual(int(info.st_atime), 1000000000)
+    self.assertEqual(file_util.Read(destination), 'contents')
+    file_util.CopyFile(source, destination, mode=0604)
+    self.assertEqual(stat.S_IMODE(os.stat(destination).st_mode), 0604)
+
+  def testCopyFileModeFollowsUmask(self):
+    source = os.path.join(self.temp_dir, 'source')
+    destination = os.path.join(self.temp_dir, 'destination')
+    file_util.Write(source, 'secret', mode=0600)
+    os.chmod(source, 0600)
+    self.addCleanup(os.umask, os.umask(027))
+    file_util.CopyFile(source, destination)
+    self.assertEqual(stat.S_IMODE(os.stat(destination).st_mode), 0640)
+    self.assertEqual(file_util.Read(destination), 'secret')
+
+  def testCopyFileMissingSource(self):
+    destination = os.path.join(self.temp_dir, 'destination')
+    self.assertRaises(OSError, file_util.CopyFile,
+                      os.path.join(self.temp_dir, 'missing'), destination)
+    self.assertFalse(os.path.exists(destination))
+    self.assertEqual(os.listdir(self.temp_dir), [])
+
+  def testAtomicWriteAnonymousFile(self):
+    fd = file_util._OpenAnonymousFile(self.temp_dir)
+    if fd is None:
+      return  # Not supported here, AtomicWrite uses mkstemp.
+    os.close(fd)
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(tempfile, 'mkstemp', None)  # Must not be called.
+    file_path = os.path.join(self.temp_dir, 'sample.txt')
+    file_util.AtomicWrite(file_path, 'original contents', mode=0604)
+    self.assertEqual(file_util.Read(file_path), 'original contents')
+    self.assertEqual(stat.S_IMODE(os.stat(file_path).st_mode), 0604)
+    file_util.AtomicWrite(file_path, self.sample_contents,
+                          durability=file_util.DURABILITY_DIRECTORY)
+    self.assertEqual(file_util.Read(file_path), self.sample_contents)
+    with file_util.AtomicWriter(file_path, mode=0640) as writer:
+      writer.write('streamed')
+    self.assertEqual(file_util.Read(file_path), 'streamed')
+    self.assertEqual(stat.S_IMODE(os.stat(file_path).st_mode), 0640)
+    self.assertEqual(os.listdir(self.temp_dir), ['sample.txt'])
+
+  def testAtomicWriteWithoutAnonymousFiles(self):
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(file_util, '_anonymous_files_supported', False)
+    file_path = os.path.join(self.temp_dir, 'sample.txt')
+    file_util.AtomicWrite(file_path, self.sample_contents, mode=0604)
+    self.assertEqual(file_util.Read(file_path), self.sample_contents)
+    self.assertEqual(stat.S_IMODE(os.stat(file_path).st_mode), 0604)
+    self.assertEqual(os.listdir(self.temp_dir), ['sample.txt'])
+
+  def testWritePartialWrites(self):
+    real_write = os.write
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(os, 'write', lambda fd, data: real_write(fd, data[:7]))
+    stubs.Set(file_util, '_anonymous_files_supported', False)
+    contents = 'c' * 1000
+    file_util.Write(self.file_path, contents)
+    self.assertEqual(file_util.Read(self.file_path), contents)
+    file_util.AtomicWrite(self.file_path, self.sample_contents)
+    self.assertEqual(file_util.Read(self.file_path), self.sample_contents)
+
+  def testWriteUnicode(self):
+    for anonymous_files_supported in (True, False):
+      stubs = mox.stubout.StubOutForTesting()
+      stubs.Set(file_util, '_anonymous_files_supported',
+                anonymous_files_supported)
+      try:
+        file_util.Write(self.file_path, u'written')
+        self.assertEqual(file_util.Read(self.file_path), 'written')
+        file_util.AtomicWrite(self.file_path, u'atomically written')
+        self.assertEqual(file_util.Read(self.file_path), 'atomically written')
+      finally:
+        stubs.UnsetAll()
+
+  def testWriteUnicodePartialWrites(self):
+    real_write = os.write
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(os, 'write', lambda fd, data: real_write(fd, data[:7]))
+    contents = u'c' * 1000
+    file_util.Write(self.file_path, contents)
+    self.assertEqual(file_util.Read(self.file_path), str(contents))
+
+  def testAtomicWriteAnonymousFileSparesOtherNames(self):
+    fd = file_util._OpenAnonymousFile(self.temp_dir)
+    if fd is None:
+      return  # Not supported here, AtomicWrite uses mkstemp.
+    os.close(fd)
+    file_path = os.path.join(self.temp_dir, 'sample.txt')
+    file_util.Write(file_path, 'original contents')
+    # The first temporary name tried is taken by another writer.
+    other_path = '%s.%s.tmp' % (file_path, ('\x01' * 8).encode('hex'))
+    file_util.Write(other_path, 'other contents')
+    random_bytes = iter(['\x01' * 8, '\x02' * 8])
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(os, 'urandom', lambda size: next(random_bytes))
+    file_util.AtomicWrite(file_path, self.sample_contents)
+    stubs.UnsetAll()
+    self.assertEqual(file_util.Read(file_path), self.sample_contents)
+    self.assertEqual(file_util.Read(other_path), 'other contents')
+    self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                     sorted(['sample.txt', os.path.basename(other_path)]))
+
+  def testMappedRead(self):
+    contents = 'header:' + os.urandom(300000) + ':footer'
+    file_util.Write(self.file_path, contents)
+    for access in (None, file_util.ACCESS_NORMAL, file_util.ACCESS_RANDOM,
+                   file_util.ACCESS_SEQUENTIAL, file_util.ACCESS_WILLNEED):
+      with file_util.MappedRead(self.file_path, access=access) as mapping:
+        self.assertEqual(len(mapping), len(contents))
+        self.assertEqual(mapping[:7], 'header:')
+        self.assertEqual(mapping.find(':footer'), len(contents) - 7)
+        self.assertEqual(str(buffer(mapping)), contents)
+    self.assertRaises(ValueError, mapping.find, 'header')  # Closed.
+
+  def testMappedReadEmptyFile(self):
+    file_util.Write(self.file_path, '')
+    with file_util.MappedRead(self.file_path) as mapping:
+      self.assertEqual(mapping, '')
+
+  def testMappedReadBadAccess(self):
+    file_util.Write(self.file_path, self.sample_contents)
+    def MapWithBadAccess():
+      with file_util.MappedRead(self.file_path, access='backwards'):
+        pass
+    self.assertRaises(ValueError, MapWithBadAccess)
+
+  def testReadChunks(self):
+    contents = os.urandom(10000)
+    file_util.Write(self.file_path, contents)
+    chunks = list(file_util.ReadChunks(self.file_path, chunk_size=4096))
+    self.assertEqual([len(chunk) for chunk in chunks], [4096, 4096, 1808])
+    self.assertEqual(''.join(chunks), contents)
+    file_util.Write(self.file_path, '')
+    self.assertEqual(list(file_util.ReadChunks(self.file_path)), [])
+
+
+class WalkDirTest(basetest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    for dir_name in ('a', 'a/b', 'a/b/c', 'skip', 'skip/deep', 'empty'):
+      os.mkdir(os.path.join(self.temp_dir, dir_name))
+    for file_name in ('top.py', 'a/one.py', 'a/one.txt', 'a/b/two.py',
+                      'a/b/c/three.txt', 'skip/four.py', 'skip/deep/five.py'):
+      file_util.Write(os.path.join(self.temp_dir, file_name), file_name)
+    os.symlink(os.path.join(self.temp_dir, 'a'),
+               os.path.join(self.temp_dir, 'link'))
+    self.all_paths = set(['top.py', 'a', 'a/one.py', 'a/one.txt', 'a/b',
+                          'a/b/two.py', 'a/b/c', 'a/b/c/three.txt', 'skip',
+                          'skip/four.py', 'skip/deep', 'skip/deep/five.py',
+                          'empty', 'link'])
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def Walk(self, **kwargs):
+    return set(os.path.relpath(entry.path, self.temp_dir)
+               for entry in file_util.WalkDir(self.temp_dir, **kwargs))
+
+  def testWalkDir(self):
+    for threads in (1, 4):
+      self.assertEqual(self.Walk(threads=threads), self.all_paths)
+
+  def testWalkDirDepthFirst(self):
+    paths = [os.path.relpath(entry.path, self.temp_dir)
+             for entry in file_util.WalkDir(self.temp_dir)]
+    self.assertEqual(len(paths), len(self.all_paths))
+    # The entries below sibling directories do not interleave.
+    below_a = [i for i, path in enumerate(paths) if path.startswith('a/')]
+    below_skip = [i for i, path in enumerate(paths)
+                  if path.startswith('skip/')]
+    self.assertTrue(max(below_a) < min(below_skip) or
+                    max(below_skip) < min(below_a))
+
+  def testWalkDirEntries(self):
+    for threads in (1, 3):
+      entries = dict((entry.name, entry) for entry in
+                     file_util.WalkDir(self.temp_dir, threads=threads))
+      self.assertTrue(entries['a'].is_dir())
+      self.assertFalse(entries['a'].is_file())
+      self.assertTrue(entries['two.py'].is_file())
+      self.assertTrue(entries['link'].is_symlink())
+      self.assertTrue(entries['link'].is_dir())
+      self.assertFalse(entries['link'].is_dir(follow_symlinks=False))
+      self.assertEqual(entries['top.py'].stat().st_size, len('top.py'))
+
+  def testWalkDirFilters(self):
+    for threads in (1, 2):
+      self.assertEqual(self.Walk(include=['*.py'], threads=threads),
+                       set(['top.py', 'a/one.py', 'a/b/two.py',
+                            'skip/four.py', 'skip/deep/five.py']))
+      self.assertEqual(
+          self.Walk(include=['*.py'], exclude=['skip', 'a/b/*'],
+                    threads=threads),
+          set(['top.py', 'a/one.py']))
+      self.assertEqual(
+          self.Walk(prune=lambda entry: entry.name in ('a', 'skip'),
+                    threads=threads),
+          set(['top.py', 'a', 'skip', 'empty', 'link']))
+
+  def testWalkDirFollowSymlinks(self):
+    self.assertEqual(self.Walk(follow_symlinks=True),
+                     self.all_paths | set(['link/one.py', 'link/one.txt',
+                                           'link/b', 'link/b/two.py',
+                                           'link/b/c', 'link/b/c/three.txt']))
+
+  def testWalkDirErrors(self):
+    errors = []
+    missing = os.path.join(self.temp_dir, 'missing')
+    self.assertEqual(list(file_util.WalkDir(missing)), [])
+    self.assertEqual(list(file_util.WalkDir(missing, onerror=errors.append,
+                                            threads=2)), [])
+    self.assertEqual([e.errno for e in errors], [errno.ENOENT])
+
+  def testWalkDirWithoutScandir(self):
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(file_util, '_scandir', file_util._ListDirEntries)
+    self.testWalkDir()
+    self.testWalkDirEntries()
+
+
+class RemoveTreeTest(basetest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.outside = os.path.join(self.temp_dir, 'outside')
+    os.mkdir(self.outside)
+    file_util.Write(os.path.join(self.outside, 'keep'), 'keep')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def MakeTree(self, name):
+    top = os.path.join(self.temp_dir, name)
+    for i in xrange(5):
+      directory = os.path.join(top, 'd%d' % i, 'sub', 'subsub')
+      os.makedirs(directory)
+      for j in xrange(20):
+        file_util.Write(os.path.join(directory, 'f%d' % j), 'x')
+        file_util.Write(os.path.join(top, 'd%d' % i, 'f%d' % j), 'x')
+    os.symlink(self.outside, os.path.join(top, 'd0', 'link'))
+    os.symlink('missing', os.path.join(top, 'dangling'))
+    return top
+
+  def testRemoveTree(self):
+    for threads in (1, 2, 8):
+      top = self.MakeTree('tree')
+      file_util.RemoveTree(top, threads=threads)
+      self.assertFalse(os.path.lexists(top))
+      self.assertTrue(os.path.exists(os.path.join(self.outside, 'keep')))
+
+  def testRemoveTreeErrors(self):
+    missing = os.path.join(self.temp_dir, 'missing')
+    try:
+      file_util.RemoveTree(missing)
+    except OSError as e:
+      self.assertEqual(e.errno, errno.ENOENT)
+    else:
+      self.fail('OSError not raised')
+    self.assertRaises(OSError, file_util.RemoveTree,
+                      os.path.join(self.outside, 'keep'))
+    link = os.path.join(self.temp_dir, 'link')
+    os.symlink(self.outside, link)
+    self.assertRaises(OSError, file_util.RemoveTree, link)
+    self.assertTrue(os.path.exists(os.path.join(self.outside, 'keep')))
+
+  def testRemoveTreeWithoutAtFunctions(self):
+    stubs = mox.stubout.StubOutForTesting()
+    self.addCleanup(stubs.UnsetAll)
+    stubs.Set(file_util, '_have_proc_self_fd', False)
+    self.testRemoveTree()
+
+  def testRmDirsThreaded(self):
+    top = self.MakeTree(os.path.join('parent', 'tree'))
+    file_util.RmDirs(top, threads=4)
+    self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'parent')))
+    file_util.RmDirs(top, threads=4)  # Does not exist anymore.
+
+  def testTemporaryDirectoryThreaded(self):
+    with file_util.TemporaryDirectory(base_path=self.temp_dir,
+                                      threads=4) as temp_dir:
+      file_util.Write(os.path.join(temp_dir, 'file'), 'x')
+      os.makedirs(os.path.join(temp_dir, 'a', 'b'))
+    self.assertFalse(os.path.exists(temp_dir))
+
+
+class FileDigestTest(basetest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.file_path = os.path.join(self.temp_dir, 'sample.txt')
+    self.contents = 'sample contents\n' * 100000
+    file_util.Write(self.file_path, self.contents)
+    os.utime(self.file_path, (1000000000, 1000000000))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testFileDigest(self):
+    self.assertEqual(file_util.FileDigest(self.file_path),
+                     hashlib.sha256(self.contents).hexdigest())
+    self.assertEqual(
+        file_util.FileDigest(self.file_path, algorithm='md5', chunk_size=7),
+        hashlib.md5(self.contents).hexdigest())
+    self.assertRaises(ValueError, file_util.FileDigest, self.file_path,
+                      algorithm='nonesuch')
+    self.assertRaises(IOError, file_util.FileDigest,
+                      os.path.join(self.temp_dir, 'missing'))
+
+  def testFileDigests(self):
+    filenames = [os.path.join(self.temp_dir, str(i)) for i in xrange(20)]
+    for filename in filenames:
+      file_util.Write(filename, filename)
+    digests = file_util.FileDigests(filenames, algorithm='sha1', threads=4)
+    self.assertEqual(digests, dict((filename, hashlib.sha1(filename).hexdigest())
+                                   for filename in filenames))
+
+  def testDigestCache(self):
+    cache_path = os.path.join(self.temp_dir, 'digests')
+    digest = hashlib.sha256(self.contents).hexdigest()
+    with file_util.DigestCache(cache_path) as cache:
+      self.assertEqual(file_util.FileDigest(self.file_path, cache=cache),
+                       digest)
+      self.assertEqual(len(cache), 1)
+    cache = file_util.DigestCache(cache_path)
+    self.assertEqual(len(cache), 1)
+    # Change the contents but not the size and times: it is not read again.
+    with open(self.file_path, 'r+') as fp:
+      fp.write('S')
+    os.utime(self.file_path, (1000000000, 1000000000))
+    self.assertEqual(file_util.FileDigest(self.file_path, cache=cache),
+                     digest)
+    self.assertEqual(file_util.FileDigest(self.file_path, algorithm='md5',
+                                          cache=cache),
+                     hashlib.md5('S' + self.contents[1:]).hexdigest())
+
+  def testDigestCacheHit(self):
+    cache = file_util.DigestCache()
+    file_util.FileDigest(self.file_path, cache=cache)
+    cache.Put('sha256', os.stat(self.file_path), 'cached')
+    self.assertEqual(file_util.FileDigest(self.file_path, cache=cache),
+                     'cached')
+    # A changed file is hashed again.
+    os.utime(self.file_path, (1000000000, 1000000001))
+    self.assertEqual(file_util.FileDigest(self.file_path, cache=cache),
+                     hashlib.sha256(self.contents).hexdigest())
+    self.assertEqual(len(cache), 2)
+
+  def testDigestCacheRecentFile(self):
+    cache = file_util.DigestCache()
+    os.utime(self.file_path, None)
+    file_util.FileDigest(self.file_path, cache=cache)
+    self.assertEqual(len(cache), 0)
+
+  def testDigestCacheFileIsPrivate(self):
+    cache_path = os.path.join(self.temp_dir, 'digests')
+    with file_util.DigestCache(cache_path) as cache:
+      file_util.FileDigest(self.file_path, cache=cache)
+    self.assertEqual(stat.S_IMODE(os.stat(cache_path).st_mode), 0600)
+
+  def testDigestCacheDamaged(self):
+    cache_path = os.path.join(self.temp_dir, 'digests')
+    file_util.Write(cache_path, 'sha256 1 2 3 4 abcd\ngarbage\nmd5 x 1 2 3 a\n')
+    cache = file_util.DigestCache(cache_path)
+    self.assertEqual(len(cache), 1)
+
 
 class FileUtilMoxTestBase(basetest.TestCase):
 
@@ -144,7 +699,8 @@ class FileUtilMoxTest(FileUtilMoxTestBase):
     gid = 'new gid'
     os.open(self.file_path, os.O_WRONLY | os.O_TRUNC | os.O_CREAT,
             0666).AndReturn(self.fd)
-    os.write(self.fd, self.sample_contents)
+    os.write(self.fd, self.sample_contents).AndReturn(
+        len(self.sample_contents))
     os.close(self.fd)
     os.chown(self.file_path, -1, gid)
     self.mox.ReplayAll()
@@ -169,7 +725,8 @@ class AtomicWriteMoxTest(FileUtilMoxTestBase):
 
     tempfile.mkstemp(dir='/path/to/some').AndReturn(
         (self.fd, self.temp_filename))
-    os.write(self.fd, self.sample_contents)
+    os.write(self.fd, self.sample_contents).AndReturn(
+        len(self.sample_contents))
     os.close(self.fd)
     os.chmod(self.temp_filename, self.mode)
 
@@ -389,6 +946,102 @@ class MkDirsMoxTest(FileUtilMoxTestBase):
     self.mox.VerifyAll()
 
 
+class MkDirsCachedMoxTest(FileUtilMoxTestBase):
+
+  # pylint: disable=maybe-no-member
+
+  def setUp(self):
+    super(MkDirsCachedMoxTest, self).setUp()
+    file_util.ForgetDirs()
+    self.mox.StubOutWithMock(os, 'mkdir')
+    self.mox.StubOutWithMock(os, 'chmod')
+    self.mox.StubOutWithMock(os.path, 'isdir')
+    self.exist_error = OSError(errno.EEXIST, 'This string not used')
+    self.non_exist_error = OSError(errno.ENOENT, 'This string not used')
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    file_util.ForgetDirs()
+
+  def testLeafFirstThenCached(self):
+    # record, replay
+    os.mkdir('/foo/bar/baz').AndRaise(self.non_exist_error)
+    os.mkdir('/foo/bar').AndRaise(self.non_exist_error)
+    os.mkdir('/foo')
+    os.chmod('/foo', 0707)
+    os.mkdir('/foo/bar')
+    os.chmod('/foo/bar', 0707)
+    os.mkdir('/foo/bar/baz')
+    os.chmod('/foo/bar/baz', 0707)
+    self.mox.ReplayAll()
+    # test, verify
+    file_util.MkDirsCached('/foo/bar/baz', force_mode=0707)
+    file_util.MkDirsCached('/foo/bar/baz/')
+    file_util.MkDirsCached('/foo/./bar/baz', force_mode=0707)
+    self.mox.VerifyAll()
+
+  def testExistingDirectory(self):
+    # record, replay
+    os.mkdir('/foo').AndRaise(self.exist_error)
+    os.path.isdir('/foo').AndReturn(True)
+    self.mox.ReplayAll()
+    # test, verify
+    file_util.MkDirsCached('/foo', force_mode=0707)
+    file_util.MkDirsCached('/foo')
+    self.mox.VerifyAll()
+
+  def testFileInsteadOfDirectory(self):
+    # record, replay
+    os.mkdir('/foo').AndRaise(self.exist_error)
+    os.path.isdir('/foo').AndReturn(False)
+    os.mkdir('/foo').AndRaise(self.exist_error)
+    os.path.isdir('/foo').AndReturn(False)
+    self.mox.ReplayAll()
+    # test, verify
+    self.assertRaises(OSError, file_util.MkDirsCached, '/foo')
+    self.assertRaises(OSError, file_util.MkDirsCached, '/foo')
+    self.mox.VerifyAll()
+
+  def testForgetDirs(self):
+    # record, replay
+    os.mkdir('/foo/bar')
+    os.mkdir('/foo/barn')
+    os.mkdir('/foo/bar')
+    os.mkdir('/foo/barn')
+    self.mox.ReplayAll()
+    # test, verify
+    file_util.MkDirsCached('/foo/bar')
+    file_util.MkDirsCached('/foo/barn')
+    file_util.ForgetDirs('/foo/bar')
+    file_util.MkDirsCached('/foo/barn')  # Still known.
+    file_util.MkDirsCached('/foo/bar')
+    file_util.ForgetDirs()
+    file_util.MkDirsCached('/foo/barn')
+    self.mox.VerifyAll()
+
+
+class MkDirsCachedTest(basetest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+    file_util.ForgetDirs()
+
+  def testMkDirsCached(self):
+    directory = os.path.join(self.temp_dir, 'a', 'b', 'c')
+    file_util.MkDirsCached(directory)
+    self.assertTrue(os.path.isdir(directory))
+    # Removing the directory through file_util forgets it.
+    file_util.RmDirs(os.path.join(self.temp_dir, 'a', 'b'))
+    file_util.MkDirsCached(directory)
+    self.assertTrue(os.path.isdir(directory))
+    file_util.RemoveTree(os.path.join(self.temp_dir, 'a'))
+    file_util.MkDirsCached(directory)
+    self.assertTrue(os.path.isdir(directory))
+
+
 class RmDirsTestCase(mox.MoxTestBase):
 
   def testRmDirs(self):